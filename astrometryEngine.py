@@ -0,0 +1,175 @@
+"""Persistent astrometry.net solver for the astrometry profiles
+
+solve-field starts a new process for every image, which reads the config, loads the index files
+and runs its own star extraction each time, and its results have to be picked out of the text it
+prints.  Here the index files are loaded once, by the astrometry python package
+(pip3 install astrometry), and stay loaded in a worker process.  Only the index files the index
+planner picks for the current profile are loaded, and they are loaded again when the pick changes.
+The stars are the centroids found by tetra3's extraction, sent through a pipe as a list, and the
+solution comes back as a dict.  The worker is started like the tetra3 solver process, so a crash
+or the memory of the index files stays out of the web server, and a worker that dies or hangs
+past the timeout is killed and started again by the next solve.  Without the package or index
+files solve() returns None and the caller uses solve-field instead.
+"""
+import atexit
+import glob
+import importlib.util
+import multiprocessing
+import multiprocessing.connection
+import os
+import pathlib
+import subprocess
+import sys
+import threading
+import time
+
+
+def _solve(solver, stars, width, scaleLow, scaleHigh, ra, dec, radius):
+    import astrometry
+    sizeHint = None
+    if scaleLow is not None:
+        sizeHint = astrometry.SizeHint(
+            lower_arcsec_per_pixel=scaleLow,
+            upper_arcsec_per_pixel=scaleHigh if scaleHigh is not None else astrometry.DEFAULT_UPPER_ARCSEC_PER_PIXEL)
+    positionHint = None
+    if radius:
+        positionHint = astrometry.PositionHint(ra_deg=ra, dec_deg=dec, radius_deg=radius)
+    # stop at the first match good enough, like solve-field does
+    parameters = astrometry.SolutionParameters(
+        logodds_callback=lambda logodds: astrometry.Action.STOP)
+    t0 = time.time()
+    solution = solver.solve(stars=stars, size_hint=sizeHint, position_hint=positionHint,
+                            solution_parameters=parameters)
+    tSolve = (time.time() - t0)*1000
+    if not solution.has_match():
+        return {'RA': None, 'Dec': None, 'FOV': None, 'Scale': None, 'Index': None,
+                'LogOdds': None, 'Matches': None, 'WCS': None, 'T_solve': tSolve}
+    match = solution.best_match()
+    return {'RA': match.center_ra_deg, 'Dec': match.center_dec_deg,
+            'FOV': match.scale_arcsec_per_pixel*width/3600, 'Scale': match.scale_arcsec_per_pixel,
+            'Index': os.path.basename(match.index_path), 'LogOdds': match.logodds,
+            'Matches': len(match.stars), 'WCS': {key: value[0] for key, value in match.wcs_fields.items()},
+            'T_solve': tSolve}
+
+
+def _worker(conn):
+    import astrometry
+    solver = None
+    loaded = None
+    try:
+        while True:
+            request = conn.recv()
+            if request is None:
+                break
+            indexFiles, args = request
+            if set(indexFiles) != loaded:
+                if solver is not None:
+                    solver.close()
+                t0 = time.time()
+                solver = astrometry.Solver([pathlib.Path(fn) for fn in indexFiles])
+                loaded = set(indexFiles)
+                print("astrometry engine loaded %d index files in %.1f secs" %
+                      (len(indexFiles), time.time() - t0), flush=True)
+            conn.send(_solve(solver, *args))
+    finally:
+        if solver is not None:
+            solver.close()
+
+
+class astrometryEngine():
+
+    def __init__(self, indexDirs=('/usr/share/astrometry', '/usr/local/astrometry/data'), loadTimeout=300.):
+        self.indexDirs = indexDirs
+        self.indexFiles = sorted(fn for d in indexDirs for fn in glob.glob(os.path.join(d, 'index-*.fits')))
+        self.installed = importlib.util.find_spec('astrometry') is not None
+        if not self.installed:
+            print("astrometry package not available, solve-field will be used", flush=True)
+        self.loadTimeout = loadTimeout  # extra time allowed when the index files are (re)loaded
+        self.lock = threading.Lock()  # one solve at a time
+        self.process = None
+        self.conn = None
+        self.loaded = None  # the index files loaded in the worker
+        self.restarts = 0
+        atexit.register(self.close)
+
+    @property
+    def available(self):
+        return self.installed and len(self.indexFiles) > 0
+
+    def start(self):
+        self.conn, child = multiprocessing.Pipe()
+        self.process = subprocess.Popen([sys.executable, os.path.abspath(__file__),
+                                         str(child.fileno())], pass_fds=(child.fileno(),))
+        child.close()
+        self.loaded = None
+        print("astrometry engine process started", self.process.pid, flush=True)
+
+    def kill(self, reason):
+        print("astrometry engine", reason, "stopping it", flush=True)
+        self.restarts += 1
+        self.conn.close()
+        if self.process.poll() is None:
+            self.process.kill()
+        self.process.wait()
+        self.process = None
+
+    def close(self):
+        with self.lock:
+            if self.process is None:
+                return
+            try:
+                self.conn.send(None)
+            except (BrokenPipeError, OSError):
+                pass
+            try:
+                self.process.wait(5)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+            self.process = None
+
+    def solve(self, centroids, size, scaleLow=None, scaleHigh=None, ra=None, dec=None, radius=None,
+              indexFiles=None, timeout=60.):
+        """Solve the star centroids of an image.
+
+        centroids is the (N,2) list of (y, x) star positions, brightest first, as returned by
+        tetra3, size is the (height, width) of the image.  The scale range is in arcsec per pixel,
+        ra, dec and radius (degrees) limit the search to around a previous position.  indexFiles
+        are the index files to solve with, all found by default, the worker loads them again if
+        they are not the ones it has.  A solve taking longer than timeout seconds (plus loadTimeout
+        when loading) is stopped.
+
+        Returns a dict with 'RA', 'Dec', 'FOV' (image width, degrees), 'Scale' (arcsec per pixel),
+        'Index' (file name of the index that solved it), 'LogOdds', 'Matches' (number of stars
+        matched), 'WCS' (the solution's FITS WCS header values) and 'T_solve' (milliseconds).  All
+        but T_solve are None if it did not solve.  Returns None if the engine isn't available or
+        its worker failed.
+        """
+        if not self.available:
+            return None
+        indexFiles = list(indexFiles or self.indexFiles)
+        stars = [(float(x), float(y)) for y, x in centroids]
+        with self.lock:
+            if self.process is None:
+                self.start()
+            if set(indexFiles) != self.loaded:
+                timeout += self.loadTimeout
+            try:
+                self.conn.send((indexFiles, (stars, size[1], scaleLow, scaleHigh, ra, dec, radius)))
+                if not self.conn.poll(timeout):
+                    self.kill("timed out")
+                    return None
+                solution = self.conn.recv()
+            except (EOFError, BrokenPipeError, ConnectionResetError):
+                self.kill("died")
+                return None
+            self.loaded = set(indexFiles)
+            return solution
+
+
+if __name__ == '__main__':
+    # the worker, started by astrometryEngine.start with its end of the pipe
+    connection = multiprocessing.connection.Connection(int(sys.argv[1]))
+    try:
+        _worker(connection)
+    except EOFError:
+        pass  # the web server has gone
@@ -0,0 +1,78 @@
+"""Hands the latest frame or status message to every client streaming it
+
+Clients (e.g. the /video_feed and /skyQstatus generators) block on a condition variable until
+something new is put, instead of polling.  Only the latest item is kept, so a client that is
+slower than the camera skips to the newest frame rather than falling behind.  A client which has
+not come back for a new item within dropAfter seconds is dropped, its next get returns None so
+its stream ends.
+"""
+import itertools
+import threading
+import time
+
+
+class broadcaster():
+
+    def __init__(self, dropAfter=30.):
+        self.dropAfter = dropAfter
+        self.condition = threading.Condition()
+        self.item = None
+        self.count = 0  # number of items put so far
+        self.clients = {}  # client id: [count of the last item it got, time it last asked]
+        self.ids = itertools.count()
+
+    def put(self, item):
+        """Make item the latest one and wake up all waiting clients."""
+        with self.condition:
+            self.item = item
+            self.count += 1
+            now = time.time()
+            for client, (seen, asked) in list(self.clients.items()):
+                # drop clients stuck on an old item, e.g. a browser tab that stopped reading
+                if seen < self.count - 1 and now - asked > self.dropAfter:
+                    print("dropping slow client", client, flush=True)
+                    del self.clients[client]
+            self.condition.notify_all()
+
+    def latest(self):
+        """Return the latest item, or None if there is none."""
+        with self.condition:
+            return self.item
+
+    def clear(self):
+        with self.condition:
+            self.item = None
+
+    def register(self):
+        """Add a client, its first get returns the latest item if there is one."""
+        with self.condition:
+            client = next(self.ids)
+            self.clients[client] = [self.count - (self.item is not None), time.time()]
+            return client
+
+    def unregister(self, client):
+        with self.condition:
+            self.clients.pop(client, None)
+
+    @property
+    def clientCount(self):
+        with self.condition:
+            return len(self.clients)
+
+    def get(self, client, timeout=None):
+        """Wait for an item newer than the last one the client got and return it.
+
+        Returns None if the client was dropped, or when timing out.
+        """
+        with self.condition:
+            if client not in self.clients:
+                return None
+            self.clients[client][1] = time.time()
+            if not self.condition.wait_for(lambda: client not in self.clients
+                                           or (self.clients[client][0] < self.count
+                                               and self.item is not None), timeout):
+                return None
+            if client not in self.clients:
+                return None
+            self.clients[client] = [self.count, time.time()]
+            return self.item
@@ -0,0 +1,90 @@
+#fake camera replaying image files, so the web based GUI plate solver can be run and tested without camera hardware
+import os
+import time
+import threading
+import numpy as np
+from PIL import Image
+
+"""  stands in for camera_pi2.skyCamera with the same methods
+    the images in replayDir are played back in name order, one per shutter time, over and over
+    with format yuv the frames are grayscale arrays like the raw luminance capture of the real camera
+"""
+
+class fakeCamera():
+    imageTypes = ('.jpg', '.jpeg', '.png')
+
+    def __init__(self, skystatus, shutter=1000000, ISO=800, resolution=(2000,1500), format = 'jpeg', replayDir='static/demo'):
+        print("fake camera replaying", replayDir, flush=True)
+        self.skyStatus = skystatus
+        self.shutter = shutter
+        self.ISO = ISO
+        self.resolution = resolution
+        self.format = format
+        self.replayDir = replayDir
+        self.runMode = True
+        self.cameraStopped = True
+        self.frame = None
+        self.count = 0
+        self.lastCount = {}  # frame count each client last got, by thread
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self._thread, daemon=True)
+        self.thread.start()
+
+    def pause(self):
+        self.runMode = False
+
+    def resume(self):
+        self.runMode = True
+
+    def setISO(self, iso):
+        self.ISO = iso
+
+    def status(self):
+        return [self.ISO, self.shutter, self.resolution]
+
+    def setResolution(self, resolution):
+        self.resolution = resolution
+
+    def setFormat(self, type):
+        self.format = type
+
+    def setShutter(self, value):
+        self.shutter = value
+
+    def get_frame(self):
+        """Return the next frame, waiting for it like the real camera does."""
+        ident = threading.get_ident()
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.count != self.lastCount.get(ident, 0), timeout=40.):
+                print("camera image event wait timed out", flush=True)
+                return None
+            self.lastCount[ident] = self.count
+            return self.frame
+
+    def readImage(self, fn):
+        if self.format == 'yuv':
+            with Image.open(fn) as img:
+                return np.asarray(img.convert('L'))
+        with open(fn, 'rb') as infile:
+            return infile.read()
+
+    def _thread(self):
+        """Replays the files as camera frames."""
+        while True:
+            files = sorted(os.path.join(self.replayDir, fn) for fn in os.listdir(self.replayDir)
+                           if fn.lower().endswith(self.imageTypes))
+            if len(files) == 0:
+                print("fake camera found no images in", self.replayDir, flush=True)
+                time.sleep(5)
+                continue
+            for fn in files:
+                while not self.runMode:
+                    self.cameraStopped = True
+                    time.sleep(.5)
+                self.cameraStopped = False
+                frame = self.readImage(fn)
+                with self.condition:
+                    self.frame = frame
+                    self.count += 1
+                    self.condition.notify_all()
+                time.sleep(self.shutter/1000000)
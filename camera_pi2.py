@@ -5,6 +5,7 @@ from tkinter import EXCEPTION
 import picamera2
 from libcamera import controls
 import threading
+import numpy as np
 
 try:
     from greenlet import getcurrent as get_ident
@@ -91,7 +92,7 @@ class skyCamera():
         self.resolution=resolution
         self.format = format
         if type(resolution) is str: resolution = tuple(map(int, resolution.split('x')))
-        self.previewConfig = self.camera.create_preview_configuration(main={"size": resolution})
+        self.previewConfig = self.createConfig(resolution)
         self.camera.start_preview(picamera2.Preview.NULL)
         self.camera.configure(self.previewConfig)
         self.camera.set_controls(self.cameraControls)
@@ -119,15 +120,28 @@ class skyCamera():
     def status(self):
         return [self.cameraControls.AnalogueGain*100, self.cameraControls.ExposureTime, self.resolution]
 
+    def createConfig(self, resolution):
+        # yuv format captures the frames as arrays, the luminance plane of a YUV420 stream is used
+        # for solving directly without jpeg encoding on the Pi and decoding again to solve
+        if self.format == 'yuv':
+            return self.camera.create_preview_configuration(main={"size": resolution, "format": "YUV420"})
+        return self.camera.create_preview_configuration(main={"size": resolution})
+
     def setResolution(self,  resolution):
         resolution = tuple(map(int, resolution.split('x')))
         self.resolution = resolution
         print ("setting resolution", resolution, flush=True)
-        self.previewConfig = self.camera.create_preview_configuration(main={"size": resolution})
+        self.stopCapture()
+        self.previewConfig = self.createConfig(resolution)
+        self.restartCapture()
+
+    def stopCapture(self):
         self.runMode = False
         while not self.cameraStopped:
             time.sleep(.2)
         self.camera.stop()
+
+    def restartCapture(self):
         self.camera.configure(self.previewConfig)
         self.camera.set_controls(self.cameraControls)
         self.camera.start()
@@ -135,7 +149,14 @@ class skyCamera():
         self.runMode = True
 
     def setFormat(self,type):
+        if (type == 'yuv') == (self.format == 'yuv'):
+            self.format = type
+            return
+        # switching to or from yuv changes the stream format so the camera must be reconfigured
+        self.stopCapture()
         self.format = type
+        self.previewConfig = self.createConfig(self.previewConfig['main']['size'])
+        self.restartCapture()
 
     def setShutter(self, value):
         self.cameraControls.FrameDurationLimits = (value,value)
@@ -178,9 +199,14 @@ class skyCamera():
             try:
                 # return current frame
                 #self.camera.switch_mode_and_capture_file(self.captureConfig, stream, format=self.format)
-                self.camera.capture_file(stream, format=self.format)
-                stream.seek(0)
-                yield stream.read()
+                if self.format == 'yuv':
+                    # the luminance (Y) plane is the first height rows of the YUV420 array
+                    width, height = self.previewConfig['main']['size']
+                    yield np.ascontiguousarray(self.camera.capture_array('main')[:height, :width])
+                else:
+                    self.camera.capture_file(stream, format=self.format)
+                    stream.seek(0)
+                    yield stream.read()
                 if not self.runMode:
                     self.cameraStopped = True
                     print ("camera stopped",flush=True)
@@ -0,0 +1,138 @@
+"""Dark frame and hot pixel calibration of the camera frames
+
+Long exposures with the HQ camera have fixed hot pixels which the extraction takes for stars, and
+being bright they end up among the few stars tetra3 builds its patterns from, so many pattern
+matches are tried in vain before one without a hot pixel is.  With the lens covered a few dark
+frames are captured for the current shutter, ISO and resolution and their median is kept as the
+master dark, the pixels far above its level are the hot pixels.  Both are saved in the darks
+directory, one file per setting, and loaded again when the camera is set that way.  Each frame is
+calibrated in one vectorized step before its stars are found: the dark's excess over its median
+level is subtracted, leaving the sky background's pedestal in place, and every hot pixel is
+replaced by a neighbour.
+
+To see what it saves, the number of pattern trials of the solves with and without calibration are
+kept, and compare() solves a frame both ways.
+"""
+import collections
+import os
+
+import numpy as np
+
+
+class darkCalibration():
+
+    def __init__(self, directory, hotSigma=6, history=50):
+        self.directory = directory
+        self.hotSigma = hotSigma
+        self.enabled = True
+        self.cache = {}  # key: (dark excess, hot pixel indices, their replacements) or None
+        # pattern trials of the last solves, calibrated or not
+        self.trials = {True: collections.deque(maxlen=history), False: collections.deque(maxlen=history)}
+        self.lastCompare = None
+
+    @staticmethod
+    def key(shutter, iso, resolution):
+        """The calibration's name for a camera setting, shutter in microseconds."""
+        if not isinstance(resolution, str):
+            resolution = '%dx%d' % tuple(resolution)
+        return '%d_%d_%s' % (int(shutter), int(round(float(iso))), resolution.replace(' ', ''))
+
+    def fileName(self, key):
+        return os.path.join(self.directory, 'dark_%s.npz' % key)
+
+    def build(self, key, frames):
+        """Make the master dark and hot pixel list from dark frames (2D uint8 arrays) and save them.
+
+        Returns the number of hot pixels.
+        """
+        dark = np.median(np.stack(frames), axis=0).astype(np.uint8)
+        level = np.median(dark)
+        sigma = max(1.48 * np.median(np.abs(dark.astype(np.float32) - level)), 1)
+        hot = np.flatnonzero(dark > level + self.hotSigma * sigma)
+        # replace each hot pixel by the first of its left, right, upper and lower neighbours that
+        # is in the image and not hot itself
+        (height, width) = dark.shape
+        isHot = np.zeros(dark.size, dtype=bool)
+        isHot[hot] = True
+        (row, col) = np.divmod(hot, width)
+        neighbour = hot.copy()
+        todo = np.ones(len(hot), dtype=bool)
+        for (dRow, dCol) in ((0, -1), (0, 1), (-1, 0), (1, 0)):
+            (r, c) = (row + dRow, col + dCol)
+            inside = (r >= 0) & (r < height) & (c >= 0) & (c < width)
+            candidate = np.where(inside, r * width + c, 0)
+            use = todo & inside & ~isHot[candidate]
+            neighbour[use] = candidate[use]
+            todo &= ~use
+        os.makedirs(self.directory, exist_ok=True)
+        np.savez_compressed(self.fileName(key), dark=dark, hot=hot, neighbour=neighbour)
+        self.cache[key] = self.calibration(dark, hot, neighbour)
+        print("dark calibration %s: %d frames, level %.1f, %d hot pixels" %
+              (key, len(frames), level, len(hot)), flush=True)
+        return len(hot)
+
+    def load(self, key):
+        """The calibration for the key, None if there is none."""
+        if key not in self.cache:
+            calibration = None
+            if os.path.exists(self.fileName(key)):
+                with np.load(self.fileName(key)) as f:
+                    calibration = self.calibration(f['dark'], f['hot'], f['neighbour'])
+            self.cache[key] = calibration
+        return self.cache[key]
+
+    @staticmethod
+    def calibration(dark, hot, neighbour):
+        # the sky background sits on the dark's median level, subtracting that too would clip the
+        # faint background at 0, so only what is above (or below) it is subtracted
+        excess = dark.astype(np.int16) - np.int16(np.median(dark))
+        return (excess, hot, neighbour)
+
+    def calibrator(self, key):
+        """A function calibrating a frame of the camera setting key, None if not calibrated."""
+        calibration = self.load(key) if self.enabled else None
+        if calibration is None:
+            return None
+        return lambda gray: self.apply(gray, calibration)
+
+    @staticmethod
+    def apply(gray, calibration):
+        """The calibrated copy of a 2D uint8 frame, the frame itself if its size doesn't match."""
+        (excess, hot, neighbour) = calibration
+        if gray.shape != excess.shape:
+            return gray
+        calibrated = np.subtract(gray, excess, dtype=np.int16).clip(0, 255).astype(np.uint8)
+        flat = calibrated.reshape(-1)
+        flat[hot] = flat[neighbour]
+        return calibrated
+
+    def recordSolve(self, solution, calibrated):
+        # failed solves count too, they tried every pattern, but tracked live solves (0 trials)
+        # matched no patterns at all and would only pull the mean down
+        if solution.get('Trials'):
+            self.trials[bool(calibrated)].append(solution['Trials'])
+
+    def compare(self, raw, calibrated, solver, **kwargs):
+        """Solve the frame before and after calibration, returns the pattern trials of each, the
+        trials saved and whether each solved."""
+        result = {}
+        for (name, gray) in (('raw', raw), ('calibrated', calibrated)):
+            solution = solver.solve_from_image(gray, **kwargs)
+            result[name] = solution.get('Trials')
+            result[name + 'Solved'] = solution['RA'] is not None
+        if result['raw'] is not None and result['calibrated'] is not None:
+            result['saved'] = result['raw'] - result['calibrated']
+        self.lastCompare = result
+        return result
+
+    def report(self):
+        """The calibrations saved, the mean pattern trials per solve with and without calibration
+        and what the last compare() found."""
+        def mean(trials):
+            return float(np.mean(trials)) if len(trials) else None
+        calibrated, raw = mean(self.trials[True]), mean(self.trials[False])
+        saved = raw - calibrated if calibrated is not None and raw is not None else None
+        darks = sorted(fn[len('dark_'):-len('.npz')] for fn in os.listdir(self.directory)
+                       if fn.startswith('dark_')) if os.path.isdir(self.directory) else []
+        return {'enabled': self.enabled, 'darks': darks, 'trialsCalibrated': calibrated,
+                'trialsUncalibrated': raw, 'trialsSaved': saved, 'lastCompare': self.lastCompare}
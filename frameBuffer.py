@@ -0,0 +1,76 @@
+"""In memory frames shared by the solver, the video stream and the focus meter
+
+Each camera (or replayed) image is kept as its encoded bytes together with the time it was taken.
+The grayscale array used for solving and focusing is decoded from the bytes once, the first time
+it is asked for.  Frames captured as raw luminance arrays work the other way round, they are only
+jpeg encoded if something asks for the bytes, e.g. a browser watching the video feed.  The image
+is only written to a file when it has to be, e.g. to save it in the history or to hand it to
+solve-field.  Camera frames can carry a calibration (dark frame and hot pixels), it is applied to
+the grayscale array when that is made.
+"""
+import io
+import threading
+from datetime import datetime
+
+import numpy as np
+from PIL import Image
+
+from broadcaster import broadcaster
+
+
+class skyFrame():
+    """One image, as the encoded bytes (jpeg, png, ...) or grayscale array and the time it was taken."""
+
+    def __init__(self, data=None, timestamp=None, name=None, gray=None, calibrate=None):
+        assert data is not None or gray is not None, 'frame needs encoded data or an array'
+        self._data = data
+        self.timestamp = timestamp if timestamp is not None else datetime.now()
+        # the file the image was read from, None for camera frames
+        self.name = name
+        self._gray = gray
+        self._calibrate = calibrate
+        # the grayscale array before calibration, set once it was calibrated
+        self.rawGray = None
+        self._lock = threading.RLock()
+
+    @classmethod
+    def fromFile(cls, fn):
+        with open(fn, 'rb') as infile:
+            return cls(infile.read(), name=fn)
+
+    @property
+    def data(self):
+        """The encoded image, jpeg encoded on first use for frames captured as arrays."""
+        with self._lock:
+            if self._data is None:
+                stream = io.BytesIO()
+                Image.fromarray(self._gray).save(stream, format='JPEG', quality=90)
+                self._data = stream.getvalue()
+            return self._data
+
+    @property
+    def calibrated(self):
+        return self.rawGray is not None
+
+    def gray(self):
+        """Return the image as a 2D uint8 numpy array, decoded and calibrated on first use."""
+        with self._lock:
+            if self._gray is None:
+                with Image.open(io.BytesIO(self.data)) as img:
+                    self._gray = np.asarray(img.convert('L'))
+            if self._calibrate is not None:
+                calibrated = self._calibrate(self._gray)
+                if calibrated is not self._gray:
+                    (self.rawGray, self._gray) = (self._gray, calibrated)
+                self._calibrate = None
+            return self._gray
+
+    def save(self, fn):
+        """Write the encoded image to a file."""
+        with open(fn, 'wb') as f:
+            f.write(self.data)
+
+
+class frameBuffer(broadcaster):
+    """Holds the latest frame.  Writers put new frames, readers get the latest one or, as a
+    registered client, wait for the next one."""
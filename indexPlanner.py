@@ -0,0 +1,99 @@
+"""Picks the astrometry.net index files a solve-field profile can use
+
+solve-field loads every index file listed in the astrometry config, with a full 4100 and 4200 set
+installed that is many files built for fields far wider or narrower than the profile's.  Each
+index file is built from quads of one size range, and a field can only be solved with quads of
+10% to 100% of its width.  From the profile's field width (or arcsec per pixel) range the planner
+works out which index files can match and writes a config loading only those, tried most used
+first.  Which index files solved the profile's images is counted in the profile (and so saved in
+skyConfig.json), once there are enough of them only those and their neighbours are loaded, also
+for profiles without a scale range.  The astrometry engine loads the same pick of index files.
+"""
+import glob
+import math
+import os
+import re
+
+# index-4116.fits, index-4205-13.fits (one healpix of a split scale), ...
+indexPattern = re.compile(r'index-(\d\d)(\d\d)(-\d+)?\.fits')
+
+
+def quadRange(scale):
+    """Smallest and largest quad diameter in arcmin of the index files with this scale number."""
+    return 2 * math.sqrt(2)**scale, 2 * math.sqrt(2)**(scale + 1)
+
+
+def indexName(text):
+    """The index name, e.g. index-4116, in a file name or solve-field's 'solved with' line."""
+    match = indexPattern.search(text)
+    if match is None:
+        return None
+    return 'index-' + match.group(1) + match.group(2) + (match.group(3) or '')
+
+
+class indexPlanner():
+
+    def __init__(self, configDir, indexDirs=('/usr/share/astrometry', '/usr/local/astrometry/data'),
+                 minHits=10):
+        self.configDir = configDir
+        self.minHits = minHits
+        # scale number of each index file found
+        self.indexFiles = {}
+        for d in indexDirs:
+            for fn in sorted(glob.glob(os.path.join(d, 'index-*.fits'))):
+                match = indexPattern.search(os.path.basename(fn))
+                if match is not None:
+                    self.indexFiles[fn] = int(match.group(2))
+        self.written = {}  # config file: the index files written to it
+
+    def recordHit(self, profile, text):
+        """Count the index named in text as having solved an image of the profile."""
+        name = indexName(text)
+        if name is not None:
+            hits = profile.setdefault('usedIndexes', {})
+            hits[name] = hits.get(name, 0) + 1
+        return name
+
+    def scales(self, profile, scaleLow, scaleHigh, width):
+        """The index scale numbers which can solve images of the profile, None for all of them."""
+        scales = None
+        if scaleLow is not None:
+            # image width in arcmin, quads of 10% to 100% of it
+            low = scaleLow * width / 60 * .1
+            high = scaleHigh * width / 60 if scaleHigh is not None else math.inf
+            scales = {scale for scale in range(20) if quadRange(scale)[1] >= low and quadRange(scale)[0] <= high}
+        hits = profile.get('usedIndexes', {})
+        if sum(hits.values()) >= self.minHits:
+            hitScales = {int(indexPattern.search(name + '.fits').group(2)) for name in hits}
+            hitScales |= {scale + d for scale in hitScales for d in (-1, 1)}
+            scales = hitScales if scales is None else (scales & hitScales) or scales
+        return scales
+
+    def filesFor(self, profile, scaleLow, scaleHigh, width):
+        """The index files which can solve images of the profile, most used first, all of them if
+        none can be left out."""
+        scales = self.scales(profile, scaleLow, scaleHigh, width)
+        hits = profile.get('usedIndexes', {})
+        files = [fn for fn, scale in self.indexFiles.items() if scales is None or scale in scales]
+        if len(files) == 0:
+            files = list(self.indexFiles)
+        # solve-field tries the index files in the order they are listed
+        files.sort(key=lambda fn: (-hits.get(indexName(os.path.basename(fn)), 0), self.indexFiles[fn], fn))
+        return files
+
+    def configFor(self, profile, scaleLow, scaleHigh, width):
+        """Write the astrometry config for the profile, returns its file name or None to use the
+        default config (no index files found or nothing to leave out)."""
+        files = self.filesFor(profile, scaleLow, scaleHigh, width)
+        if len(files) == len(self.indexFiles):
+            return None
+        configFile = os.path.join(self.configDir, 'astrometry_%s.cfg' %
+                                  re.sub(r'[^\w-]', '_', profile.get('name', 'profile')))
+        if self.written.get(configFile) != files:
+            with open(configFile, 'w') as f:
+                f.write("# written by skysolve for the %s profile, %d of %d index files\n" %
+                        (profile.get('name'), len(files), len(self.indexFiles)))
+                for fn in files:
+                    f.write("index %s\n" % fn)
+            self.written[configFile] = files
+        return configFile
@@ -0,0 +1,169 @@
+"""Draws the solution overlay (the named stars and deep sky objects in the field) in process
+
+plot-constellations was started after every solve-field solution to draw cap-ngc.png, reading
+cap.wcs and its own catalogs, and tetra3 solutions had no overlay at all.  Here the bright star
+list (bstars) and, if NGC.csv (the OpenNGC catalog, semicolon separated) is next to this file, the
+NGC/IC objects are projected onto the image with one vectorized gnomonic (TAN) projection and drawn
+on a transparent image the size of the frame.  Solutions are reduced to the same tangent point,
+reference pixel and matrix whether they come from a FITS WCS (cap.wcs or the astrometry engine)
+or from tetra3's RA, Dec, Roll and FOV, and the drawn overlay is cached per solution so showing
+it again costs nothing.
+"""
+import collections
+import csv
+import io
+import math
+import os
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+
+import bstars
+
+
+def unitVectors(ra, dec):
+    """Unit vectors of the RA, Dec arrays (degrees)."""
+    ra, dec = np.radians(ra), np.radians(dec)
+    return np.stack((np.cos(ra) * np.cos(dec), np.sin(ra) * np.cos(dec), np.sin(dec)), axis=-1)
+
+
+def parseSexagesimal(text, hours):
+    """'HH:MM:SS.s' or '+DD:MM:SS' in degrees."""
+    sign = -1 if text.startswith('-') else 1
+    d, m, s = (float(v) for v in text.lstrip('+-').split(':'))
+    return sign * (d + m / 60 + s / 3600) * (15 if hours else 1)
+
+
+def loadNgc(fn, magLimit):
+    """Names and positions of the OpenNGC objects brighter than magLimit and all Messier objects."""
+    names, ra, dec = [], [], []
+    if not os.path.exists(fn):
+        return names, np.empty((0, 3))
+    with open(fn, newline='') as f:
+        for row in csv.DictReader(f, delimiter=';'):
+            if not row.get('RA') or not row.get('Dec') or row.get('Type') in ('Dup', 'NonEx'):
+                continue
+            messier = row.get('M', '')
+            try:
+                mag = float(row.get('V-Mag') or row.get('B-Mag') or 99)
+            except ValueError:
+                mag = 99
+            if not messier and mag > magLimit:
+                continue
+            names.append('M%d' % int(messier) if messier else row['Name'])
+            ra.append(parseSexagesimal(row['RA'], True))
+            dec.append(parseSexagesimal(row['Dec'], False))
+    print("overlay loaded %d NGC objects" % len(names), flush=True)
+    return names, unitVectors(np.array(ra), np.array(dec))
+
+
+def loadFont(size):
+    for name in ("DejaVuSans.ttf", "FreeMono.ttf"):
+        try:
+            return ImageFont.truetype(name, size)
+        except OSError:
+            pass
+    return ImageFont.load_default()
+
+
+class solutionOverlay():
+
+    def __init__(self, ngcFile=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'NGC.csv'),
+                 magLimit=6., labelMag=4.5, ngcMagLimit=11., cacheSize=8):
+        stars = [s for s in bstars.bstars if s[4] <= magLimit]
+        self.starMag = np.array([s[4] for s in stars])
+        self.starVectors = unitVectors(np.array([s[2] for s in stars]), np.array([s[3] for s in stars]))
+        self.starNames = [self.name(s) for s in stars]
+        self.labelMag = labelMag
+        self.ngcFile = ngcFile
+        self.ngcMagLimit = ngcMagLimit
+        self.ngcNames = None  # loaded by the first render
+        self.font = loadFont(15)
+        self.cache = collections.OrderedDict()
+        self.cacheSize = cacheSize
+        self.hits = 0
+
+    @staticmethod
+    def name(star):
+        """'Proper name (designation)', the designation or '' for the bstars entry."""
+        designation, proper = (v.decode('utf-8') if isinstance(v, bytes) else v for v in star[:2])
+        if proper and designation:
+            return "%s (%s)" % (proper, designation)
+        return proper or designation
+
+    def fromWcs(self, header, size=None):
+        """Overlay for a FITS TAN WCS, a header read from cap.wcs or the astrometry engine's WCS
+        dict.  size is the (height, width) of the image, by default IMAGEH and IMAGEW."""
+        if size is None:
+            size = (int(header['IMAGEH']), int(header['IMAGEW']))
+        cd = np.array([[header['CD1_1'], header['CD1_2']], [header['CD2_1'], header['CD2_2']]], dtype=float)
+        # FITS pixel 1 is centred at 1.0, the overlay's first pixel spans 0 to 1
+        refPixel = (float(header['CRPIX1']) - .5, float(header['CRPIX2']) - .5)
+        # the intermediate world coordinates are in degrees, the projection gives radians
+        matrix = np.linalg.inv(cd) * math.degrees(1)
+        return self.render(float(header['CRVAL1']), float(header['CRVAL2']), refPixel, matrix, size)
+
+    def fromTetra3(self, solution, size):
+        """Overlay for a tetra3 solution of an image of size (height, width)."""
+        height, width = size
+        scale = math.tan(math.radians(solution['FOV']) / 2) / (width / 2)
+        roll = math.radians(solution['Roll'])
+        c, s = math.cos(roll), math.sin(roll)
+        # tetra3's camera frame: x to the left and y up in the image, rolled from east and north
+        matrix = -np.array([[c, s], [-s, c]]) / scale
+        return self.render(solution['RA'], solution['Dec'], (width / 2, height / 2), matrix, size)
+
+    def project(self, vectors, ra, dec, refPixel, matrix):
+        """Pixel positions (N,2 x, y) of the unit vectors, NaN for those behind the tangent point."""
+        ra, dec = math.radians(ra), math.radians(dec)
+        boresight = np.array([math.cos(ra) * math.cos(dec), math.sin(ra) * math.cos(dec), math.sin(dec)])
+        east = np.array([-math.sin(ra), math.cos(ra), 0])
+        north = np.cross(boresight, east)
+        along = vectors @ boresight
+        along = np.where(along > .1, along, np.nan)  # at most ~84 degrees off axis
+        xi = (vectors @ east) / along
+        eta = (vectors @ north) / along
+        return np.stack((xi, eta), axis=-1) @ matrix.T + refPixel
+
+    def render(self, ra, dec, refPixel, matrix, size):
+        """The overlay as PNG bytes and the names of the named stars on it, brightest first."""
+        key = (round(ra, 4), round(dec, 4), tuple(np.round(refPixel, 1)),
+               tuple(np.round(matrix.ravel(), 2)), tuple(size))
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            self.hits += 1
+            return self.cache[key]
+        if self.ngcNames is None:
+            self.ngcNames, self.ngcVectors = loadNgc(self.ngcFile, self.ngcMagLimit)
+        height, width = size
+        overlay = Image.new('RGBA', (width, height), (0, 0, 0, 0))
+        draw = ImageDraw.Draw(overlay)
+
+        def visible(pixels):
+            with np.errstate(invalid='ignore'):
+                return np.flatnonzero((pixels[:, 0] >= 0) & (pixels[:, 0] < width) &
+                                      (pixels[:, 1] >= 0) & (pixels[:, 1] < height))
+
+        named = []
+        pixels = self.project(self.starVectors, ra, dec, refPixel, matrix)
+        inView = visible(pixels)
+        for i in inView[np.argsort(self.starMag[inView])]:
+            x, y = pixels[i]
+            r = 3 + 1.5 * (6 - self.starMag[i])
+            draw.ellipse((x - r, y - r, x + r, y + r), outline=(255, 64, 64, 255), width=2)
+            # bstars lists a few stars twice
+            if self.starNames[i] and self.starMag[i] <= self.labelMag and self.starNames[i] not in named:
+                draw.text((x + r + 2, y - 8), self.starNames[i], font=self.font, fill=(255, 255, 255, 255))
+                named.append(self.starNames[i])
+        if len(self.ngcNames):
+            pixels = self.project(self.ngcVectors, ra, dec, refPixel, matrix)
+            for i in visible(pixels):
+                x, y = pixels[i]
+                draw.rectangle((x - 6, y - 6, x + 6, y + 6), outline=(64, 255, 64, 255), width=2)
+                draw.text((x + 8, y - 8), self.ngcNames[i], font=self.font, fill=(64, 255, 64, 255))
+        png = io.BytesIO()
+        overlay.save(png, format='PNG')
+        self.cache[key] = (png.getvalue(), named)
+        if len(self.cache) > self.cacheSize:
+            self.cache.popitem(last=False)
+        return self.cache[key]
@@ -0,0 +1,71 @@
+"""Runs solve-field and plot-constellations without blocking on their output
+
+The output lines are read through a selector with a short timeout, so the run can be stopped in
+between lines: when the wall clock deadline passes or when any of the cancel events is set (the
+mode changed, the other solver of the hybrid solver was first, ...).  The command runs in its own
+process group, when it ends or is stopped the whole group is killed and reaped, so no
+astrometry-engine or other children are left behind.
+"""
+import os
+import selectors
+import signal
+import subprocess
+import time
+
+
+class processRunner():
+
+    def __init__(self, cmd, deadline=None, cancel=(), poll=.1):
+        """deadline is a time.time() value, cancel a list of threading.Events."""
+        self.cmd = cmd
+        self.deadline = deadline
+        self.cancel = [event for event in cancel if event is not None]
+        self.poll = poll
+        # why the run ended: 'done', 'deadline' or 'cancelled'
+        self.reason = None
+        self.returncode = None
+
+    def stopped(self):
+        if any(event.is_set() for event in self.cancel):
+            return 'cancelled'
+        if self.deadline is not None and time.time() > self.deadline:
+            return 'deadline'
+        return None
+
+    def lines(self):
+        """Start the command and yield its output lines until it ends or is stopped."""
+        self.reason = self.stopped()
+        if self.reason is not None:
+            return
+        p = subprocess.Popen(self.cmd, stdout=subprocess.PIPE,
+                             start_new_session=True)
+        selector = selectors.DefaultSelector()
+        selector.register(p.stdout, selectors.EVENT_READ)
+        pending = b''
+        try:
+            while True:
+                self.reason = self.stopped()
+                if self.reason is not None:
+                    break
+                if not selector.select(self.poll):
+                    continue
+                data = os.read(p.stdout.fileno(), 65536)
+                if not data:  # end of output, the command is done
+                    if pending:
+                        yield pending.decode(encoding='UTF-8', errors='replace')
+                    self.reason = 'done'
+                    break
+                pending += data
+                *complete, pending = pending.split(b'\n')
+                for line in complete:
+                    yield line.decode(encoding='UTF-8', errors='replace') + '\n'
+        finally:
+            selector.close()
+            try:
+                os.killpg(p.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+            self.returncode = p.wait()
+            p.stdout.close()
+            if self.reason is None:  # the caller stopped reading
+                self.reason = 'cancelled'
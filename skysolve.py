@@ -6,7 +6,14 @@ import time
 from flask.wrappers import Request
 import pprint
 
-from camera_pi2 import skyCamera
+from camera_fake import fakeCamera
+try:
+    from camera_pi2 import skyCamera
+except ImportError as e:
+    print("picamera2 not available, images will be replayed from files instead", e, flush=True)
+    skyCamera = fakeCamera
+from frameBuffer import skyFrame, frameBuffer
+from broadcaster import broadcaster
 
 from datetime import datetime, timedelta
 import threading
@@ -23,9 +30,16 @@ import io
 import getpass
 import copy
 import sys
-from tetra3 import Tetra3
+from solverProcess import solverProcess
+from solvePipeline import solvePipeline
+from astrometryEngine import astrometryEngine
+from indexPlanner import indexPlanner
+from processRunner import processRunner
+from overlay import solutionOverlay
+from darkCalibration import darkCalibration
 import RPi.GPIO as GPIO  # Import Raspberry Pi GPIO library
 import Quality
+import fitsio
 
 import glob
 
@@ -43,12 +57,24 @@ try:
 except BaseException as e:
     print("did not start encoder", e, flush=True)
 
-usedIndexes = {}
 
-# Create instance and load default_database (built with max_fov=12 and the rest as default)
+# Start the tetra3 solver process and load default_database (built with max_fov=12 and the rest
+# as default), together with any databases built for other fields of view saved as
+# tetra3_fov<max_fov>. tetra3 picks the database to use for each solve from the profile's field
+# estimate.
+# When live solving, a second process extracts the stars of the next frame while t3 matches. It
+# loads no databases, only as many stars as t3 verifies with are asked of it.
 t3 = None
 if t3 == None:
-    t3 = Tetra3('default_database')
+    # the .npz files and memory mapped directories, a name like tetra3_fov7.5 keeps its dot
+    t3Databases = ['default_database'] + sorted(set(
+        name[:-len('.npz')] if name.endswith('.npz') else name for name in
+        (os.path.basename(fn) for fn in
+         glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tetra3_fov*')))))
+    t3 = solverProcess(t3Databases)
+    t3Extractor = solverProcess(None)
+    # tetra3's default if the solver process failed to load the databases
+    verificationStars = t3.verification_stars or 20
 
 
 class Mode(Enum):
@@ -64,6 +90,7 @@ class Mode(Enum):
 class LimitedLengthList(list):
     def __init__(self, seq=(), length=math.inf):
         self.length = length
+        self.condition = threading.Condition()
 
         if len(seq) > length:
             raise ValueError("Argument seq has too many items")
@@ -71,13 +98,29 @@ class LimitedLengthList(list):
         super(LimitedLengthList, self).__init__(seq)
 
     def append(self, item):
-        if len(self) < self.length:
-            super(LimitedLengthList, self).append(item)
+        with self.condition:
+            if len(self) < self.length:
+                super(LimitedLengthList, self).append(item)
 
-        else:
-            super(LimitedLengthList, self).__init__(
-                super(LimitedLengthList, self)[self.length/2:])
-            super(LimitedLengthList, self).append(item)
+            else:
+                super(LimitedLengthList, self).__init__(
+                    super(LimitedLengthList, self)[self.length//2:])
+                super(LimitedLengthList, self).append(item)
+            self.condition.notify_all()
+
+    def dropBefore(self, item):
+        """Remove the items before item (that object, not an equal one) if it is still there."""
+        with self.condition:
+            for i, line in enumerate(self):
+                if line is item:
+                    del self[:i]
+                    break
+
+    def waitPop(self):
+        """Remove and return the first item, waiting for one to be appended if empty."""
+        with self.condition:
+            self.condition.wait_for(lambda: len(self) > 0)
+            return self.pop(0)
 
 
 app = 30
@@ -90,12 +133,35 @@ ra = 0
 dec = 0
 solveStatus = ''
 computedPPa = ''
-frameStack = []  # holds images and the time it was taken
-frameStackLock = threading.Lock()
+# holds the latest image and the time it was taken, shared by the solver, gen() and focus
+frames = frameBuffer()
 
 
 focusStd = ''
 state = Mode.ALIGN
+# notified on every mode change so an idle solveThread wakes up straight away
+stateChanged = threading.Condition()
+# set (and replaced by a new one) when the mode changes, a running solve-field is then killed
+modeChanged = threading.Event()
+
+
+def setState(newState, restart=False):
+    # restart signals a mode change even when the state stays the same, a new /solveThis stops
+    # the solve of the previous image
+    global state, modeChanged
+    with stateChanged:
+        if newState is not state or restart:
+            modeChanged.set()
+            modeChanged = threading.Event()
+        state = newState
+        stateChanged.notify_all()
+
+
+def solverIdle():
+    # nothing to do until the mode changes, the live modes need frames from the camera
+    if state is Mode.PAUSED or state is Mode.PLAYBACK:
+        return True
+    return cameraNotPresent and state is not Mode.SOLVETHIS
 
 testNdx = 0
 testFiles = []
@@ -142,10 +208,19 @@ skyConfig = {'camera': {'shutter': 1, 'ISO':800, 'frame': '800x600','format': 'j
 """
 
 
+# routes and the solving threads save the config, one at a time
+configLock = threading.RLock()
+
+
 def saveConfig():
-    with open('skyConfig.json', 'w') as f:
+    global unsavedIndexHits
+    # written next to it and renamed over it, so skyConfig.json is never left half written
+    with configLock:
+        with open('skyConfig.json.tmp', 'w') as f:
 
-        json.dump(skyConfig, f, indent=4)
+            json.dump(skyConfig, f, indent=4)
+        os.replace('skyConfig.json.tmp', 'skyConfig.json')
+        unsavedIndexHits = 0
 
 
 # saveConfig()
@@ -158,7 +233,16 @@ print(json.dumps(skyConfig['solverProfiles']['25FL'], indent=4))
 print(json.dumps(skyConfig['observing'], indent=4))
 print(json.dumps(skyConfig['camera'], indent=4), flush=True)
 
-imageName = 'cap.'+skyConfig['camera']['format']
+
+
+def imageExt():
+    # yuv frames are captured as arrays and saved as jpeg
+    if skyConfig['camera']['format'] == 'yuv':
+        return 'jpeg'
+    return skyConfig['camera']['format']
+
+
+imageName = 'cap.'+imageExt()
 
 #print (skyConfig)
 skyCam = None
@@ -166,6 +250,15 @@ skyStatusText = ''
 verboseSolveText = ''
 
 
+darks = darkCalibration(os.path.join(solve_path, 'darks'))
+
+
+# the dark calibration for the camera's current shutter, ISO and resolution
+def darkKey():
+    iso, shutter, resolution = skyCam.status()
+    return darks.key(shutter, iso, resolution)
+
+
 def delayedStatus(delay, status):
     global skyStatusText
     time.sleep(delay)
@@ -177,14 +270,22 @@ def setupCamera():
     if not skyCam:
         print('creating cam')
         try:
-            skyCam = skyCamera(delayedStatus, shutter=int(
-                1000000 * float(skyConfig['camera']['shutter'])),
-                format=skyConfig['camera']['format'],
-                resolution=skyConfig['camera']['frame'])
+            # replay the images in camera replayDir (default the demo images) instead of using the camera
+            if skyConfig['camera'].get('replayDir') or skyCamera is fakeCamera:
+                skyCam = fakeCamera(delayedStatus, shutter=int(
+                    1000000 * float(skyConfig['camera']['shutter'])),
+                    format=skyConfig['camera']['format'],
+                    resolution=skyConfig['camera']['frame'],
+                    replayDir=skyConfig['camera'].get('replayDir') or demo_path)
+            else:
+                skyCam = skyCamera(delayedStatus, shutter=int(
+                    1000000 * float(skyConfig['camera']['shutter'])),
+                    format=skyConfig['camera']['format'],
+                    resolution=skyConfig['camera']['frame'])
             cameraNotPresent = False
             if skyConfig['solver']['startupSolveing']:
                 print("startup in solving")
-                state = Mode.SOLVING
+                setState(Mode.SOLVING)
             startFrame = skyCam.get_frame()
             if startFrame is None:
                 print("camera did not seem to start")
@@ -205,6 +306,8 @@ lastsolveTime = datetime.now()
 justStarted = True
 camera_Died = False
 solveCompleted = False
+# set by measureTransparency while live solving, the next frame is written to the cap file
+measureLiveFrame = False
 
 
 def shutThread():
@@ -227,7 +330,7 @@ def switchWatcher():
                 print("shutting down")
                 skyStatusText = "shutting down."
                 th = threading.Thread(target=shutThread)
-                state = Mode.PAUSED
+                setState(Mode.PAUSED)
                 th.start()
                 break
 
@@ -236,26 +339,24 @@ switcherWatcherThread.start()
 #
 #  this is responsible for getting images from the camera even in align mod
 def solveThread():
-    global skyStatusText, focusStd, solveCurrent, state, skyCam, frameStack, frameStackLock, testNdx, camera_Died,\
-        solveLog, solveCompleted
-
-    # save the image to be solved in the file system and on the stack for the gen() routine to give to the client browser
-    def saveImage(frame):
-        global frameStack, frameStackLock
+    global skyStatusText, focusStd, solveCurrent, state, skyCam, frames, testNdx, camera_Died,\
+        solveLog, solveCompleted, measureLiveFrame
+
+    # put the image to be solved in the frame buffer for the solver, focus and the gen() routine to give to the client browser
+    def saveImage(frame, name=None):
+        # camera frames get the dark calibration of the camera's settings, if there is one
+        calibrate = darks.calibrator(darkKey()) if name is None else None
+        # yuv frames are luminance arrays, they are only jpeg encoded if the browser or a file needs them
+        if isinstance(frame, np.ndarray):
+            image = skyFrame(gray=frame, name=name, calibrate=calibrate)
+        else:
+            image = skyFrame(frame, name=name, calibrate=calibrate)
+        frames.put(image)
+        return image
 
-        with open(os.path.join(solve_path, imageName), "wb") as f:
-            try:
-                f.write(frame)
-                frameStackLock.acquire()
-                # save to stack so gen can send it to the client browser
-                frameStack.append(
-                    (os.path.join(solve_path, imageName), datetime.now()))
-                frameStackLock.release()
-                return True
-            except Exception as e:
-                print(e)
-                solveLog.append(str(e) + '\n')
-                return False
+    # solve-field reads the image from the file system
+    def writeImage(image):
+        image.save(os.path.join(solve_path, imageName))
 
     def makeDeadImage(text):
         img = Image.new('RGB', (600, 200), color=(0, 0, 0))
@@ -273,19 +374,29 @@ def solveThread():
         lastsolveTime = datetime.now()
 
 
-        if state is Mode.PAUSED or state is Mode.PLAYBACK:
+        if solverIdle():
+            # sleep instead of spinning until /Align, /Solve, /solveThis ... change the mode
+            with stateChanged:
+                stateChanged.wait_for(lambda: not solverIdle())
             continue
 
         # solve this one selected image then switch state to playback
         if state is Mode.SOLVETHIS:
+            # set if another image is to be solved or the mode changes meanwhile
+            token = modeChanged
 
             print('solving skyStatus', skyStatusText, solveThisImage)
-            copyfile(solveThisImage, os.path.join(solve_path, imageName))
+            image = skyFrame.fromFile(solveThisImage)
+            frames.put(image)
             skyStatusText = 'Solving'
             print("solving", solveThisImage)
-            if skyConfig['solverProfiles'][skyConfig['solver']['currentProfile']]['solver_type'] == 'solverTetra3':
+            if skyConfig['solverProfiles'][skyConfig['solver']['currentProfile']]['solver_type'] == 'solverHybrid':
+                hybridSolve(image)
+            elif skyConfig['solverProfiles'][skyConfig['solver']['currentProfile']]['solver_type'] == 'solverTetra3':
                 verboseSolveText = ""
-                s = tetraSolve(os.path.join(solve_path, imageName))
+                # tetra3 solves from memory, the cap file is for the sky quality measurement
+                writeImage(image)
+                s = tetraSolve(image)
                 if s['RA'] != None:
                     ra = s['RA']
                     dec = s['Dec']
@@ -297,20 +408,22 @@ def solveThread():
                 else:
                     skyStatusText = str(s)
             else:
-
-                if not solve(os.path.join(solve_path, imageName)) and skyConfig['solverProfiles'][skyConfig['solver']['currentProfile']]['searchRadius'] > 0:
+                writeImage(image)
+                if not solve(os.path.join(solve_path, imageName)) and not token.is_set() and \
+                        skyConfig['solverProfiles'][skyConfig['solver']['currentProfile']]['searchRadius'] > 0:
                     skyStatusText = 'Failed. Retrying with no position hint.'
                     # try again but this time since the previous failed it will not use a starting guess possition
                     solve(os.path.join(solve_path, imageName))
 
-            state = Mode.PLAYBACK
+            # unless a new image came or the mode changed, which the next pass picks up
+            with stateChanged:
+                if not token.is_set():
+                    setState(Mode.PLAYBACK)
             solveCompleted = True
             continue
 
         else:  # live solving loop path
             #print("getting image in solve", flush=True)
-            if cameraNotPresent:
-                continue
             try:
                 frame = skyCam.get_frame()
             except Exception as e:
@@ -333,10 +446,11 @@ def solveThread():
 
             lastpictureTime = datetime.now()
         cameraTry = 0
+        frameName = None
         # if solving history one after the other in auto playback
         if (state is Mode.AUTOPLAYBACK):
             if testNdx == len(testFiles):
-                state = Mode.PLAYBACK
+                setState(Mode.PLAYBACK)
                 skyStatusText = "Complete."
                 continue
             fn = testFiles[testNdx]
@@ -348,37 +462,50 @@ def solveThread():
 
             with open(fn, 'rb') as infile:
                 frame = infile.read()
+            frameName = fn
 
-        saveImage(frame)
+        image = saveImage(frame, frameName)
+        # a sky quality measurement reads this frame and solve-field's stars of it from the files
+        measuring = measureLiveFrame and state is Mode.SOLVING
         #debug to fake camera image with a real star image
         #copyfile("static/history/11_01_22_23_47_15.jpeg", os.path.join(solve_path, imageName))
         if state is Mode.SOLVING or state is Mode.AUTOPLAYBACK:
-            if skyConfig['solverProfiles'][skyConfig['solver']['currentProfile']]['solver_type'] == 'solverTetra3':
-                s = tetraSolve(os.path.join(solve_path, imageName))
+            if skyConfig['solverProfiles'][skyConfig['solver']['currentProfile']]['solver_type'] == 'solverHybrid':
+                hybridSolve(image, live=state is Mode.SOLVING and not measuring)
+            elif skyConfig['solverProfiles'][skyConfig['solver']['currentProfile']]['solver_type'] == 'solverTetra3':
+                if state is Mode.SOLVING:
+                    if measuring:
+                        writeImage(image)
+                        measureLiveFrame = False
+                    # stars are extracted and matched by the pipeline while this loop gets the next frame
+                    livePipeline.submit(image, fov_estimate=tetraFov())
+                    continue
+                s = tetraSolve(image)
                 # print(str(s))
-                if s['RA'] != None:
-                    ra = s['RA']
-                    dec = s['Dec']
-                    fov = s['FOV']
-                    dur = (s['T_solve']+s['T_extract'])/1000
-                    result = "RA:%6.3lf    Dec:%6.3lf     FOV:%6.3lf     %6.3lf secs" % (
-                        ra/15, dec,  fov, dur)
-                    skyStatusText = result
-                else:
-                    skyStatusText = str(s)
+                skyStatusText = tetraStatus(s)
             else:
                 if state is Mode.SOLVING:
                     skyStatusText = ""
-                f = solve(os.path.join(solve_path, imageName))
+                    # live frames go to the astrometry engine if it is installed, else solve-field,
+                    # which also writes the cap.corr star list a sky quality measurement needs
+                    if not measuring and astrometrySolve(image) is not None:
+                        solveCompleted = True
+                        continue
+                if state is not Mode.SOLVING or measuring:
+                    writeImage(image)
+                # live frames are solved from the stars tetra3 finds, playback with the solve-field plots
+                f = solve(os.path.join(solve_path, imageName),
+                          image=image if state is Mode.SOLVING else None)
                 if f == False:
-                    state = Mode.PLAYBACK
+                    setState(Mode.PLAYBACK)
+            if measuring:
+                measureLiveFrame = False
             solveCompleted = True
             continue
 
         # else measaure contrast for focus bar
         try:
-            img = Image.open(os.path.join(solve_path, imageName)).convert("L")
-            imgarr = np.array(img)
+            imgarr = image.gray()
             avg = imgarr.mean()
             imax = imgarr.max()
             if avg == 0:
@@ -401,7 +528,47 @@ if skyConfig['solver']['startupSolveing']:
 
 
 
-def solve(fn, parms=[]):
+# number of brightest stars written to the xylist for solve-field
+xylistStars = 100
+
+
+def writeXylist(image):
+    # find the stars with tetra3's extractor and write them as a FITS xylist, brightest first, so
+    # solve-field doesn't have to run its own source extraction
+    img = image.gray()
+    centroids = t3Extractor.get_centroids(img, max_returned=xylistStars, track_background=True,
+                                         parallel_tiles=os.cpu_count())
+    xylist = np.zeros(len(centroids), dtype=[('X', 'f8'), ('Y', 'f8')])
+    # tetra3 measures from the corner of the image, FITS from the centre of the first pixel
+    xylist['X'] = centroids[:, 1] + .5
+    xylist['Y'] = centroids[:, 0] + .5
+    fn = os.path.join(solve_path, 'cap.xyls')
+    fitsio.write(fn, xylist, clobber=True)
+    return fn, img.shape
+
+
+# solve-field gets this many secs on top of the profile's cpu limit before it is killed
+solveFieldGrace = 10
+
+skyOverlay = solutionOverlay()
+lastOverlay = None
+
+
+# write the overlay to cap-ngc.png for the solution display, unless it is the one already there.
+# Returns the named stars as the found stars text and their constellations
+def showOverlay(overlay):
+    global lastOverlay
+    png, names = overlay
+    if png is not lastOverlay:
+        with open(os.path.join(solve_path, 'cap-ngc.png'), 'wb') as f:
+            f.write(png)
+        lastOverlay = png
+    # 'Rigel (βOri)', '29Ori', ... end with the constellation
+    constellations = list(dict.fromkeys(name.rstrip(')')[-3:] for name in names))
+    return ', '.join(names), constellations
+
+
+def solve(fn, parms=[], image=None, cancel=None):
     print("solving", flush=True)
 
     global app, solving, maxTime, searchRaius, solveLog, ra, dec, searchEnable, solveStatus,\
@@ -409,6 +576,8 @@ def solve(fn, parms=[]):
     startTime = datetime.now()
     solving = True
     solved = ''
+    # set if the mode changes while solving
+    modeToken = modeChanged
     profile = skyConfig['solverProfiles'][skyConfig['solver']
                                           ['currentProfile']]
     fieldwidthParm = ''
@@ -443,6 +612,27 @@ def solve(fn, parms=[]):
     #print('show stars', profile['showStars'])
     if not profile['showStars']:
         parms = parms + ['-p']
+    # the xylist has no image to plot the stars on, so not when showing them
+    extractTime = None
+    if image is not None and not profile['showStars']:
+        t0 = time.time()
+        fn, (height, width) = writeXylist(image)
+        extractTime = time.time() - t0
+        parms = parms + ['--width', str(width), '--height', str(height),
+                         '--x-column', 'X', '--y-column', 'Y']
+    elif image is not None:
+        # live frames are only written when solve-field reads the image itself
+        image.save(fn)
+    # load only the index files which can solve images of this profile
+    if image is not None:
+        width = image.gray().shape[1]
+    else:
+        with Image.open(fn) as img:
+            width = img.size[0]
+    scaleLow, scaleHigh = profileScale(profile, width)
+    indexConfig = astrometryIndexes.configFor(profile, scaleLow, scaleHigh, width)
+    if indexConfig and '--config' not in parms:
+        parms = parms + ['--config', indexConfig]
     parms = parms + ["--uniformize", "0", "--no-remove-lines", "--new-fits", "none",  "--pnm", "none", "--rdls",
                      "none"]
     cmd = ["solve-field", fn, "--depth", str(profile['solveDepth']), "--sigma", str(profile['solveSigma']),
@@ -451,70 +641,80 @@ def solve(fn, parms=[]):
     #print("\n\nsolving ", cmd)
     if skyConfig['observing']['verbose']:
         solveLog.append(' '.join(cmd) + '\n')
-    p = subprocess.Popen(cmd, stdout=subprocess.PIPE)
-    solveLog.clear()
+    # solve-field is stopped at the deadline, when the mode changes or the solve is cancelled
+    run = processRunner(cmd, deadline=time.time() + float(profile['maxTime']) + solveFieldGrace,
+                        cancel=[cancel, modeToken])
     ppa = ''
     starNames = {}
     duration = None
     radec = ''
-    ra = 0
-    dec = 0
-    solveLog.append("solving:\n")
+    # the log before this run is dropped and the position hint reset only once the run is done,
+    # a cancelled run leaves them, and the status if nothing else changed it, as they were
+    runStart = "solving %s:\n" % time.strftime('%H:%M:%S')
+    solveLog.append(runStart)
+    previousStatus = skyStatusText
     skyStatusText = skyStatusText + " solving"
     lastmessage = ''
-    while not p.poll():
-        stdoutdata = p.stdout.readline().decode(encoding='UTF-8')
-        if stdoutdata:
-            if stdoutdata == lastmessage:
-                continue
-            lastmessage = stdoutdata
-            if 'simplexy: found' in stdoutdata:
-                skyStatusText = stdoutdata
-                print("stdoutdata", stdoutdata)
-            elif stdoutdata.startswith('Field center: (RA,Dec) = ('):
-                solved = stdoutdata
-                fields = solved.split()[-3:-1]
-                #print ('f',fields)
-                ra = fields[0][1:-1]
-                dec = fields[1][0:-1]
-                ra = float(fields[0][1:-1])
-                dec = float(fields[1][0:-1])
-                radec = "%s %6.6lf %6.6lf \n" % (
-                    time.strftime('%H:%M:%S'), ra, dec)
-                file1 = open(os.path.join(
-                    solve_path, "radec.txt"), "w")  # write mode
-                file1.write(radec)
-                file1.close()
-                stopTime = datetime.now()
-                duration = stopTime - startTime
-                #print ('duration', duration)
-                skyStatusText = skyStatusText + " solved "+str(duration)+'secs'
-            if stdoutdata and skyConfig['observing']['verbose']:
+    for stdoutdata in run.lines():
+        if stdoutdata == lastmessage:
+            continue
+        lastmessage = stdoutdata
+        if 'simplexy: found' in stdoutdata:
+            skyStatusText = stdoutdata
+            print("stdoutdata", stdoutdata)
+        elif stdoutdata.startswith('Field center: (RA,Dec) = ('):
+            solved = stdoutdata
+            fields = solved.split()[-3:-1]
+            #print ('f',fields)
+            ra = fields[0][1:-1]
+            dec = fields[1][0:-1]
+            ra = float(fields[0][1:-1])
+            dec = float(fields[1][0:-1])
+            radec = "%s %6.6lf %6.6lf \n" % (
+                time.strftime('%H:%M:%S'), ra, dec)
+            file1 = open(os.path.join(
+                solve_path, "radec.txt"), "w")  # write mode
+            file1.write(radec)
+            file1.close()
+            stopTime = datetime.now()
+            duration = stopTime - startTime
+            #print ('duration', duration)
+            skyStatusText = skyStatusText + " solved "+str(duration)+'secs'
+        if stdoutdata.startswith("Field 1: solved with"):
+            # the index hits are saved with the profile, the index planner uses them
+            ndx = recordIndexHit(profile, stdoutdata)
+        if stdoutdata and skyConfig['observing']['verbose']:
+            solveLog.append(stdoutdata)
+            print("stdout", str(stdoutdata))
+            skyStatusText = skyStatusText + '.'
+            if stdoutdata.startswith("Field 1: solved with"):
+                print("index", ndx, stdoutdata, flush=True)
+                pp = pprint.pformat(profile['usedIndexes'])
+                print("Used indexes", pp, flush=True)
+                solveLog.append('used indexes ' + pp + '\n')
+
+            elif stdoutdata.startswith('Field size'):
+                print("Field size", stdoutdata, flush=True)
                 solveLog.append(stdoutdata)
-                print("stdout", str(stdoutdata))
-                skyStatusText = skyStatusText + '.'
-                if stdoutdata.startswith("Field 1: solved with"):
-                    ndx = stdoutdata.split("index-")[-1].strip()
-                    print("index", ndx, stdoutdata, flush=True)
-                    usedIndexes[ndx] = usedIndexes.get(ndx, 0)+1
-                    pp = pprint.pformat(usedIndexes)
-                    print("Used indexes", pp, flush=True)
-                    solveLog.append('used indexes ' + pp + '\n')
-
-                elif stdoutdata.startswith('Field size'):
-                    print("Field size", stdoutdata, flush=True)
-                    solveLog.append(stdoutdata)
-                    solveStatus += (". " + stdoutdata.split(":")[1].rstrip())
-                elif stdoutdata.find('pixel scale') > 0:
-                    computedPPa = stdoutdata.split("scale ")[1].rstrip()
-                elif 'The star' in stdoutdata:
-                    stdoutdata = stdoutdata.replace(')', '')
-                    con = stdoutdata[-4:-1]
-                    if con not in starNames:
-                        starNames[con] = 1
-
-        else:
-            break
+                solveStatus += (". " + stdoutdata.split(":")[1].rstrip())
+            elif stdoutdata.find('pixel scale') > 0:
+                computedPPa = stdoutdata.split("scale ")[1].rstrip()
+            elif 'The star' in stdoutdata:
+                stdoutdata = stdoutdata.replace(')', '')
+                con = stdoutdata[-4:-1]
+                if con not in starNames:
+                    starNames[con] = 1
+
+    if run.reason == 'cancelled':
+        # the mode changed or the other solver was first, leave the status and position alone
+        solveLog.append("solve-field cancelled\n")
+        if skyStatusText.startswith(previousStatus + " solving"):
+            skyStatusText = previousStatus
+        solving = False
+        return ''
+    solveLog.dropBefore(runStart)
+    if run.reason == 'deadline':
+        solveLog.append("solve-field stopped at the %d secs deadline\n" % (float(profile['maxTime']) + solveFieldGrace))
 
     solveStatus += ". scale " + ppa
 
@@ -525,27 +725,10 @@ def solve(fn, parms=[]):
         file1 = open(os.path.join(solve_path, "radec.txt"), "w")  # write mode
         file1.write(radec)
         file1.close()
-        cmdPlot = ['/usr/bin/plot-constellations', '-v', '-w', os.path.join(solve_path, 'cap.wcs'),
-                   '-B', '-C', '-N', '-o', os.path.join(solve_path, 'cap-ngc.png')]
-        p2 = subprocess.Popen(cmdPlot, stdout=subprocess.PIPE)
-        ndx = 0
-        stars = []
-        while not p2.poll():
-            if ndx > 1000:
-                break
-            ndx += 1
-            stdoutdata = p2.stdout.readline().decode(encoding='UTF-8')
-            if stdoutdata:
-                stars.append(stdoutdata)
-                print(stdoutdata)
-
-                if 'The star' in stdoutdata:
-                    stdoutdata = stdoutdata.replace(')', '')
-                    con = stdoutdata[-4:-1]
-                    if con not in starNames:
-                        starNames[con] = 1
-        foundStars = ', '.join(stars).replace("\n", "")
-        foundStars = foundStars.replace("The star", "")
+        foundStars, found = showOverlay(skyOverlay.fromWcs(
+            fitsio.read_header(os.path.join(solve_path, 'cap.wcs'))))
+        for con in found:
+            starNames[con] = 1
         #solveLog.append(foundStars + "\n")
         constellations = ', '.join(starNames.keys())
         # copy the index over the ngc file so stars will display with the index triangle
@@ -581,9 +764,13 @@ def solve(fn, parms=[]):
             if state is Mode.SOLVING and saveimage:
                 lastObs = radec
                 fn = datetime.now().strftime("%m_%d_%y_%H_%M_%S.") + \
-                    skyConfig['camera']['format']
-                copyfile(os.path.join(solve_path, imageName),
-                         os.path.join(solve_path, 'history', fn))
+                    imageExt()
+                if image is not None:
+                    # the live frame may not have been written to the cap file
+                    image.save(os.path.join(solve_path, 'history', fn))
+                else:
+                    copyfile(os.path.join(solve_path, imageName),
+                             os.path.join(solve_path, 'history', fn))
 
         if skyConfig['observing']['showSolution']:
             triggerSolutionDisplay = True
@@ -595,21 +782,116 @@ def solve(fn, parms=[]):
         skyStatusText = skyStatusText + " Failed"
         ra = 0
         solveLog.append("Failed\n")
+    if extractTime is None:
+        solveLog.append("solve-field with its own extraction %.2f secs\n" %
+                        (datetime.now() - startTime).total_seconds())
+    else:
+        solveLog.append("tetra3 extraction %.3f secs, solve-field on the xylist %.2f secs\n" %
+                        (extractTime, (datetime.now() - startTime).total_seconds() - extractTime))
     solving = False
     return solved
 
 
-def tetraSolve(imageName):
-    global skyStatusText, solveLog, t3
+astroEngine = astrometryEngine()
+astrometryIndexes = indexPlanner(solve_path)
+# the index hits are counted in the profiles in memory, skyConfig.json is saved with them every
+# indexHitsSaveEvery hits rather than on every solved frame (and by any other save, such as a
+# profile change)
+indexHitsSaveEvery = 10
+unsavedIndexHits = 0
 
-    solveLog.append("solving " + imageName + '\n')
-    img = Image.open(os.path.join(solve_path, imageName))
-    #print('solving', imageName)
+
+def recordIndexHit(profile, text):
+    global unsavedIndexHits
+    with configLock:
+        name = astrometryIndexes.recordHit(profile, text)
+        unsavedIndexHits += 1
+        if unsavedIndexHits >= indexHitsSaveEvery:
+            saveConfig()
+    return name
+
+
+# the profile's scale range in arcsec per pixel for an image width pixels wide
+def profileScale(profile, width):
+    if profile['FieldWidthMode'] == 'FieldWidthModeaPP':
+        low, high, factor = profile['aPPLoValue'], profile['aPPHiValue'], 1
+    elif profile['FieldWidthMode'] == 'FieldWidthModeField':
+        low, high, factor = profile['fieldLoValue'], profile['fieldHiValue'], 3600 / width
+    else:
+        return None, None
+    low, high = str(low).strip(), str(high).strip()
+    return (float(low) * factor if low else None), (float(high) * factor if high else None)
+
+
+def astrometrySolve(image):
+    global ra, dec, skyStatusText, solveLog, verboseSolveText
+    # solve with the stars found by tetra3 in the already running astrometry engine, None if the
+    # engine isn't available or failed
+    if not astroEngine.available:
+        return None
     profile = skyConfig['solverProfiles'][skyConfig['solver']
                                           ['currentProfile']]
+    img = image.gray()
+    scaleLow, scaleHigh = profileScale(profile, img.shape[1])
+    centroids = t3Extractor.get_centroids(img, max_returned=int(profile['solveDepth']), track_background=True,
+                                         parallel_tiles=os.cpu_count())
+    hint = {}
+    if profile['searchRadius'] > 0 and ra != 0:
+        hint = {'ra': ra, 'dec': dec, 'radius': profile['searchRadius']}
+    # the engine loads only the index files for the profile's scale, again when the profile changes
+    indexFiles = astrometryIndexes.filesFor(profile, scaleLow, scaleHigh, img.shape[1])
+    s = astroEngine.solve(centroids, img.shape, scaleLow, scaleHigh, indexFiles=indexFiles,
+                          timeout=float(profile['maxTime']) + solveFieldGrace, **hint)
+    if s is None:
+        # the engine's worker failed, solve-field solves this frame
+        return None
+    if s['RA'] is None:
+        ra = 0
+        skyStatusText = "Failed %d stars %.1f secs" % (len(centroids), s['T_solve']/1000)
+        solveLog.append("Failed\n")
+        return s
+    ra = s['RA']
+    dec = s['Dec']
+    radec = "%s %6.6lf %6.6lf \n" % (time.strftime('%H:%M:%S'), ra, dec)
+    file1 = open(os.path.join(solve_path, "radec.txt"), "w")  # write mode
+    file1.write(radec)
+    file1.close()
+    recordIndexHit(profile, s['Index'])
+    solveLog.append(str({k: v for k, v in s.items() if k != 'WCS'}) + '\n')
+    skyStatusText = "RA:%6.3lf    Dec:%6.3lf     FOV:%6.3lf     %6.3lf secs" % (
+        ra/15, dec,  s['FOV'], s['T_solve']/1000)
+    if state is not Mode.SOLVING or skyConfig['observing']['verbose']:
+        verboseSolveText, _ = showOverlay(skyOverlay.fromWcs(s['WCS'], img.shape))
+    return s
+
+
+def tetraFov():
+    profile = skyConfig['solverProfiles'][skyConfig['solver']
+                                          ['currentProfile']]
+    return float(profile['fieldLoValue'])
+
+
+def tetraStatus(s):
+    if s['RA'] != None:
+        dur = (s['T_solve']+s['T_extract'])/1000
+        return "RA:%6.3lf    Dec:%6.3lf     FOV:%6.3lf     %6.3lf secs" % (
+            s['RA']/15, s['Dec'],  s['FOV'], dur)
+    return str(s)
+
+
+def tetraSolve(image):
+    global solveLog, t3
+
+    solveLog.append("solving " + (image.name or imageName) + '\n')
+    img = image.gray()
+    #print('solving', imageName)
+    solved = t3.solve_from_image(img, fov_estimate=tetraFov())
+    darks.recordSolve(solved, image.calibrated)
+    return tetraSolved(solved, img.shape)
+
 
-    solved = t3.solve_from_image(
-        img, fov_estimate=float(profile['fieldLoValue']))
+def tetraSolved(solved, size):
+    global skyStatusText, solveLog, verboseSolveText
 
     # print(str(solved),profile['fieldLoValue'],flush=True)
     if solved['RA'] == None:
@@ -621,9 +903,112 @@ def tetraSolve(imageName):
     file1.write(radec)
     file1.close()
     skyStatusText = str(solved['RA'])
+    # like solve-field's solutions, the stars are drawn for single images or when verbose
+    if state is not Mode.SOLVING or skyConfig['observing']['verbose']:
+        verboseSolveText, _ = showOverlay(skyOverlay.fromTetra3(solved, size))
     return solved
 
 
+# live solving solutions from the pipeline, consecutive frames are tracked from the last solution:
+# tetra3 first matches the stars around it and only does a full solve if the scope moved too far
+def liveSolved(image, solved):
+    global skyStatusText, solveCompleted
+
+    tetraSolved(solved, image.gray().shape)
+    darks.recordSolve(solved, image.calibrated)
+    if state is Mode.SOLVING:
+        skyStatusText = tetraStatus(solved)
+    solveCompleted = True
+
+
+# live frames are thresholded against a background model kept over the frames in the extractor,
+# and only the brightest spots, as many as tetra3 uses, are measured
+livePipeline = solvePipeline(t3Extractor, t3, liveSolved,
+                             extractArgs={'max_returned': verificationStars, 'track_background': True,
+                                          'partial_extraction': True})
+
+# once one solver has won this share of at least hybridLearnAfter races for a profile the hybrid
+# solver starts only that one, racing both again every hybridRaceEvery frames to keep learning
+hybridLearnAfter = 20
+hybridFavourite = .9
+hybridRaceEvery = 10
+hybridSolves = 0
+
+
+def hybridSolve(image, live=False):
+    global skyStatusText, hybridSolves
+    # start tetra3 and solve-field on the same image, the first one to solve it wins and
+    # solve-field is killed if it didn't
+    profile = skyConfig['solverProfiles'][skyConfig['solver']['currentProfile']]
+    wins = profile.setdefault('solverWins', {'tetra3': 0, 'astrometry': 0})
+    hybridSolves += 1
+    favourite = max(wins, key=wins.get)
+    solvers = ['tetra3', 'astrometry']
+    if sum(wins.values()) >= hybridLearnAfter and wins[favourite] >= hybridFavourite * sum(wins.values()) \
+            and hybridSolves % hybridRaceEvery != 0:
+        solvers = [favourite]
+
+    if not live:
+        # playback frames are solved by solve-field from the cap file, live ones from the xylist
+        image.save(os.path.join(solve_path, imageName))
+    lock = threading.Lock()
+    finished = threading.Condition(lock)
+    results = {}
+    solutions = {}
+    cancel = threading.Event()
+
+    def tetra3Solver():
+        return tetraSolve(image)
+
+    def astrometrySolver():
+        return solve(os.path.join(solve_path, imageName), image=image if live else None, cancel=cancel)
+
+    def run(name, solver):
+        try:
+            s = solver()
+        except Exception as e:
+            print(name, "solver failed", e, flush=True)
+            s = None
+        solved = bool(s) and (s['RA'] is not None if isinstance(s, dict) else True)
+        solutions[name] = s
+        with finished:
+            results[name] = solved
+            finished.notify_all()
+
+    def race(names):
+        threads = [threading.Thread(target=run, args=(name, {'tetra3': tetra3Solver,
+                   'astrometry': astrometrySolver}[name]), daemon=True) for name in names]
+        for th in threads:
+            th.start()
+        with finished:
+            finished.wait_for(lambda: any(results.get(name) for name in names)
+                              or all(name in results for name in names))
+            winner = next((name for name in names if results.get(name)), None)
+        if winner is not None:
+            # solve-field is killed within a tenth of a second
+            cancel.set()
+        for th in threads:
+            th.join()
+        return winner
+
+    t0 = time.time()
+    winner = race(solvers)
+    if winner is None and len(solvers) == 1:
+        # the usual winner failed, the other one may still solve it
+        results.clear()
+        winner = race([name for name in wins if name != solvers[0]])
+    if winner is None:
+        skyStatusText = "Failed"
+        return None
+    wins[winner] += 1
+    if sum(wins.values()) % 10 == 0:
+        saveConfig()
+    solveLog.append("%s solved first in %.2f secs, wins %s\n" % (winner, time.time() - t0, wins))
+    if winner == 'tetra3':
+        skyStatusText = tetraStatus(solutions['tetra3'])
+    return winner
+
+
 app = Flask(__name__)
 
 skyStatusText = 'Initilizing Camera'
@@ -643,7 +1028,7 @@ def index():
     skyFrameValues = ['400x300', '640x480', '800x600', '1024x768',
                       '1280x960', '1920x1440', '2000x1000', '2000x1500']
     isoValues = ['100', '200', '400', '800', '1600', '3200']
-    formatValues = ['jpeg', 'png']
+    formatValues = ['jpeg', 'png', 'yuv']
     solveParams = {'PPA': 27, 'FieldWidth': 14, 'Timeout': 34,
                    'Sigma': 9, 'Depth': 20, 'SearchRadius': 10}
     if cameraNotPresent:
@@ -666,11 +1051,7 @@ def streamSolveLog():
     def generate():
         global solveLog
         while True:
-            #print (len(solveLog))
-            if len(solveLog) > 0:
-                str = solveLog.pop(0)
-                #print ("log", str)
-                yield str
+            yield solveLog.waitPop()
 
     return app.response_class(generate(), mimetype="text/plain")
 
@@ -680,7 +1061,7 @@ def pause():
     global skyStatusText, skyCam, state
     if skyCam:
         skyCam.pause()
-    state = Mode.PAUSED
+    setState(Mode.PAUSED)
 
     skyStatusText = 'Paused'
     return Response(skyStatusText)
@@ -692,7 +1073,7 @@ def Align():
     if skyCam:
         skyCam.resume()
 
-        state = Mode.ALIGN
+        setState(Mode.ALIGN)
         skyStatusText = 'Align Mode'
     return Response(skyStatusText)
 
@@ -702,9 +1083,12 @@ def saveCurrent():
     global skyStatusText, imageName
     print("save current image", flush=True)
     fn = datetime.now().strftime("%m_%d_%y_%H_%M_%S.") + \
-        skyConfig['camera']['format']
-    copyfile(os.path.join(solve_path, imageName),
-             os.path.join(solve_path, 'history', fn))
+        imageExt()
+    image = frames.latest()
+    if image is None:
+        skyStatusText = 'no image to save'
+        return Response(skyStatusText)
+    image.save(os.path.join(solve_path, 'history', fn))
 
     skyStatusText = 'saved'
     return Response(skyStatusText)
@@ -716,13 +1100,13 @@ def Solving():
     if skyCam:
         skyCam.resume()
     if state is Mode.PLAYBACK:
-        state = Mode.AUTOPLAYBACK
+        setState(Mode.AUTOPLAYBACK)
         skyStatusText = "Auto playback"
     elif state is Mode.AUTOPLAYBACK:
-        state = Mode.PLAYBACK
+        setState(Mode.PLAYBACK)
         skyStatusText = "Manual playback"
     else:
-        state = Mode.SOLVING
+        setState(Mode.SOLVING)
         skyStatusText = 'Solving Mode'
     return Response(skyStatusText)
 
@@ -770,9 +1154,9 @@ def setFrame(value):
 def setFormat(value):
     global skyStatusText, imageName
     skyStatusText = "changing Image Format to " + value
-    imageName = 'cap.'+value
     skyCam.setFormat(value)
     skyConfig['camera']['format'] = value
+    imageName = 'cap.'+imageExt()
     saveConfig()
 
     return Response(status=204)
@@ -870,40 +1254,88 @@ def Focus():
     return Response(focusStd)
 
 
-def gen():
-    global skyStatusText, solveT, testNdx,  triggerSolutionDisplay, testMode, state, solveCurrent, frameStack, frameStackLock, framecnt, tmr
-    # Video streaming generator function.
+@app.route('/solverWins', methods=['GET'])
+def solverWins():
+    return json.dumps({name: profile.get('solverWins') for name, profile in
+                       skyConfig['solverProfiles'].items() if profile.get('solverWins')})
 
-    lastImageTime = datetime.now()
-    yield (b'\r\n--framex\r\n' b'Content-Type: image/jpeg\r\n\r\n')
-    while True:
-        if len(frameStack) == 0:
-            continue
 
-        frameStackLock.acquire()
-        if len(frameStack) == 0:
+# per stage times of the live solving pipeline and the depth of the queues between the stages
+@app.route('/pipelineStats', methods=['GET'])
+def pipelineStats():
+    return json.dumps(livePipeline.stats())
 
-            frameStackLock.release()
-            continue
 
-        lastImageTime = frameStack[-1][1]
+def captureDarkFrames(count):
+    global skyStatusText
+    key = darkKey()
+    darkFrames = []
+    while len(darkFrames) < count:
+        frame = skyCam.get_frame()
+        if frame is None:
+            skyStatusText = "dark frames: the camera timed out"
+            return
+        darkFrames.append((skyFrame(gray=frame) if isinstance(frame, np.ndarray) else skyFrame(frame)).gray())
+        skyStatusText = "dark frame %d of %d" % (len(darkFrames), count)
+    hot = darks.build(key, darkFrames)
+    skyStatusText = "dark calibration %s saved, %d hot pixels" % (key, hot)
+
+
+# with the lens covered, capture dark frames (?frames=N, default 10) for the camera's current
+# shutter, ISO and resolution and make the calibration for them
+@app.route('/captureDarks', methods=['POST', 'GET'])
+def captureDarks():
+    count = int(request.args.get('frames', 10))
+    if skyCam is None:
+        return Response("no camera, dark frames can't be captured", status=503)
+    threading.Thread(target=captureDarkFrames, args=(count,), daemon=True).start()
+    return Response("capturing %d dark frames, keep the lens covered" % count)
+
+
+@app.route('/darkCalibration/<value>', methods=['POST'])
+def darkCalibrationOn(value):
+    darks.enabled = (value == 'true')
+    return Response(status=204)
+
+
+# the dark calibrations saved and the pattern trials per solve with and without them, with
+# ?compare=1 the latest frame is solved both ways too
+@app.route('/calibrationReport', methods=['GET'])
+def calibrationReport():
+    image = frames.latest()
+    if request.args.get('compare') and image is not None and image.gray() is not None and image.calibrated:
+        darks.compare(image.rawGray, image.gray(), t3, fov_estimate=tetraFov())
+    return json.dumps(darks.report())
+
 
-        fn = frameStack[-1][0]
+def gen():
+    global skyStatusText, solveT, testNdx,  triggerSolutionDisplay, testMode, state, solveCurrent, frames, framecnt, tmr
+    # Video streaming generator function.
 
-        with open(fn, 'rb') as infile:
-            frame = infile.read()
-        frameStack.clear()
-        frameStackLock.release()
+    client = frames.register()
+    print("video clients", frames.clientCount, flush=True)
+    try:
+        yield (b'\r\n--framex\r\n' b'Content-Type: image/jpeg\r\n\r\n')
+        while True:
+            # blocks until there is a new frame, None if this client got dropped for being too slow
+            image = frames.get(client)
+            if image is None:
+                break
+            frame = image.data
 
-        if state is Mode.ALIGN:
-            framecnt = framecnt + 1
-            skyStatusText = "frame %d" % (framecnt)
+            if state is Mode.ALIGN:
+                framecnt = framecnt + 1
+                skyStatusText = "frame %d" % (framecnt)
 
-        # this send the image and also the header for the next image
-        yield (frame + b'\r\n--framex\r\n' b'Content-Type: image/jpeg\r\n\r\n')
+            # this send the image and also the header for the next image
+            yield (frame + b'\r\n--framex\r\n' b'Content-Type: image/jpeg\r\n\r\n')
 
-        if state is Mode.SOLVING:
-            solveCurrent = True
+            if state is Mode.SOLVING:
+                solveCurrent = True
+    finally:
+        # the browser closed the stream or the client was dropped
+        frames.unregister(client)
+        print("video clients", frames.clientCount, flush=True)
 
 
 @app.route('/deleteProfile/<value>', methods=['POST'])
@@ -951,6 +1383,9 @@ def apply():
     profile['verbose'] = bool(req.get("verbose"))
     profile['maxTime'] = float(req.get('CPUTimeout'))
     profile['additionalParms'] = req.get('additionalParms')
+    # astrometry profiles can also race tetra3 against solve-field
+    if req.get('solver_type') in ('solverAstromet', 'solverHybrid') and profile['solver_type'] != 'solverTetra3':
+        profile['solver_type'] = req.get('solver_type')
     #print("curprofile", profile)
     saveConfig()
     print('\n\n\nskyconfig', json.dumps(
@@ -963,10 +1398,10 @@ def apply():
 
 @app.route('/demoMode', methods=['POST'])
 def demoMode():
-    global testMode, testFiles, testNdx, frameStack,  solveLog, state, solveThisImage
+    global testMode, testFiles, testNdx, frames,  solveLog, state, solveThisImage
 
     skyStatusText = 'Demo images will be set for playback'
-    state = Mode.PLAYBACK
+    setState(Mode.PLAYBACK)
     testFiles = [demo_path + '/' + fn for fn in os.listdir(
         demo_path) if any(fn.endswith(ext) for ext in ['jpg', 'png'])]
     testFiles.sort(key=os.path.getmtime)
@@ -974,30 +1409,27 @@ def demoMode():
 
     print("demo files len", len(testFiles))
     time.sleep(2)
-    frameStack.clear()
+    frames.clear()
     setupImageFromFile()
 
-    solveLog = [x + '\n' for x in testFiles]
+    for x in testFiles:
+        solveLog.append(x + '\n')
 
     return Response(skyStatusText)
 
 
 def setupImageFromFile():
-    global solveThisImage, frameStackLock, frameStack, skyStatusText
+    global solveThisImage, frames, skyStatusText
 
     solveThisImage = testFiles[testNdx]
 
-    frameStackLock.acquire()
-    frameStack.clear()
-
-    frameStack.append((solveThisImage, datetime.now()))
-    frameStackLock.release()
+    frames.put(skyFrame.fromFile(solveThisImage))
 
     skyStatusText = "%d %s" % (testNdx, testFiles[testNdx])
 
 
 def findHistoryFiles():
-    global saveLog, skyStatusText, testFiles, testNdx, frameStack, solveThisImage
+    global saveLog, skyStatusText, testFiles, testNdx, frames, solveThisImage
     print("finding files")
     x = datetime.now() + timedelta(seconds=2)
     testFiles = [history_path + '/' + fn for fn in os.listdir(
@@ -1006,7 +1438,7 @@ def findHistoryFiles():
 
 
     print("test files len", len(testFiles))
-    frameStack.clear()
+    frames.clear()
     solveLog = [x + '\n' for x in testFiles]
     while datetime.now() < x:
         time.sleep(1)
@@ -1043,7 +1475,7 @@ def shutdown():
 @app.route('/reboot', methods=['POST'])
 def reboot():
     global skyStatusText, state
-    state = Mode.PAUSED
+    setState(Mode.PAUSED)
     th = threading.Thread(target=reboot3)
     th.start()
     skyStatusText = "reboot in 3 seconds goodbye. You will need to reload this page after about 3 minutes"
@@ -1060,7 +1492,7 @@ def restartThread():
 def restartc():
     global skyStatusText, skyCam, state
 
-    state = Mode.PAUSED
+    setState(Mode.PAUSED)
     th = threading.Thread(target=restartThread)
     th.start()
     skyStatusText = 'restarting. You will need to Reload this page in about 30 seconds'
@@ -1069,9 +1501,9 @@ def restartc():
 
 @app.route('/testMode', methods=['POST'])
 def toggletestMode():
-    global testMode, testFiles, testNdx, frameStack,  solveLog, state, solveThisImage, skyStatusText
+    global testMode, testFiles, testNdx, frames,  solveLog, state, solveThisImage, skyStatusText
 
-    state = Mode.PLAYBACK
+    setState(Mode.PLAYBACK)
     print('will find files')
     skyStatusText = "Gathering History files"
     th = threading.Thread(target=findHistoryFiles)
@@ -1086,19 +1518,22 @@ allDone = False
 import traceback
 def measureTransparency(solveLiveImage = False):
     # tell system to pause taking images after solving the current image
-    global skyStatusText, state, solveThisImage, frameStackLock, frameStack,skyStatusText, solveCurrent,\
-         solveCompleted,   measureHtmlStack
+    global skyStatusText, state, solveThisImage, frames,skyStatusText, solveCurrent,\
+         solveCompleted,   measureHtmlStack, measureLiveFrame
     solveCurrent = True
     sendStatus('solving')
     if state is Mode.PLAYBACK:
-        state = Mode.SOLVETHIS
+        setState(Mode.SOLVETHIS)
+    elif state is Mode.SOLVING:
+        # live frames aren't written to the cap file, wait for the next one, which is
+        measureLiveFrame = True
     
     skyStatusText = "Solving"
     solveCompleted = False
-    while not solveCompleted:
+    while not solveCompleted or (measureLiveFrame and state is Mode.SOLVING):
         time.sleep(.5)
     skyStatusText = "computing star stats"
-    sourcefn = os.path.basename(solveThisImage).split(skyConfig['camera']['format'])[0][:-1]
+    sourcefn = os.path.basename(solveThisImage).split(imageExt())[0][:-1]
     try:
         sendStatus('Inspecting stars')
         starlist, image, width, height= Quality.findStarMags(os.path.join(solve_path, imageName),sourcefn)
@@ -1193,33 +1628,30 @@ def measureTransparency(solveLiveImage = False):
     #skyStatusText = out 
     return starlist,out  
 
-readytoSend = False
-message = ''
+statusMessages = broadcaster()
 statusCols = ['','']
 
 def sendStatus(msg, col=1):
-    global readytoSend, message
     statusCols[col-1] = msg
-    while readytoSend:
-        pass
-    message = ' '.join(statusCols)
-    readytoSend = True
+    statusMessages.put(' '.join(statusCols))
     
 @app.route('/skyQstatus', methods=['POST','GET'])
 def skyQStatus():
-    global readytoSend,message,allDone
+    global allDone
     print("skyall called")
     sendStatus("Ready")
 
     def inner():
-        global  allDone,readytoSend,message
-        while True:
-            #measureStackLock.acquire()
-            if readytoSend:
+        client = statusMessages.register()
+        try:
+            while True:
+                message = statusMessages.get(client)
+                if message is None:
+                    break
                 yield 'data: '+message+ '\n\n'
-                readytoSend = False
+        finally:
+            statusMessages.unregister(client)
 
-                
     return Response(inner(), mimetype='text/event-stream')
 
     
@@ -1238,18 +1670,18 @@ def processImageX():
 
 @app.route("/skyQualitySample", methods=['POST','GET'])
 def takeSkyQualitySample():
-    global skyStatusText, state, solveThisImage, frameStackLock, frameStack,skyStatusText, solveCurrent,\
+    global skyStatusText, state, solveThisImage, frames,skyStatusText, solveCurrent,\
          solveCompleted, starMeasures
 
     # if all parameter is true then use all images in history and rebuild transaprency database
     if request.args.get('live'):
         #turn on solving mode and wait for an image to be solved
-        state = Mode.SOLVING
+        setState(Mode.SOLVING)
         #return Response("Analizying live image")
     else:
         # stop live solving if running and get history
         if state != Mode.PLAYBACK:
-            state = Mode.PLAYBACK
+            setState(Mode.PLAYBACK)
             findHistoryFiles()
 
     #display the transparancy from the current image
@@ -1413,7 +1845,7 @@ def prevObs():
 def solveThis():
     global solveCurrent, state
     solveCurrent = True
-    state = Mode.SOLVETHIS
+    setState(Mode.SOLVETHIS, restart=True)
     skyStatusText = "Solving"
     return Response(skyStatusText)
 
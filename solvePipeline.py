@@ -0,0 +1,104 @@
+"""Pipelined star extraction and matching for live solving
+
+The capture loop submits each new frame and goes straight back to the camera.  An extract thread
+finds the centroids of frame N+1 in one solver process while a match thread solves the centroids
+of frame N in another, so on a multi core Pi the camera, extraction and matching all run at the
+same time and solutions come close to once per exposure.  Between the stages are queues holding
+at most one item, a newer frame replaces one still waiting, so the latency never grows when a
+stage can't keep up.
+
+Consecutive frames are tracked from the last solution, see Tetra3.solve_from_centroids, and
+the extraction can be given arguments such as track_background, which thresholds them against a
+background model kept over the frames instead of filtering each one, see tetra3.BackgroundModel.
+"""
+import collections
+import threading
+import time
+
+import numpy as np
+
+
+class stageQueue():
+    """Bounded queue between two stages, when full the oldest item is dropped (latest wins)."""
+
+    def __init__(self, maxsize=1):
+        self.items = collections.deque(maxlen=maxsize)
+        self.condition = threading.Condition()
+        self.dropped = 0
+
+    def put(self, item):
+        with self.condition:
+            if len(self.items) == self.items.maxlen:
+                self.dropped += 1
+            self.items.append(item)
+            self.condition.notify()
+
+    def get(self):
+        with self.condition:
+            self.condition.wait_for(lambda: len(self.items) > 0)
+            return self.items.popleft()
+
+    def __len__(self):
+        with self.condition:
+            return len(self.items)
+
+
+class solvePipeline():
+
+    def __init__(self, extractor, matcher, onSolved, history=50, extractArgs=None):
+        """extractor and matcher are solverProcess (or Tetra3) instances, onSolved(image, solution)
+        is called from the match thread with each solution.  extractArgs are passed to
+        get_centroids."""
+        self.extractor = extractor
+        self.extractArgs = extractArgs or {}
+        self.matcher = matcher
+        self.onSolved = onSolved
+        self.extractQueue = stageQueue()
+        self.matchQueue = stageQueue()
+        self.lastSolution = None
+        # the last stage times in milliseconds, for stats()
+        self.times = {stage: collections.deque(maxlen=history)
+                      for stage in ('extract', 'match', 'latency')}
+        for stage in (self._extract, self._match):
+            threading.Thread(target=stage, daemon=True).start()
+
+    def submit(self, image, track=True, **kwargs):
+        """Queue a skyFrame for solving, kwargs are passed to solve_from_centroids."""
+        self.extractQueue.put((image, track, kwargs, time.perf_counter()))
+
+    def _extract(self):
+        while True:
+            image, track, kwargs, submitted = self.extractQueue.get()
+            t0 = time.perf_counter()
+            gray = image.gray()
+            centroids = self.extractor.get_centroids(gray, **self.extractArgs)
+            tExtract = (time.perf_counter() - t0)*1000
+            self.times['extract'].append(tExtract)
+            self.matchQueue.put((image, gray.shape, centroids, tExtract, track, kwargs, submitted))
+
+    def _match(self):
+        while True:
+            image, size, centroids, tExtract, track, kwargs, submitted = self.matchQueue.get()
+            t0 = time.perf_counter()
+            solution = self.matcher.solve_from_centroids(
+                centroids, size, previous_solution=self.lastSolution if track else None, **kwargs)
+            now = time.perf_counter()
+            self.times['match'].append((now - t0)*1000)
+            self.times['latency'].append((now - submitted)*1000)
+            solution['T_extract'] = tExtract
+            # from submitting the frame to its solution, including time waiting in the queues
+            solution['T_latency'] = (now - submitted)*1000
+            self.lastSolution = solution if solution['RA'] is not None else None
+            try:
+                self.onSolved(image, solution)
+            except Exception as e:
+                print("pipeline solution handler failed", e, flush=True)
+
+    def stats(self):
+        """Median stage times in milliseconds, queue depths and frames dropped by each queue."""
+        stats = {'T_' + stage: float(np.median(list(times))) if len(times) else None
+                 for stage, times in self.times.items()}
+        for name, queue in (('extract', self.extractQueue), ('match', self.matchQueue)):
+            stats[name + 'Queue'] = len(queue)
+            stats[name + 'Dropped'] = queue.dropped
+        return stats
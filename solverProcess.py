@@ -0,0 +1,177 @@
+"""Runs the tetra3 solver in a worker process
+
+Solving is mostly python and numpy work which, inside the web server process, competes for the
+GIL with Flask, the video stream and the focus meter.  The worker process owns its own Tetra3
+instance.  Each image is copied into a shared memory block, only its name, shape and the solve
+arguments go through the pipe, and the solution dict (or the centroids) comes back the same way.  If the worker
+raises or dies (or hangs past the timeout) the solve fails, the worker is started again and the
+web server keeps running.
+
+The worker is a fresh python running this file, not a fork: it is restarted from the solving
+threads while Flask, the camera and the pipeline threads are running, and a process forked while
+another thread holds a lock (logging, the allocator, a pipe) can deadlock.  Nor is it started by
+multiprocessing's spawn or forkserver, which would run skysolve.py again in the worker.
+"""
+import atexit
+import multiprocessing
+import multiprocessing.connection
+import os
+import subprocess
+import sys
+import threading
+import time
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+
+def _worker(databases, conn):
+    from tetra3 import Tetra3
+    t3 = Tetra3(databases)
+    shm = None
+    try:
+        while True:
+            request = conn.recv()
+            if request is None:
+                break
+            method, name, shape, args, kwargs = request
+            if name is not None:
+                if shm is None or shm.name != name:
+                    if shm is not None:
+                        shm.close()
+                    shm = shared_memory.SharedMemory(name=name)
+                    # the block belongs to the web server, the resource tracker this process
+                    # starts must not unlink it when the worker exits
+                    resource_tracker.unregister(shm._name, 'shared_memory')
+                args = (np.ndarray(shape, dtype=np.uint8, buffer=shm.buf),) + args
+            # an exception ends the worker, the front end starts a fresh one
+            result = getattr(t3, method)
+            if callable(result):
+                result = result(*args, **kwargs)
+            del args
+            conn.send(result)
+    finally:
+        if shm is not None:
+            shm.close()
+
+
+class solverProcess():
+    """Stands in for a Tetra3 instance, solve_from_image runs in the worker process."""
+
+    def __init__(self, databases, timeout=60.):
+        self.databases = databases
+        self.timeout = timeout
+        self.lock = threading.Lock()  # one solve at a time
+        self.shm = None
+        self.process = None
+        self.conn = None
+        self.restarts = 0
+        self.start()
+        atexit.register(self.stop)
+
+    def start(self):
+        self.conn, child = multiprocessing.Pipe()
+        self.process = subprocess.Popen([sys.executable, os.path.abspath(__file__),
+                                         str(child.fileno())], pass_fds=(child.fileno(),))
+        child.close()
+        self.conn.send(self.databases)
+        print("solver process started", self.process.pid, flush=True)
+
+    def restart(self, reason):
+        print("solver process", reason, "restarting it", flush=True)
+        self.restarts += 1
+        self.conn.close()
+        if self.process.poll() is None:
+            self.process.kill()
+        self.process.wait()
+        self.start()
+
+    def stop(self):
+        with self.lock:
+            try:
+                self.conn.send(None)
+            except (BrokenPipeError, OSError):
+                pass
+            try:
+                self.process.wait(5)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+            if self.shm is not None:
+                self.shm.close()
+                self.shm.unlink()
+                self.shm = None
+
+    def _share(self, image):
+        """Copy the image into the shared memory block, making a bigger block if needed."""
+        if self.shm is None or self.shm.size < image.nbytes:
+            if self.shm is not None:
+                self.shm.close()
+                self.shm.unlink()
+            self.shm = shared_memory.SharedMemory(create=True, size=image.nbytes)
+        np.ndarray(image.shape, dtype=np.uint8, buffer=self.shm.buf)[:] = image
+
+    def _call(self, method, image, *args, **kwargs):
+        """Run the Tetra3 method in the worker, the image (if any) is passed as its first argument.
+
+        Returns None if the worker failed.
+        """
+        with self.lock:
+            name = shape = None
+            if image is not None:
+                image = np.asarray(image, dtype=np.uint8)
+                self._share(image)
+                name, shape = self.shm.name, image.shape
+            try:
+                self.conn.send((method, name, shape, args, kwargs))
+                if not self.conn.poll(self.timeout):
+                    self.restart("timed out")
+                    return None
+                return self.conn.recv()
+            except (EOFError, BrokenPipeError, ConnectionResetError):
+                self.restart("died")
+                return None
+
+    def solve_from_image(self, image, **kwargs):
+        """Solve the image in the worker, see Tetra3.solve_from_image.
+
+        The returned solution also has 'T_ipc', the round trip time in milliseconds spent on top
+        of the worker's T_solve and T_extract.
+        """
+        t0 = time.perf_counter()
+        solution = self._call('solve_from_image', image, **kwargs)
+        if solution is None:
+            return self.failed(t0)
+        solution['T_ipc'] = (time.perf_counter() - t0)*1000 - solution['T_solve'] \
+            - solution.get('T_extract', 0)
+        return solution
+
+    @property
+    def verification_stars(self):
+        """The number of stars the worker's databases need for verification, see
+        Tetra3.verification_stars, None if the worker failed."""
+        return self._call('verification_stars', None)
+
+    def get_centroids(self, image, **kwargs):
+        """Find the star centroids in the worker, see Tetra3.get_centroids."""
+        centroids = self._call('get_centroids', image, **kwargs)
+        return centroids if centroids is not None else np.empty((0, 2))
+
+    def solve_from_centroids(self, star_centroids, size, **kwargs):
+        """Solve the centroids in the worker, see Tetra3.solve_from_centroids."""
+        t0 = time.perf_counter()
+        solution = self._call('solve_from_centroids', None, star_centroids, size, **kwargs)
+        return solution if solution is not None else self.failed(t0)
+
+    @staticmethod
+    def failed(t0):
+        return {'RA': None, 'Dec': None, 'Roll': None, 'FOV': None, 'RMSE': None, 'Matches': None,
+                'Prob': None, 'T_solve': (time.perf_counter() - t0)*1000, 'T_extract': 0, 'Trials': None}
+
+
+if __name__ == '__main__':
+    # the worker, started by solverProcess.start with its end of the pipe
+    connection = multiprocessing.connection.Connection(int(sys.argv[1]))
+    try:
+        _worker(connection.recv(), connection)
+    except EOFError:
+        pass  # the web server has gone
@@ -302,6 +302,13 @@ $(document).ready(function(){
  
         }
     )
+    // races tetra3 against astrometry with the astrometry profile settings
+    $('#solverHybrid').click(
+        function(){
+            var ele = document.getElementById('astrometryForm');
+            ele.style.display = "inline";
+        }
+    )
     $('#deleteProfile').click(
         function(){
             var sel = $('#solveProfile').val()
@@ -377,7 +384,7 @@ $(document).ready(function(){
             console.log("skyimage was clicked");
             var verb = document.getElementById('idverbose').checked;
 
-            if ( !verb || sks.consts.currentProfile === 'Tetra3')
+            if ( !verb )
                 return
 
             var src = document.getElementById("solu");
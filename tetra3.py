@@ -82,9 +82,13 @@ Original Tetra license notice:
 
 # Standard imports:
 from pathlib import Path
+import concurrent.futures
 import csv
 import logging
 import itertools
+import multiprocessing
+import os
+import shutil
 from time import perf_counter as precision_timestamp
 from datetime import datetime
 
@@ -93,12 +97,26 @@ import numpy as np
 from numpy.linalg import norm
 import scipy.ndimage
 import scipy.optimize
+import scipy.sparse
+import scipy.sparse.csgraph
 import scipy.stats
 
 _MAGIC_RAND = 2654435761
+_PROBE_BLOCK = 16
+_DOT_TOLERANCE = 1e-6
+_CHECKPOINT_INTERVAL = 60
 _supported_databases = ('bsc5', 'hip_main', 'tyc_main')
 
 
+def _npz_path(path):
+    """Get the path with the suffix .npz added, unless it has it already.
+
+    Unlike pathlib's with_suffix this keeps a dot in the name, as in tetra3_fov7.5.
+    """
+    path = Path(path)
+    return path if path.suffix == '.npz' else path.with_name(path.name + '.npz')
+
+
 def _insert_at_index(item, index, table):
     """Inserts to table with quadratic probing."""
     max_ind = table.shape[0]
@@ -129,6 +147,227 @@ def _key_to_index(key, bin_factor, max_index):
     return (index * _MAGIC_RAND) % max_index
 
 
+def _get_at_keys(keys, indices, table_keys):
+    """Gets from table with quadratic probing for many keys at once, using the stored pattern keys.
+
+    `table_keys` holds the key of the pattern in each slot of the table as a single integer (the
+    maximum of its dtype for empty slots). Only slots with the sought key are returned, so colliding
+    patterns are skipped without being read. Probe steps are gathered in blocks for all keys at
+    once. Returns a tuple (source, slots) where slots are the table indices of all matches found and
+    source is the position in keys each match was found from. Matches are ordered by source, then
+    by probe step.
+    """
+    max_ind = table_keys.shape[0]
+    empty_key = np.iinfo(table_keys.dtype).max
+    keys = np.asarray(keys, dtype=table_keys.dtype)
+    indices = np.asarray(indices, dtype=np.int64)
+    active = np.arange(len(indices))
+    sources = []
+    slots = []
+    for first_step in itertools.count(0, _PROBE_BLOCK):
+        if len(active) == 0:
+            break
+        steps = np.arange(first_step, first_step + _PROBE_BLOCK, dtype=np.int64)
+        probed = (indices[active, None] + steps**2) % max_ind
+        found = table_keys[probed]
+        # a probe chain ends at the first empty slot
+        in_chain = np.logical_and.accumulate(found != empty_key, axis=1)
+        (hit_row, hit_step) = np.nonzero(in_chain & (found == keys[active, None]))
+        sources.append(active[hit_row])
+        slots.append(probed[hit_row, hit_step])
+        active = active[in_chain[:, -1]]
+    if len(sources) == 0:
+        return (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64))
+    source = np.concatenate(sources)
+    order = np.argsort(source, kind='stable')
+    return (source[order], np.concatenate(slots)[order])
+
+
+def _keys_to_indices(keys, max_index):
+    """Get hash indices for many keys packed by :func:`_pack_keys`, as :func:`_key_to_index`.
+
+    The key is reduced modulo max_index before it is multiplied by the magic constant, so the
+    product stays within uint64 and the indices are those of the Python integer arithmetic.
+    """
+    assert 0 < max_index < 2**32, 'hash table too long for uint64 index arithmetic'
+    keys = np.asarray(keys).astype(np.uint64) % np.uint64(max_index)
+    return (keys * np.uint64(_MAGIC_RAND % max_index) % np.uint64(max_index)).astype(np.int64)
+
+
+def _pack_keys(keys, bin_factor):
+    """Get keys (one per row) as single integers."""
+    keys = np.asarray(keys, dtype=np.int64)
+    assert int(bin_factor) ** keys.shape[-1] <= 2**63, 'pattern keys overflow int64'
+    return (keys * int(bin_factor) ** np.arange(keys.shape[-1], dtype=np.int64)).sum(axis=-1)
+
+
+def _compute_pattern_keys(star_table, pattern_catalog, bin_factor, chunk_size=2**18):
+    """Get the key of every pattern in a catalog as a single integer, for :meth:`_get_at_keys`.
+
+    Empty slots get the maximum value of the returned dtype. The edge ratios are computed with the
+    same precision as when the catalog was generated, so the keys match those used for insertion.
+    """
+    num_edges = pattern_catalog.shape[1] * (pattern_catalog.shape[1] - 1) // 2
+    if int(bin_factor) ** (num_edges - 1) < np.iinfo(np.uint32).max:
+        dtype = np.uint32
+    else:
+        dtype = np.uint64
+    pattern_keys = np.full(pattern_catalog.shape[0], np.iinfo(dtype).max, dtype=dtype)
+    # Work in chunks to limit memory use for large catalogs
+    for start in range(0, pattern_catalog.shape[0], chunk_size):
+        rows = pattern_catalog[start:start + chunk_size, :]
+        occupied = np.nonzero(np.any(rows != 0, axis=1))[0]
+        (_, edge_ratios) = _compute_edge_ratios(star_table[rows[occupied, :], 2:5])
+        pattern_keys[start + occupied] = _pack_keys((edge_ratios * bin_factor).astype(int),
+                                                    bin_factor)
+    return pattern_keys
+
+
+def _compute_edge_ratios(vectors):
+    """Get sorted edges and edge ratios of star patterns.
+
+    Args:
+        vectors (numpy.ndarray): Star vectors of shape (..., pattern_size, 3).
+
+    Returns:
+        tuple: Sorted edge lengths (..., num_edges) and the edges divided by the largest edge,
+        excluding the largest itself (..., num_edges - 1).
+    """
+    # Pairs are in the same order as itertools.combinations
+    (first, second) = np.triu_indices(vectors.shape[-2], k=1)
+    edges = np.sort(norm(vectors[..., first, :] - vectors[..., second, :], axis=-1), axis=-1)
+    return (edges, edges[..., :-1] / edges[..., -1:])
+
+
+def _build_sky_index(star_vectors, max_fov):
+    """Build a coarse grid index of star vectors for cone queries, see :meth:`_get_nearby_stars`.
+
+    The cube around the unit sphere is split into cells of about half `max_fov` (degrees) per side
+    (like the temporary sky map used when generating databases). Only the occupied cells are kept,
+    so the index is the size of the star table however small the cells. Returns a tuple (bins,
+    stars, cells, starts): the cube has 2*bins cells per side, stars are the star indices sorted
+    by cell, cells the sorted flattened indices of the occupied cells and starts the position in
+    stars where the members of each of them start (with the total number of stars appended).
+    """
+    bins = max(1, int(2 / np.deg2rad(float(max_fov))))
+    cells = np.clip(((np.asarray(star_vectors) + 1) * bins).astype(int), 0, 2*bins - 1)
+    flat_cells = np.ravel_multi_index(cells.T, (2*bins,)*3)
+    stars = np.argsort(flat_cells, kind='stable').astype(np.int32)
+    (occupied, starts) = np.unique(flat_cells[stars], return_index=True)
+    starts = np.append(starts, len(stars)).astype(np.int32)
+    return (np.int64(bins), stars, occupied.astype(np.int64), starts)
+
+
+# Shared with the pattern generation worker processes, set by _init_pattern_worker
+_pattern_worker_data = {}
+
+
+def _init_pattern_worker(star_vectors, sky_map, temp_bins, max_fov, pattern_size):
+    """Store the data needed by :meth:`_find_patterns_in_region` in a worker process."""
+    _pattern_worker_data.update(star_vectors=star_vectors, sky_map=sky_map, temp_bins=temp_bins,
+                                max_fov=max_fov, pattern_size=pattern_size)
+
+
+def _dots_above(vector, vectors, limit):
+    """Check which dot products of vector with the rows of vectors are larger than limit.
+
+    Computed in one go, but values within rounding error of the limit are recomputed one by one
+    with np.dot so the result is exactly as if each was tested separately.
+    """
+    dots = np.dot(vectors, vector)
+    above = dots > limit
+    for i in np.nonzero(np.abs(dots - limit) < _DOT_TOLERANCE)[0]:
+        above[i] = np.dot(vector, vectors[i]) > limit
+    return above
+
+
+def _find_patterns_in_region(region):
+    """Find all patterns whose first star is in one region (cell) of the temporary sky map.
+
+    Gives the same patterns, in the same order, as removing each star of the region from the sky
+    map in turn and combining it with the nearby stars which are left. Returns a tuple with the
+    region and an array of patterns (one per row).
+    """
+    star_vectors = _pattern_worker_data['star_vectors']
+    sky_map = _pattern_worker_data['sky_map']
+    temp_bins = _pattern_worker_data['temp_bins']
+    max_fov = _pattern_worker_data['max_fov']
+    pattern_size = _pattern_worker_data['pattern_size']
+    patterns = []
+    for first_star in sky_map[region]:
+        vector = star_vectors[first_star, :]
+        # given error of at most radius in each dimension, compute the space of hash codes
+        hash_code_space = [range(max(low, 0), min(high+1, 2*temp_bins)) for (low, high)
+                           in zip(((vector + 1 - max_fov) * temp_bins).astype(int),
+                                  ((vector + 1 + max_fov) * temp_bins).astype(int))]
+        # stars from earlier regions and earlier in this one have been removed from the map
+        nearby = np.concatenate([np.empty(0, dtype=np.int64)]
+                                + [star_ids[star_ids > first_star] for star_ids
+                                   in (sky_map.get(hash_code) for hash_code
+                                       in itertools.product(*hash_code_space))
+                                   if star_ids is not None])
+        nearby = nearby[_dots_above(vector, star_vectors[nearby, :], np.cos(max_fov))]
+        if len(nearby) < pattern_size - 1:
+            continue
+        # verify that the patterns fit within the maximum field-of-view
+        # by checking the distances between every pair of the other stars
+        within_fov = np.array([_dots_above(star_vectors[star_id, :], star_vectors[nearby, :],
+                                           np.cos(max_fov)) for star_id in nearby])
+        combinations = np.array(list(itertools.combinations(range(len(nearby)),
+                                                            pattern_size - 1)))
+        valid = np.ones(len(combinations), dtype=bool)
+        for (first, second) in itertools.combinations(range(pattern_size - 1), 2):
+            valid &= within_fov[combinations[:, first], combinations[:, second]]
+        combinations = combinations[valid, :]
+        patterns.append(np.column_stack((np.full(len(combinations), first_star),
+                                         nearby[combinations])))
+    if len(patterns) == 0:
+        return (region, np.empty((0, pattern_size), dtype=np.int64))
+    return (region, np.concatenate(patterns))
+
+
+def _compute_vectors(star_centroids, height, width, fov):
+    """Get unit vectors from star centroids (pinhole camera)."""
+    # compute array of (i,j,k) vectors given array of (y,x) star centroids and
+    # an estimate of the image's field-of-view in the x dimension
+    # by applying the pinhole camera equations
+    star_centroids = np.asarray(star_centroids, dtype=np.float64)
+    center_x = width / 2.
+    center_y = height / 2.
+    scale_factor = np.tan(fov / 2) / center_x
+    j_over_i = (center_x - star_centroids[..., 1]) * scale_factor
+    k_over_i = (center_y - star_centroids[..., 0]) * scale_factor
+    i = 1. / np.sqrt(1 + j_over_i**2 + k_over_i**2)
+    return np.stack((i, j_over_i * i, k_over_i * i), axis=-1)
+
+
+def _find_rotation_matrix(image_vectors, catalog_vectors):
+    """Calculate the least-squares rotation matrix from catalog to image frame."""
+    # find the covariance matrix H between the image and catalog vectors
+    H = np.dot(np.asarray(image_vectors).T, np.asarray(catalog_vectors))
+    # use singular value decomposition to find the rotation matrix
+    (U, S, V) = np.linalg.svd(H)
+    rotation_matrix = np.dot(U, V)
+    # correct reflection matrix if determinant is -1 instead of 1
+    # by flipping the sign of the third column of the rotation matrix
+    rotation_matrix[:, 2] *= np.linalg.det(rotation_matrix)
+    return rotation_matrix
+
+
+def _rotation_matrix_from_attitude(ra, dec, roll):
+    """Get the rotation matrix from catalog to image frame for an attitude in degrees.
+
+    This is the inverse of how the right ascension, declination and roll of a solution are found
+    from its rotation matrix.
+    """
+    (ra, dec, roll) = np.deg2rad((ra, dec, roll))
+    boresight = np.array([np.cos(ra) * np.cos(dec), np.sin(ra) * np.cos(dec), np.sin(dec)])
+    east = np.array([-np.sin(ra), np.cos(ra), 0])
+    north = np.array([-np.sin(dec) * np.cos(ra), -np.sin(dec) * np.sin(ra), np.cos(dec)])
+    return np.array([boresight, np.cos(roll) * east + np.sin(roll) * north,
+                     np.cos(roll) * north - np.sin(roll) * east])
+
+
 def _generate_patterns_from_centroids(star_centroids, pattern_size):
     """Iterate over centroids in order of brightness."""
     # break if there aren't enough centroids to make even one pattern
@@ -204,8 +443,9 @@ class Tetra3():
             t3.generate_database(max_fov=20, save_as='my_database_name')
 
     Args:
-        load_database (str or pathlib.Path, optional): Database to load. Will call
-            :meth:`load_database` with the provided argument after creating instance.
+        load_database (str, pathlib.Path or list, optional): Database, or set of databases, to
+            load. Will call :meth:`load_database` with the provided argument after creating
+            instance.
         debug_folder (pathlib.Path, optional): The folder for debug logging. If None (the default)
             the folder tetra3/debug will be used/created.
 
@@ -237,7 +477,12 @@ class Tetra3():
         self._logger.debug('Tetra3 Constructor called with load_database=' + str(load_database))
         self._star_table = None
         self._pattern_catalog = None
+        self._pattern_keys = None
+        self._sky_index = None
+        self._databases = []
         self._verification_catalog = None
+        self._background_model = None
+        self._trials = 0
         self._db_props = {'pattern_mode': None, 'pattern_size': None, 'pattern_bins': None,
                           'pattern_max_error': None, 'max_fov': None,
                           'pattern_stars_per_fov': None, 'verification_stars_per_fov': None,
@@ -286,6 +531,15 @@ class Tetra3():
         """numpy.ndarray: Catalog of patterns in the database."""
         return self._pattern_catalog
 
+    @property
+    def pattern_keys(self):
+        """numpy.ndarray: Hash key of each row in the pattern catalog as a single integer.
+
+        Empty rows have the maximum value of the array's dtype. Stored in the database file, or
+        computed when loading a database saved without them.
+        """
+        return self._pattern_keys
+
     @property
     def database_properties(self):
         """dict: Dictionary of database properties.
@@ -305,28 +559,77 @@ class Tetra3():
         """
         return self._db_props
 
+    @property
+    def verification_stars(self):
+        """int: Number of stars needed for verification with any of the loaded databases, the
+        number :meth:`get_centroids` returns by default."""
+        assert self.has_database, 'No database loaded'
+        return int(max(database['props']['verification_stars_per_fov']
+                       for database in self._databases))
+
     def load_database(self, path='default_database'):
-        """Load database from file.
+        """Load database from file, or a set of databases from several files.
+
+        A set of databases built for different maximum fields of view lets the solver pick the
+        database to use for each image from the field of view estimate, see
+        :meth:`solve_from_centroids`. The database properties and arrays of this instance are
+        those of the database in the set with the largest field of view.
+
+        If a directory with the same name as the database but without suffix exists (as written
+        by :meth:`save_database` with `mmap=True`) and the .npz file is not newer, the database is
+        loaded from it instead of the .npz file. The arrays are then memory mapped read only, so
+        they are read from disk as they are used and the memory is shared between all processes
+        using the same database.
 
         Args:
-            path (str or pathlib.Path): The file to load. If given a str, the file will be looked
-                for in the tetra3 directory. If given a pathlib.Path, this path will be used
-                unmodified. The suffix .npz will be added.
+            path (str, pathlib.Path or list): The file to load. If given a str, the file will be
+                looked for in the tetra3 directory. If given a pathlib.Path, this path will be used
+                unmodified. The suffix .npz will be added. If given a list of these, all are
+                loaded as a set.
         """
         self._logger.debug('Got load database with: ' + str(path))
+        if isinstance(path, (list, tuple)):
+            assert len(path) > 0, 'No database to load'
+            databases = []
+            for single_path in path:
+                self.load_database(single_path)
+                databases.extend(self._databases)
+            databases.sort(key=lambda database: database['props']['max_fov'])
+            self._use_database(databases[-1])
+            self._databases = databases
+            self._logger.info('Loaded set of ' + str(len(databases)) + ' databases with max_fov '
+                              + str([database['props']['max_fov'] for database in databases]))
+            return
         if isinstance(path, str):
             self._logger.debug('String given, append to tetra3 directory')
-            path = (Path(__file__).parent / path).with_suffix('.npz')
+            path = _npz_path(Path(__file__).parent / path)
         else:
             self._logger.debug('Not a string, use as path directly')
-            path = Path(path).with_suffix('.npz')
-
-        self._logger.info('Loading database from: ' + str(path))
-        with np.load(path) as data:
-            self._logger.debug('Loaded database, unpack files')
-            self._pattern_catalog = data['pattern_catalog']
-            self._star_table = data['star_table']
-            props_packed = data['props_packed']
+            path = _npz_path(path)
+
+        mmap_path = path.with_name(path.stem)
+        if mmap_path.is_dir() and not (path.exists()
+                                       and path.stat().st_mtime > mmap_path.stat().st_mtime):
+            path = mmap_path
+            self._logger.info('Loading memory mapped database from: ' + str(path))
+            data = {name.stem: np.load(name, mmap_mode='r') for name in path.glob('*.npy')}
+        else:
+            self._logger.info('Loading database from: ' + str(path))
+            with np.load(path) as npz_data:
+                data = {name: npz_data[name] for name in npz_data.files}
+        self._logger.debug('Loaded database, unpack files')
+        self._pattern_catalog = data['pattern_catalog']
+        self._star_table = data['star_table']
+        props_packed = data['props_packed']
+        if 'pattern_keys' in data:
+            self._pattern_keys = data['pattern_keys']
+        else:
+            self._pattern_keys = None
+        if 'sky_index_cells' in data:
+            self._sky_index = (data['sky_index_bins'][()], data['sky_index_stars'],
+                               data['sky_index_cells'], data['sky_index_starts'])
+        else:
+            self._sky_index = None
         self._logger.debug('Unpacking properties')
         for key in self._db_props.keys():
             try:
@@ -343,23 +646,59 @@ class Tetra3():
                         + str(self._db_props[key]))
                 else:
                     raise
-
-    def save_database(self, path):
+        if self._pattern_keys is None:
+            self._logger.info('Database has no pattern keys, computing them. Save the database '
+                              + 'again to skip this when loading.')
+            self._pattern_keys = _compute_pattern_keys(self._star_table, self._pattern_catalog,
+                                                       self._db_props['pattern_bins'])
+        if self._sky_index is None:
+            self._logger.debug('Database has no sky index, building it')
+            self._sky_index = _build_sky_index(self._star_table[:, 2:5],
+                                               self._db_props['max_fov'])
+        self._databases = [self._current_database()]
+
+    def _current_database(self):
+        """Get the arrays and properties of the current database as a dictionary."""
+        return {'star_table': self._star_table, 'pattern_catalog': self._pattern_catalog,
+                'pattern_keys': self._pattern_keys, 'sky_index': self._sky_index,
+                'props': dict(self._db_props)}
+
+    def _use_database(self, database):
+        """Make a database from the set, as given by :meth:`_current_database`, the current one."""
+        self._star_table = database['star_table']
+        self._pattern_catalog = database['pattern_catalog']
+        self._pattern_keys = database['pattern_keys']
+        self._sky_index = database['sky_index']
+        self._db_props = dict(database['props'])
+
+    def save_database(self, path, mmap=False):
         """Save database to file.
 
         Args:
             path (str or pathlib.Path): The file to save to. If given a str, the file will be saved
                 in the tetra3 directory. If given a pathlib.Path, this path will be used
                 unmodified. The suffix .npz will be added.
+            mmap (bool, optional): If True, save the arrays uncompressed as .npy files in a
+                directory named as the database without the .npz suffix, which
+                :meth:`load_database` will memory map. Takes more disk space, but loads
+                almost instantly and without reading the whole database into memory. If False,
+                such a directory is removed so the new .npz file is the one loaded.
+
+        Example:
+            ::
+
+                # Convert an existing database to the memory mapped format
+                t3 = tetra3.Tetra3('default_database')
+                t3.save_database('default_database', mmap=True)
         """
         assert self.has_database, 'No database'
         self._logger.debug('Got save database with: ' + str(path))
         if isinstance(path, str):
             self._logger.debug('String given, append to tetra3 directory')
-            path = (Path(__file__).parent / path).with_suffix('.npz')
+            path = _npz_path(Path(__file__).parent / path)
         else:
             self._logger.debug('Not a string, use as path directly')
-            path = Path(path).with_suffix('.npz')
+            path = _npz_path(path)
             
         self._logger.info('Saving database to: ' + str(path))
         # Pack properties as numpy structured array
@@ -382,14 +721,40 @@ class Tetra3():
                                        ('star_max_magnitude', np.float32),
                                        ('star_min_separation', np.float32)])
         self._logger.debug('Packed properties into: ' + str(props_packed))
-        self._logger.debug('Saving as compressed numpy archive')
-        np.savez_compressed(path, star_table=self.star_table,
-                            pattern_catalog=self.pattern_catalog, props_packed=props_packed)
+        arrays = {'star_table': self.star_table, 'pattern_catalog': self.pattern_catalog,
+                  'pattern_keys': self.pattern_keys, 'sky_index_bins': self._sky_index[0],
+                  'sky_index_stars': self._sky_index[1], 'sky_index_cells': self._sky_index[2],
+                  'sky_index_starts': self._sky_index[3], 'props_packed': props_packed}
+        if mmap:
+            path = path.with_name(path.stem)
+            self._logger.debug('Saving as directory of numpy arrays: ' + str(path))
+            path.mkdir(parents=True, exist_ok=True)
+            for (name, array) in arrays.items():
+                # write to a new file, the old one may be memory mapped by this or other processes
+                temp_file = path / (name + '.npy.tmp')
+                with open(temp_file, 'wb') as f:
+                    np.save(f, array)
+                temp_file.replace(path / (name + '.npy'))
+        else:
+            self._logger.debug('Saving as compressed numpy archive')
+            np.savez_compressed(path, **arrays)
+            if path.with_name(path.stem).is_dir():
+                # a memory mapped copy would be loaded instead of the archive
+                self._logger.info('Removing old memory mapped database: '
+                                  + str(path.with_name(path.stem)))
+                shutil.rmtree(path.with_name(path.stem))
 
     def generate_database(self, max_fov, save_as=None, star_catalog='bsc5', pattern_stars_per_fov=10,
                           verification_stars_per_fov=20, star_max_magnitude=7,
-                          star_min_separation=.05, pattern_max_error=.005):
-        """Create a database and optionally save to file. Typically takes 5 to 30 minutes.
+                          star_min_separation=.05, pattern_max_error=.005, num_workers=None,
+                          checkpoint=None):
+        """Create a database and optionally save to file. Typically takes a few minutes.
+
+        The patterns are found in parallel for different regions of the sky using `num_workers`
+        processes. Progress is logged, and if a `checkpoint` file is given the patterns found so
+        far are saved to it regularly so an interrupted build can be resumed by calling this
+        method again with the same arguments. The result is identical whatever the number of
+        workers and whether or not the build was resumed.
 
         Note:
             If you wish to build you own database (typically for a different field-of-view) you must
@@ -420,6 +785,10 @@ class Tetra3():
             star_min_separation (float, optional): Smallest separation (in degrees) allowed between
                 stars (to remove doubles).
             pattern_max_error (float, optional): Maximum difference allowed in pattern for a match.
+            num_workers (int, optional): Number of processes used to find patterns. If None (the
+                default) one per CPU is used, if 1 everything runs in this process.
+            checkpoint (str or pathlib.Path, optional): File to save progress to while finding
+                patterns, and to resume from if it exists. Removed when the database is finished.
 
         Example:
             ::
@@ -434,7 +803,8 @@ class Tetra3():
         self._logger.debug('Got generate pattern catalogue with input: '
                            + str((max_fov, save_as, star_catalog, pattern_stars_per_fov,
                                   verification_stars_per_fov, star_max_magnitude,
-                                  star_min_separation, pattern_max_error)))
+                                  star_min_separation, pattern_max_error, num_workers,
+                                  checkpoint)))
 
         assert star_catalog in _supported_databases, 'Star catalogue name must be one of: ' \
              + str(_supported_databases)
@@ -443,6 +813,11 @@ class Tetra3():
         verification_stars_per_fov = int(verification_stars_per_fov)
         star_max_magnitude = float(star_max_magnitude)
         star_min_separation = float(star_min_separation)
+        if num_workers is None:
+            num_workers = os.cpu_count() or 1
+        num_workers = int(num_workers)
+        if checkpoint is not None:
+            checkpoint = _npz_path(checkpoint)
         pattern_size = 4
         pattern_bins = 25
         current_year = datetime.utcnow().year
@@ -476,12 +851,13 @@ class Tetra3():
             with open(catalog_file_full_pathname, 'rb') as star_catalog_file:
                 star_catalog_file.seek(header_length)  # skip header
                 reader = np.fromfile(star_catalog_file, dtype=bsc5_data_type, count=num_entries)
-                for (i, entry) in enumerate(reader):  # star_num in range(num_entries):
-                    mag = entry[4]/100
-                    if mag <= star_max_magnitude:
-                        ra  = entry[1] + entry[5] * (current_year - 1950)
-                        dec = entry[2] + entry[6] * (current_year - 1950)
-                        star_table[i,:] = ([ra, dec, 0, 0, 0, mag])
+            mag = reader['mag']/100
+            kept = mag <= star_max_magnitude
+            star_table[kept, 0] = reader['RA1950'][kept] \
+                + reader['RA_pm'][kept] * (current_year - 1950)
+            star_table[kept, 1] = reader['Dec1950'][kept] \
+                + reader['Dec_PM'][kept] * (current_year - 1950)
+            star_table[kept, 5] = mag[kept]
         elif star_catalog in ('hip_main', 'tyc_main'):
             incomplete_entries = 0
             with open(catalog_file_full_pathname, 'r') as star_catalog_file:
@@ -494,10 +870,10 @@ class Tetra3():
                         continue
                     mag = float(entry[5])
                     if mag is not None and mag <= star_max_magnitude:
-                        pmRA = np.float(entry[12])/1000/60/60  # convert milliarcseconds per year to degrees per year
-                        ra  = np.deg2rad(np.float(entry[8]) + pmRA * (current_year - 1991.25))
-                        pmDec = np.float(entry[13])/1000/60/60  # convert milliarcseconds per year to degrees per year
-                        dec = np.deg2rad(np.float(entry[9]) + pmDec * (current_year - 1991.25))
+                        pmRA = float(entry[12])/1000/60/60  # convert milliarcseconds per year to degrees per year
+                        ra  = np.deg2rad(float(entry[8]) + pmRA * (current_year - 1991.25))
+                        pmDec = float(entry[13])/1000/60/60  # convert milliarcseconds per year to degrees per year
+                        dec = np.deg2rad(float(entry[9]) + pmDec * (current_year - 1991.25))
                         star_table[i,:] = ([ra, dec, 0, 0, 0, mag])
                 if incomplete_entries:
                     self._logger.info('Skipped %i incomplete entries.' % incomplete_entries)
@@ -512,39 +888,64 @@ class Tetra3():
             + str(star_max_magnitude) + '.')
 
         # Calculate star direction vectors:
-        for i in range(0, num_entries):
-            vector = np.array([np.cos(star_table[i,0])*np.cos(star_table[i,1]),
-                               np.sin(star_table[i,0])*np.cos(star_table[i,1]),
-                               np.sin(star_table[i,1])])
-            star_table[i,2:5] = vector
-                
+        star_table[:, 2] = np.cos(star_table[:, 0]) * np.cos(star_table[:, 1])
+        star_table[:, 3] = np.sin(star_table[:, 0]) * np.cos(star_table[:, 1])
+        star_table[:, 4] = np.sin(star_table[:, 1])
+
         # Filter for maximum number of stars in FOV and doubles
-        keep_for_patterns = [False] * star_table.shape[0]
-        keep_for_verifying = [False] * star_table.shape[0]
+        # Stars are taken in order of brightness and only compared with the stars kept so far which
+        # are close enough to matter, looked up in coarse sky maps of the kept stars
+        keep_for_patterns = np.zeros(num_entries, dtype=bool)
+        keep_for_verifying = np.zeros(num_entries, dtype=bool)
         all_star_vectors = star_table[:, 2:5].transpose()
-        # Keep the first one and skip index 0 in loop
-        keep_for_patterns[0] = True
-        keep_for_verifying[0] = True
-        for star_ind in range(1, star_table.shape[0]):
+        filter_radius = max(max_fov/2, np.deg2rad(star_min_separation))
+        filter_bins = max(1, int(1 / filter_radius))
+        kept_patterns_map = {}
+        kept_verifying_map = {}
+
+        def kept_nearby_stars(kept_map, vector):
+            """Get kept stars which may be within filter_radius of the vector."""
+            hash_code_space = [range(max(low, 0), high+1) for (low, high)
+                               in zip(((vector + 1 - filter_radius) * filter_bins).astype(int),
+                                      ((vector + 1 + filter_radius) * filter_bins).astype(int))]
+            return [star_id for hash_code in itertools.product(*hash_code_space)
+                    for star_id in kept_map.get(hash_code, ())]
+
+        progress_step = max(1, num_entries // 10)
+        for star_ind in range(num_entries):
+            if star_ind % progress_step == 0 and star_ind > 0:
+                self._logger.info('Filtering stars: %i of %i done.' % (star_ind, num_entries))
             vector = star_table[star_ind, 2:5]
-            # Angle to all stars we have kept
-            angs_patterns = np.dot(vector, all_star_vectors[:, keep_for_patterns])
-            angs_verifying = np.dot(vector, all_star_vectors[:, keep_for_verifying])
-            # Check double star limit as well as stars-per-fov limit
-            if star_min_separation is None \
-                    or all(angs_patterns < np.cos(np.deg2rad(star_min_separation))):
-                num_stars_in_fov = sum(angs_patterns > np.cos(max_fov/2))
-                if num_stars_in_fov < pattern_stars_per_fov:
-                    # Only keep if not too many close by already
-                    keep_for_patterns[star_ind] = True
-                    keep_for_verifying[star_ind] = True
-            # Secondary stars-per-fov check, if we fail this we will not keep the star at all
-            if star_min_separation is None \
-                    or all(angs_verifying < np.cos(np.deg2rad(star_min_separation))):
-                num_stars_in_fov = sum(angs_verifying > np.cos(max_fov/2))
-                if num_stars_in_fov < verification_stars_per_fov:
-                    # Only keep if not too many close by already
-                    keep_for_verifying[star_ind] = True
+            if star_ind == 0:
+                # Keep the first one
+                keep_for_patterns[0] = True
+                keep_for_verifying[0] = True
+            else:
+                # Angle to all stars we have kept nearby
+                angs_patterns = np.dot(vector, all_star_vectors[
+                                            :, kept_nearby_stars(kept_patterns_map, vector)])
+                angs_verifying = np.dot(vector, all_star_vectors[
+                                            :, kept_nearby_stars(kept_verifying_map, vector)])
+                # Check double star limit as well as stars-per-fov limit
+                if star_min_separation is None \
+                        or all(angs_patterns < np.cos(np.deg2rad(star_min_separation))):
+                    num_stars_in_fov = sum(angs_patterns > np.cos(max_fov/2))
+                    if num_stars_in_fov < pattern_stars_per_fov:
+                        # Only keep if not too many close by already
+                        keep_for_patterns[star_ind] = True
+                        keep_for_verifying[star_ind] = True
+                # Secondary stars-per-fov check, if we fail this we will not keep the star at all
+                if star_min_separation is None \
+                        or all(angs_verifying < np.cos(np.deg2rad(star_min_separation))):
+                    num_stars_in_fov = sum(angs_verifying > np.cos(max_fov/2))
+                    if num_stars_in_fov < verification_stars_per_fov:
+                        # Only keep if not too many close by already
+                        keep_for_verifying[star_ind] = True
+            hash_code = tuple(((vector + 1) * filter_bins).astype(int))
+            if keep_for_patterns[star_ind]:
+                kept_patterns_map.setdefault(hash_code, []).append(star_ind)
+            if keep_for_verifying[star_ind]:
+                kept_verifying_map.setdefault(hash_code, []).append(star_ind)
         # Trim down star table and update indexing for pattern stars
         star_table = star_table[keep_for_verifying, :]
         pattern_stars = (np.cumsum(keep_for_verifying)-1)[keep_for_patterns]
@@ -557,83 +958,117 @@ class Tetra3():
         self._logger.debug('Building temporary hash table for finding pattern neighbours')
         temp_coarse_sky_map = {}
         temp_bins = 4
-        # insert the stars into the hash table
+        # insert the stars into the hash table, in order of brightness
         for star_id in pattern_stars:
             vector = star_table[star_id, 2:5]
             # find which partition the star occupies in the hash table
-            hash_code = tuple(((vector+1)*temp_bins).astype(np.int))
-            # if the partition is empty, create a new list to hold the star
-            # if the partition already contains stars, add the star to the list
-            temp_coarse_sky_map[hash_code] = temp_coarse_sky_map.pop(hash_code, []) + [star_id]
-
-        def temp_get_nearby_stars(vector, radius):
-            """Get nearby from temporary hash table."""
-            # create list of nearby stars
-            nearby_star_ids = []
-            # given error of at most radius in each dimension, compute the space of hash codes
-            hash_code_space = [range(max(low, 0), min(high+1, 2*temp_bins)) for (low, high)
-                               in zip(((vector + 1 - radius) * temp_bins).astype(np.int),
-                                      ((vector + 1 + radius) * temp_bins).astype(np.int))]
-            # iterate over hash code space
-            for hash_code in itertools.product(*hash_code_space):
-                # iterate over the stars in the given partition, adding them to
-                # the nearby stars list if they're within range of the vector
-                for star_id in temp_coarse_sky_map.get(hash_code, []):
-                    if np.dot(vector, star_table[star_id, 2:5]) > np.cos(radius):
-                        nearby_star_ids.append(star_id)
-            return nearby_star_ids
-
-        # generate pattern catalog
-        self._logger.info('Generating all possible patterns.')
-        pattern_list = []
-        # initialize pattern, which will contain pattern_size star ids
-        pattern = [None] * pattern_size
-        for pattern[0] in pattern_stars:  # star_ids_filtered:
-            vector = star_table[pattern[0], 2:5]
-            # find which partition the star occupies in the sky hash table
-            hash_code = tuple(((vector+1)*temp_bins).astype(np.int))
-            # remove the star from the sky hash table
-            temp_coarse_sky_map[hash_code].remove(pattern[0])
-            # iterate over all possible patterns containing the removed star
-            for pattern[1:] in itertools.combinations(temp_get_nearby_stars(vector, max_fov),
-                                                      pattern_size-1):
-                # retrieve the vectors of the stars in the pattern
-                vectors = star_table[pattern, 2:5]
-                # verify that the pattern fits within the maximum field-of-view
-                # by checking the distances between every pair of stars in the pattern
-                if all(np.dot(*star_pair) > np.cos(max_fov)
-                        for star_pair in itertools.combinations(vectors, 2)):
-                    pattern_list.append(pattern.copy())
+            hash_code = tuple(((vector+1)*temp_bins).astype(int))
+            temp_coarse_sky_map.setdefault(hash_code, []).append(star_id)
+        temp_coarse_sky_map = {hash_code: np.array(star_ids, dtype=np.int64)
+                               for (hash_code, star_ids) in temp_coarse_sky_map.items()}
+
+        # generate pattern catalog, each region (partition) of the sky map is one task
+        regions = sorted(temp_coarse_sky_map.keys())
+        found_patterns = {}
+        checkpoint_id = repr((star_catalog, float(max_fov), pattern_stars_per_fov,
+                              verification_stars_per_fov, star_max_magnitude, star_min_separation,
+                              pattern_size, current_year, star_table.shape[0],
+                              len(pattern_stars)))
+        if checkpoint is not None and checkpoint.exists():
+            with np.load(checkpoint) as data:
+                if str(data['checkpoint_id']) == checkpoint_id:
+                    lengths = np.cumsum(data['region_lengths'])[:-1]
+                    for (region, patterns) in zip(data['regions'],
+                                                  np.split(data['patterns'], lengths)):
+                        found_patterns[tuple(int(x) for x in region)] = patterns
+                    self._logger.info('Resuming from checkpoint ' + str(checkpoint) + ' with '
+                                      + str(len(found_patterns)) + ' sky regions done.')
+                else:
+                    self._logger.info('Ignoring checkpoint ' + str(checkpoint)
+                                      + ' made with other settings.')
+
+        def save_checkpoint():
+            self._logger.debug('Saving checkpoint to ' + str(checkpoint))
+            done = list(found_patterns.keys())
+            np.savez(checkpoint, checkpoint_id=checkpoint_id,
+                     regions=np.array(done, dtype=np.int64).reshape((-1, 3)),
+                     region_lengths=np.array([len(found_patterns[r]) for r in done],
+                                             dtype=np.int64),
+                     patterns=np.concatenate([np.empty((0, pattern_size), dtype=np.int64)]
+                                             + [found_patterns[r] for r in done]))
+
+        todo = [region for region in regions if region not in found_patterns]
+        self._logger.info('Generating all possible patterns in ' + str(len(todo))
+                          + ' sky regions with ' + str(num_workers) + ' processes.')
+        worker_args = (star_table[:, 2:5], temp_coarse_sky_map, temp_bins, max_fov, pattern_size)
+        if num_workers > 1 and len(todo) > 1:
+            pool = multiprocessing.Pool(num_workers, initializer=_init_pattern_worker,
+                                        initargs=worker_args)
+            results = pool.imap_unordered(_find_patterns_in_region, todo)
+        else:
+            pool = None
+            _init_pattern_worker(*worker_args)
+            results = map(_find_patterns_in_region, todo)
+        try:
+            last_checkpoint = precision_timestamp()
+            progress_step = max(1, len(todo) // 10)
+            for (num_done, (region, patterns)) in enumerate(results, start=1):
+                found_patterns[region] = patterns
+                if num_done % progress_step == 0 or num_done == len(todo):
+                    self._logger.info('Generating patterns: %i of %i sky regions done.'
+                                      % (num_done, len(todo)))
+                if checkpoint is not None \
+                        and precision_timestamp() - last_checkpoint > _CHECKPOINT_INTERVAL:
+                    save_checkpoint()
+                    last_checkpoint = precision_timestamp()
+        except BaseException:
+            if checkpoint is not None:
+                save_checkpoint()
+            raise
+        finally:
+            if pool is not None:
+                pool.terminate()
+        # patterns in the order of their first star, as when removing each star in turn
+        pattern_list = np.concatenate([np.empty((0, pattern_size), dtype=np.int64)]
+                                      + [found_patterns[region] for region in regions])
+        pattern_list = pattern_list[np.argsort(pattern_list[:, 0], kind='stable'), :]
 
         self._logger.info('Found ' + str(len(pattern_list)) + ' patterns. Building catalogue.')
         catalog_length = 2 * len(pattern_list)
         pattern_catalog = np.zeros((catalog_length, pattern_size), dtype=np.uint16)
-        for pattern in pattern_list:
-            # retrieve the vectors of the stars in the pattern
-            vectors = star_table[pattern, 2:5]
-            # calculate and sort the edges of the star pattern
-            edges = np.sort([np.sqrt((np.subtract(*star_pair)**2).sum())
-                             for star_pair in itertools.combinations(vectors, 2)])
-            # extract the largest edge
-            largest_edge = edges[-1]
-            # divide the edges by the largest edge to create dimensionless ratios
-            edge_ratios = edges[:-1] / largest_edge
-            # convert edge ratio float to hash code by binning
-            hash_code = tuple((edge_ratios * pattern_bins).astype(np.int))
-            hash_index = _key_to_index(hash_code, pattern_bins, pattern_catalog.shape[0])
-            # use quadratic probing to find an open space in the pattern catalog to insert
-            for index in ((hash_index + offset ** 2) % pattern_catalog.shape[0]
-                          for offset in itertools.count()):
+        # calculate the edge ratio keys of all patterns and their hash indices in bulk
+        pattern_keys = _compute_pattern_keys(star_table, pattern_list, pattern_bins)
+        hash_indices = _keys_to_indices(pattern_keys, catalog_length)
+        # use quadratic probing to find an open space in the pattern catalog to insert, in the
+        # order the patterns were found (a slot is open if the first star of the pattern in it
+        # has id zero, so such patterns are overwritten by any later pattern probing the slot)
+        occupied = bytearray(catalog_length)
+        slots = []
+        for (hash_index, occupies) in zip(hash_indices.tolist(),
+                                          (pattern_list[:, 0] != 0).tolist()):
+            for offset in itertools.count():
+                index = (hash_index + offset ** 2) % catalog_length
                 # if the current slot is empty, add the pattern
-                if not pattern_catalog[index][0]:
-                    pattern_catalog[index] = pattern
+                if not occupied[index]:
+                    slots.append(index)
+                    occupied[index] = occupies
                     break
+        # only the last pattern written to each slot remains
+        slots = np.array(slots, dtype=np.int64)
+        (_, last) = np.unique(slots[::-1], return_index=True)
+        last = len(slots) - 1 - last
+        pattern_catalog[slots[last], :] = pattern_list[last, :]
+        catalog_keys = np.full(catalog_length, np.iinfo(pattern_keys.dtype).max,
+                               dtype=pattern_keys.dtype)
+        catalog_keys[slots[last]] = pattern_keys[last]
         self._logger.info('Finished generating database.')
         self._logger.info('Size of uncompressed star table: %i Bytes.' %star_table.nbytes)
         self._logger.info('Size of uncompressed pattern catalog: %i Bytes.' %pattern_catalog.nbytes)
 
         self._star_table = star_table
         self._pattern_catalog = pattern_catalog
+        self._pattern_keys = catalog_keys
+        self._sky_index = _build_sky_index(star_table[:, 2:5], np.rad2deg(max_fov))
         self._db_props['pattern_mode'] = 'edge_ratio'
         self._db_props['pattern_size'] = pattern_size
         self._db_props['pattern_bins'] = pattern_bins
@@ -644,22 +1079,25 @@ class Tetra3():
         self._db_props['star_max_magnitude'] = star_max_magnitude
         self._db_props['star_min_separation'] = star_min_separation
         self._logger.debug(self._db_props)
+        self._databases = [self._current_database()]
 
         if save_as is not None:
             self._logger.debug('Saving generated database as: ' + str(save_as))
             self.save_database(save_as)
         else:
             self._logger.info('Skipping database file generation.')
+        if checkpoint is not None and checkpoint.exists():
+            checkpoint.unlink()
 
     def solve_from_image(self, image, fov_estimate=None, fov_max_error=None,
                          pattern_checking_stars=6, match_radius=.01, match_threshold=1e-9,
-                         **kwargs):
+                         fov_refine=False, previous_solution=None, **kwargs):
         """Solve for the sky location of an image.
 
         Star locations (centroids) are found using :meth:`tetra3.get_centroids_from_image` and
-        keyword arguments are passed along to this method. Every combination of the
-        `pattern_checking_stars` (default 6) brightest stars found is checked against the database
-        before giving up.
+        keyword arguments are passed along to this method. The centroids are then solved for
+        with :meth:`solve_from_centroids`, see there for how the patterns are checked and how the
+        database is chosen if a set of databases is loaded.
 
         Example:
             ::
@@ -680,6 +1118,12 @@ class Tetra3():
                 as a fraction of the image field of view.
             match_threshold (float, optional): Maximum allowed mismatch probability to consider
                 a tested pattern a valid match.
+            fov_refine (bool, optional): If True, refine the field of view of each candidate match
+                by least squares optimisation after the direct estimate from the pattern edges.
+                Slower, default False.
+            previous_solution (dict, optional): Solution of a previous image of the same field,
+                e.g. the last frame of a live view. If given, the image is first tracked from it,
+                see :meth:`solve_from_centroids`.
             **kwargs (optional): Other keyword arguments passed to
                 :meth:`tetra3.get_centroids_from_image`.
 
@@ -694,226 +1138,469 @@ class Tetra3():
                 - 'Prob': Probability that the solution is a mismatch.
                 - 'T_solve': Time spent searching for a match in milliseconds.
                 - 'T_extract': Time spent exctracting star centroids in milliseconds.
+                - 'Trials': Number of candidate pattern matches verified, 0 if tracked.
 
                 If unsuccsessful in finding a match,  None is returned for all keys of the
-                dictionary except 'T_solve' and 'T_exctract'.
+                dictionary except 'T_solve', 'T_exctract' and 'Trials'.
         """
         assert self.has_database, 'No database loaded'
         image = np.asarray(image)
-        if fov_estimate is None:
-            fov_estimate = np.deg2rad(self._db_props['max_fov'])
-        else:
-            fov_estimate = np.deg2rad(float(fov_estimate))
+        # Run star extraction, passing kwargs along
+        t0_extract = precision_timestamp()
+        star_centroids = self.get_centroids(image, **kwargs)
+        t_extract = (precision_timestamp() - t0_extract)*1000
+        solution = self.solve_from_centroids(star_centroids, image.shape[0:2],
+                                             fov_estimate=fov_estimate,
+                                             fov_max_error=fov_max_error,
+                                             pattern_checking_stars=pattern_checking_stars,
+                                             match_radius=match_radius,
+                                             match_threshold=match_threshold,
+                                             fov_refine=fov_refine,
+                                             previous_solution=previous_solution)
+        solution['T_extract'] = t_extract
+        return solution
+
+    def get_centroids(self, image, max_returned=None, track_background=False, **kwargs):
+        """Find the star centroids in an image to solve with :meth:`solve_from_centroids`.
+
+        Runs :meth:`tetra3.get_centroids_from_image`, returning as many stars as are needed for
+        verification with any of the loaded databases. This is the star extraction done by
+        :meth:`solve_from_image`, separate so extraction and solving can run in different threads
+        or processes.
+
+        Args:
+            image (numpy.ndarray): The image to find the stars in.
+            max_returned (int, optional): Number of brightest stars to return instead, e.g. for
+                another solver.
+            track_background (bool, optional): If True, the image is the next frame of a live
+                sequence and is thresholded against this instance's
+                :class:`tetra3.BackgroundModel`, which is created by the first such call.
+            **kwargs (optional): Other keyword arguments passed to
+                :meth:`tetra3.get_centroids_from_image`.
+
+        Returns:
+            numpy.ndarray: (N,2) list of (y, x) centroids, ordered by brightest first.
+        """
+        if max_returned is None:
+            max_returned = self.verification_stars
+        if track_background:
+            if self._background_model is None:
+                self._background_model = BackgroundModel()
+            kwargs['background_model'] = self._background_model
+        return get_centroids_from_image(np.asarray(image), max_returned=max_returned, **kwargs)
+
+    def solve_from_centroids(self, star_centroids, size, fov_estimate=None, fov_max_error=None,
+                             pattern_checking_stars=6, match_radius=.01, match_threshold=1e-9,
+                             fov_refine=False, previous_solution=None):
+        """Solve for the sky location of star centroids found in an image.
+
+        Every combination of the `pattern_checking_stars` (default 6) brightest stars is checked
+        against the database before giving up. The hash lookups and edge ratio tests for all these
+        patterns are done together as arrays, only the catalog patterns passing the edge ratio
+        test are fitted and verified one by one.
+
+        If a set of databases is loaded (see :meth:`load_database`) the one built for the smallest
+        field of view which is at least `fov_estimate` is tried first. Only if that fails are the
+        neighbouring databases in the set, built for the next larger and the next smaller field of
+        view, tried in turn. Without `fov_estimate` the database for the largest field of view is
+        tried first.
+
+        If a `previous_solution` is given, the cheaper :meth:`track_from_centroids` is tried first
+        and the full solve is only done if that fails.
+
+        Args:
+            star_centroids (numpy.ndarray): (N,2) list of centroids, ordered by brightest first.
+                Each row is the (y, x) position of the star measured from the top left corner,
+                as returned by :meth:`tetra3.get_centroids_from_image`.
+            size (tuple): (height, width) of the image the centroids are from in pixels.
+            fov_estimate (float, optional): Estimated field of view of the image in degrees.
+            fov_max_error (float, optional): Maximum difference in field of view from the estimate
+                allowed for a match in degrees.
+            pattern_checking_stars (int, optional): Number of stars used to create possible
+                patterns to look up in database.
+            match_radius (float, optional): Maximum distance to a star to be considered a match
+                as a fraction of the image field of view.
+            match_threshold (float, optional): Maximum allowed mismatch probability to consider
+                a tested pattern a valid match.
+            fov_refine (bool, optional): If True, refine the field of view of each candidate match
+                by least squares optimisation after the direct estimate from the pattern edges.
+                Slower, default False.
+            previous_solution (dict, optional): Solution of a previous image of the same field to
+                track from.
+
+        Returns:
+            dict: A dictionary with the same keys as returned by :meth:`solve_from_image`, except
+                'T_extract'.
+        """
+        assert self.has_database, 'No database loaded'
+        self._trials = 0
+        if fov_estimate is not None:
+            fov_estimate = float(fov_estimate)
         if fov_max_error is not None:
             fov_max_error = np.deg2rad(float(fov_max_error))
         match_radius = float(match_radius)
         match_threshold = float(match_threshold)
         pattern_checking_stars = int(pattern_checking_stars)
-
-        # extract height (y) and width (x) of image
-        height, width = image.shape[0:2]
-        # Extract relevant database properties
-        num_stars = self._db_props['verification_stars_per_fov']
-        p_size = self._db_props['pattern_size']
-        p_bins = self._db_props['pattern_bins']
-        p_max_err = self._db_props['pattern_max_error']
-        # Run star extraction, passing kwargs along
-        t0_extract = precision_timestamp()
-        star_centroids = get_centroids_from_image(image, max_returned=num_stars, **kwargs)
-        t_extract = (precision_timestamp() - t0_extract)*1000
-
-        def compute_vectors(star_centroids, fov):
-            """Get unit vectors from star centroids (pinhole camera)."""
-            # compute list of (i,j,k) vectors given list of (y,x) star centroids and
-            # an estimate of the image's field-of-view in the x dimension
-            # by applying the pinhole camera equations
-            center_x = width / 2.
-            center_y = height / 2.
-            scale_factor = np.tan(fov / 2) / center_x
-            star_vectors = []
-            for (star_y, star_x) in star_centroids:
-                j_over_i = (center_x - star_x) * scale_factor
-                k_over_i = (center_y - star_y) * scale_factor
-                i = 1. / np.sqrt(1 + j_over_i**2 + k_over_i**2)
-                j = j_over_i * i
-                k = k_over_i * i
-                vec = np.array([i, j, k])
-                star_vectors.append(vec)
-            return star_vectors
+        fov_refine = bool(fov_refine)
+        star_centroids = np.asarray(star_centroids, dtype=np.float64).reshape((-1, 2))
+        (height, width) = size[0:2]
 
         t0_solve = precision_timestamp()
-        for image_centroids in _generate_patterns_from_centroids(
-                                            star_centroids[:pattern_checking_stars], p_size):
-            # compute star vectors using an estimate for the field-of-view in the x dimension
-            pattern_star_vectors = compute_vectors(image_centroids, fov_estimate)
-            # calculate and sort the edges of the star pattern
-            pattern_edges = np.sort([norm(np.subtract(
-                *star_pair)) for star_pair in itertools.combinations(pattern_star_vectors, 2)])
-            # extract the largest edge
-            pattern_largest_edge = pattern_edges[-1]
-            # divide the pattern's edges by the largest edge to create dimensionless ratios
-            pattern_edge_ratios = pattern_edges[:-1] / pattern_largest_edge
-            # Pssible hash codes to look up
-            hash_code_space = [range(max(low, 0), min(high+1, p_bins)) for (low, high)
-                               in zip(((pattern_edge_ratios - p_max_err) * p_bins).astype(np.int),
-                                      ((pattern_edge_ratios + p_max_err) * p_bins).astype(np.int))]
-            # iterate over hash code space, only looking up non-duplicate codes
-            for hash_code in set(tuple(sorted(code))
-                                 for code in itertools.product(*hash_code_space)):
-                hash_code = tuple(hash_code)
-                hash_index = _key_to_index(hash_code, p_bins, self.pattern_catalog.shape[0])
-                matches = _get_at_index(hash_index, self.pattern_catalog)
-                if len(matches) == 0:
-                    continue
-
-                for match_row in matches:
-                    # retrieve the vectors of the stars in the catalog pattern
-                    catalog_vectors = self.star_table[match_row, 2:5]
-                    # calculate and sort the edges of the star pattern
-                    catalog_edges = np.sort([norm(np.subtract(*star_pair)) for star_pair
-                                            in itertools.combinations(catalog_vectors, 2)])
-                    # extract the largest edge
-                    catalog_largest_edge = catalog_edges[-1]
-                    # divide the edges by the largest edge to create dimensionless ratios
-                    catalog_edge_ratios = catalog_edges[:-1] / catalog_largest_edge
-                    # check if match is within the given maximum allowable error
-                    # note that this also filters out star patterns from colliding bins
-                    if any([abs(val) > p_max_err for val in (catalog_edge_ratios
-                                                             - pattern_edge_ratios)]):
-                        continue
-                    # compute the actual field-of-view using least squares optimization
-                    # compute the catalog pattern's edges for error estimation
-                    catalog_edges = np.append(catalog_edge_ratios * catalog_largest_edge,
-                                              catalog_largest_edge)
-                    # helper function that calculates a list of errors in pattern edge lengths
-                    # with the catalog edge lengths for a given fov
-
-                    def fov_to_error(fov):
-                        # recalculate the pattern's star vectors given the new fov
-                        pattern_star_vectors = compute_vectors(
-                            image_centroids, fov)
-                        # recalculate the pattern's edge lengths
-                        pattern_edges = np.sort([norm(np.subtract(*star_pair)) for star_pair
-                                                in itertools.combinations(pattern_star_vectors,
-                                                                          2)])
-                        # return a list of errors, one for each edge
-                        return catalog_edges - pattern_edges
-                    # find the fov that minimizes the squared error, starting with the estimate
-                    fov = scipy.optimize.leastsq(fov_to_error, fov_estimate)[0][0]
-
-                    # If the FOV is incorrect we can skip this immediately
-                    if fov_max_error is not None and abs(fov - fov_estimate) > fov_max_error:
-                        continue
-
-                    # Recalculate vectors and uniquely sort them by distance from centroid
-                    pattern_star_vectors = compute_vectors(image_centroids, fov)
-                    # find the centroid, or average position, of the star pattern
-                    pattern_centroid = np.mean(pattern_star_vectors, axis=0)
-                    # calculate each star's radius, or Euclidean distance from the centroid
-                    pattern_radii = [norm(star_vector - pattern_centroid)
-                                     for star_vector in pattern_star_vectors]
-                    # use the radii to uniquely order the pattern's star vectors so they can be
-                    # matched with the catalog vectors
-                    pattern_sorted_vectors = np.array(pattern_star_vectors)[
-                                                                       np.argsort(pattern_radii)]
-                    # find the centroid, or average position, of the star pattern
-                    catalog_centroid = np.mean(catalog_vectors, axis=0)
-                    # calculate each star's radius, or Euclidean distance from the centroid
-                    catalog_radii = [norm(vector - catalog_centroid) for vector in catalog_vectors]
-                    # use the radii to uniquely order the catalog vectors
-                    catalog_sorted_vectors = catalog_vectors[np.argsort(catalog_radii)]
-
-                    # calculate the least-squares rotation matrix from catalog to image frame
-                    def find_rotation_matrix(image_vectors, catalog_vectors):
-                        # find the covariance matrix H between the image and catalog vectors
-                        H = np.sum([np.dot(image_vectors[i].reshape((3, 1)),
-                                           catalog_vectors[i].reshape((1, 3)))
-                                    for i in range(len(image_vectors))], axis=0)
-                        # use singular value decomposition to find the rotation matrix
-                        (U, S, V) = np.linalg.svd(H)
-                        rotation_matrix = np.dot(U, V)
-                        # correct reflection matrix if determinant is -1 instead of 1
-                        # by flipping the sign of the third column of the rotation matrix
-                        rotation_matrix[:, 2] *= np.linalg.det(rotation_matrix)
-                        return rotation_matrix
-
-                    # Use the pattern match to find an estimate for the image's rotation matrix
-                    rotation_matrix = find_rotation_matrix(pattern_sorted_vectors,
-                                                           catalog_sorted_vectors)
-                    # calculate all star vectors using the new field-of-view
-                    all_star_vectors = compute_vectors(star_centroids, fov)
-                    rotated_star_vectors = np.array([np.dot(rotation_matrix.T, star_vector)
-                                                     for star_vector in all_star_vectors])
-                    # Find all star vectors inside the (diagonal) field of view for matching
-                    image_center_vector = rotation_matrix[0, :]
-                    fov_diagonal_rad = fov * np.sqrt(width**2 + height**2) / width
-                    nearby_star_vectors = self.star_table[
-                            self._get_nearby_stars(image_center_vector, fov_diagonal_rad/2), 2:5]
-                    # Match the nearby star vectors to the proposed measured star vectors
-                    match_tuples = []
-                    for ind, measured_vec in enumerate(rotated_star_vectors):
-                        within_match_radius = (np.dot(measured_vec.reshape((1, 3)),
-                                                      nearby_star_vectors.transpose())
-                                               > np.cos(match_radius * fov)).flatten()
-                        if sum(within_match_radius) == 1:  # If exactly one matching star:
-                            match_ind = within_match_radius.nonzero()[0][0]
-                            match_tuples.append((all_star_vectors[ind],
-                                                 nearby_star_vectors[match_ind]))
-                    # Statistical reasoning for probability that current match is incorrect:
-                    num_extracted_stars = len(all_star_vectors)
-                    num_nearby_catalog_stars = len(nearby_star_vectors)
-                    num_star_matches = len(match_tuples)
-                    # Probability that a single star is a mismatch
-                    prob_single_star_mismatch = \
-                        1 - (1 - num_nearby_catalog_stars * match_radius**2)
-                    # Two matches can always be made using the degrees of freedom of the pattern
-                    prob_mismatch = scipy.stats.binom.cdf(num_extracted_stars
-                                                          - (num_star_matches - 2),
-                                                          num_extracted_stars,
-                                                          1 - prob_single_star_mismatch)
-                    if prob_mismatch < match_threshold:
-                        # Solved in this time
-                        t_solve = (precision_timestamp() - t0_solve)*1000
-                        # diplay mismatch probability in scientific notation
-                        self._logger.debug("NEW P: %.4g" % prob_mismatch)
-                        # if a match has been found, recompute rotation with all matched vectors
-                        rotation_matrix = find_rotation_matrix(*zip(*match_tuples))
-                        # Residuals calculation
-                        measured_vs_catalog = [(np.dot(rotation_matrix.T, pair[0]), pair[1])
-                                               for pair in match_tuples]
-                        angles = np.arcsin([norm(np.cross(m, c)) / norm(m) / norm(c)
-                                            for (m, c) in measured_vs_catalog])
-                        residual = np.rad2deg(np.sqrt(np.mean(angles**2))) * 3600
-                        # extract right ascension, declination, and roll from rotation matrix
-                        ra = np.rad2deg(np.arctan2(rotation_matrix[0, 1],
-                                                   rotation_matrix[0, 0])) % 360
-                        dec = np.rad2deg(np.arctan2(rotation_matrix[0, 2],
-                                                    norm(rotation_matrix[1:3, 2])))
-                        roll = np.rad2deg(np.arctan2(rotation_matrix[1, 2],
-                                                     rotation_matrix[2, 2])) % 360
-                        self._logger.debug("RA:    %03.8f" % ra + ' deg')
-                        self._logger.debug("DEC:   %03.8f" % dec + ' deg')
-                        self._logger.debug("ROLL:  %03.8f" % roll + ' deg')
-                        self._logger.debug("FOV:   %03.8f" % np.rad2deg(fov) + ' deg')
-                        self._logger.debug('MATCH: %i' % len(match_tuples) + ' stars')
-                        self._logger.debug('SOLVE: %.2f' % round(t_solve, 2) + ' ms')
-                        self._logger.debug('RESID: %.2f' % residual + ' asec')
-                        return {'RA': ra, 'Dec': dec, 'Roll': roll, 'FOV': np.rad2deg(fov),
-                                'RMSE': residual, 'Matches': len(match_tuples),
-                                'Prob': prob_mismatch, 'T_solve': t_solve, 'T_extract': t_extract}
+        if previous_solution is not None and previous_solution['RA'] is not None:
+            solution = self.track_from_centroids(star_centroids, size, previous_solution,
+                                                 match_radius=match_radius,
+                                                 match_threshold=match_threshold)
+            if solution['RA'] is not None:
+                solution['T_solve'] = (precision_timestamp() - t0_solve)*1000
+                solution['Trials'] = 0
+                return solution
+            self._logger.debug('Tracking failed, doing a full solve')
+        for database in self._databases_to_try(fov_estimate):
+            solution = self._solve_with_database(database, star_centroids, height, width,
+                                                 fov_estimate, fov_max_error,
+                                                 pattern_checking_stars, match_radius,
+                                                 match_threshold, fov_refine)
+            if solution is not None:
+                # Solved in this time
+                t_solve = (precision_timestamp() - t0_solve)*1000
+                self._logger.debug('SOLVE: %.2f' % round(t_solve, 2) + ' ms')
+                solution['T_solve'] = t_solve
+                solution['Trials'] = self._trials
+                return solution
         t_solve = (precision_timestamp() - t0_solve) * 1000
         self._logger.debug('FAIL: Did not find a match to the stars! It took '
                            + str(round(t_solve)) + ' ms.')
         return {'RA': None, 'Dec': None, 'Roll': None, 'FOV': None, 'RMSE': None, 'Matches': None,
-                'Prob': None, 'T_solve': t_solve, 'T_extract': t_extract}
+                'Prob': None, 'T_solve': t_solve, 'Trials': self._trials}
+
+    def track_from_centroids(self, star_centroids, size, previous_solution, max_motion=None,
+                             match_radius=.01, match_threshold=1e-9):
+        """Solve for star centroids close to a previous solution, without pattern matching.
+
+        Meant for consecutive frames of a live view, where the field moves little from one frame
+        to the next. The catalog stars around the previous attitude are paired with the image
+        stars placed on the sky at that attitude, and the motion of the field is taken as the
+        offset shared by the most pairs. All stars are then matched and the match is verified
+        as in :meth:`solve_from_centroids`. The field of view of the previous solution is kept.
+
+        This is much faster than a full solve, but fails (returning None for all solution keys
+        except 'T_solve') if the field moved more than `max_motion` or rotated too much, in which
+        case a full solve is needed.
+
+        Args:
+            star_centroids (numpy.ndarray): (N,2) list of centroids, ordered by brightest first.
+            size (tuple): (height, width) of the image the centroids are from in pixels.
+            previous_solution (dict): Solution to track from, as returned by
+                :meth:`solve_from_centroids`.
+            max_motion (float, optional): Largest motion of the field since the previous solution
+                in degrees. If None (the default) half the field of view is used.
+            match_radius (float, optional): Maximum distance to a star to be considered a match
+                as a fraction of the image field of view.
+            match_threshold (float, optional): Maximum allowed mismatch probability to consider
+                the tracked position a valid match.
 
-    def _get_nearby_stars(self, vector, radius):
-        """Get stars within radius radians of the vector."""
-        return np.where(np.dot(np.asarray(vector), self.star_table[:, 2:5].T) > np.cos(radius))[0]
+        Returns:
+            dict: A dictionary with the same keys as returned by :meth:`solve_from_centroids`.
+        """
+        assert self.has_database, 'No database loaded'
+        t0_solve = precision_timestamp()
+        fov = np.deg2rad(float(previous_solution['FOV']))
+        if max_motion is None:
+            max_motion = fov / 2
+        else:
+            max_motion = np.deg2rad(float(max_motion))
+        match_radius = float(match_radius)
+        match_threshold = float(match_threshold)
+        database = self._databases_to_try(float(previous_solution['FOV']))[0]
+        star_centroids = np.asarray(star_centroids, dtype=np.float64).reshape((-1, 2))
+        star_centroids = star_centroids[:database['props']['verification_stars_per_fov']]
+        (height, width) = size[0:2]
+
+        solution = None
+        # place the image stars on the sky with the previous attitude
+        rotation_matrix = _rotation_matrix_from_attitude(previous_solution['RA'],
+                                                         previous_solution['Dec'],
+                                                         previous_solution['Roll'])
+        image_vectors = _compute_vectors(star_centroids, height, width, fov)
+        predicted_vectors = np.dot(image_vectors, rotation_matrix)
+        fov_diagonal_rad = fov * np.sqrt(width**2 + height**2) / width
+        nearby_star_vectors = database['star_table'][
+                self._get_nearby_stars(rotation_matrix[0, :], fov_diagonal_rad/2 + max_motion,
+                                       database), 2:5]
+        # all pairs of an image and a catalog star which may be the same star
+        (image_ind, catalog_ind) = np.nonzero(np.dot(predicted_vectors, nearby_star_vectors.T)
+                                              > np.cos(max_motion))
+        offsets = nearby_star_vectors[catalog_ind] - predicted_vectors[image_ind]
+        if len(offsets) > 0:
+            # the motion of the field is the offset most pairs agree on, found as the most common
+            # offset rounded to the match radius and refined with the pairs close to it
+            (bins, bin_ind, counts) = np.unique(np.round(offsets / (match_radius * fov)),
+                                                axis=0, return_inverse=True, return_counts=True)
+            motion = np.mean(offsets[bin_ind.ravel() == np.argmax(counts)], axis=0)
+            agree = norm(offsets - motion, axis=1) < match_radius * fov
+            # take each image star once, in case two catalog stars agree for it
+            (pairs, first) = np.unique(image_ind[agree], return_index=True)
+            self._logger.debug('Tracking: ' + str(len(pairs)) + ' of ' + str(len(image_vectors))
+                               + ' stars agree on the motion of the field')
+            if len(pairs) >= 3:
+                # fit the rotation to the agreeing pairs and verify it with all stars
+                rotation_matrix = _find_rotation_matrix(image_vectors[image_ind[agree][first]],
+                                                        nearby_star_vectors[
+                                                            catalog_ind[agree][first]])
+                solution = self._verify_rotation(database, star_centroids, height, width,
+                                                 rotation_matrix, fov, match_radius,
+                                                 match_threshold)
+        t_solve = (precision_timestamp() - t0_solve) * 1000
+        if solution is None:
+            self._logger.debug('FAIL: Could not track the stars! It took '
+                               + str(round(t_solve)) + ' ms.')
+            return {'RA': None, 'Dec': None, 'Roll': None, 'FOV': None, 'RMSE': None,
+                    'Matches': None, 'Prob': None, 'T_solve': t_solve}
+        self._logger.debug('TRACK: %.2f' % round(t_solve, 2) + ' ms')
+        solution['T_solve'] = t_solve
+        return solution
+
+    def _databases_to_try(self, fov_estimate):
+        """Get the loaded databases to try, in order, for a field of view estimate in degrees.
+
+        The set is sorted by the maximum field of view the databases were built for. The first
+        one which covers the estimate comes first, followed by its neighbours in the set.
+        """
+        databases = self._databases
+        first = len(databases) - 1
+        if fov_estimate is not None:
+            for (index, database) in enumerate(databases):
+                if database['props']['max_fov'] >= fov_estimate:
+                    first = index
+                    break
+        return [databases[index] for index in (first, first + 1, first - 1)
+                if 0 <= index < len(databases)]
+
+    def _solve_with_database(self, database, star_centroids, height, width, fov_estimate,
+                             fov_max_error, pattern_checking_stars, match_radius,
+                             match_threshold, fov_refine):
+        """Try to solve for star centroids with one database of the set.
+
+        Arguments are as for :meth:`solve_from_centroids`, except the field of view estimate
+        is in degrees and the error in radians. Returns the solution dictionary without timing
+        or None if no match was found.
+        """
+        star_table = database['star_table']
+        pattern_catalog = database['pattern_catalog']
+        if fov_estimate is None:
+            fov_estimate = np.deg2rad(database['props']['max_fov'])
+        else:
+            fov_estimate = np.deg2rad(fov_estimate)
+        # Extract relevant database properties
+        num_stars = database['props']['verification_stars_per_fov']
+        p_size = database['props']['pattern_size']
+        p_bins = database['props']['pattern_bins']
+        p_max_err = database['props']['pattern_max_error']
+        catalog_length = pattern_catalog.shape[0]
+        star_centroids = star_centroids[:num_stars]
+        self._logger.debug('Trying database with max_fov ' + str(database['props']['max_fov']))
+
+        # Stack all image patterns, brightest first, and get their edge ratios in one go
+        image_patterns = np.array(list(_generate_patterns_from_centroids(
+                                            star_centroids[:pattern_checking_stars], p_size)))
+        if len(image_patterns) > 0:
+            # compute star vectors using an estimate for the field-of-view in the x dimension
+            (_, pattern_edge_ratios) = _compute_edge_ratios(_compute_vectors(
+                                            image_patterns, height, width, fov_estimate))
+            # Possible hash codes to look up, all combinations of the bins within the error range
+            code_low = np.maximum(((pattern_edge_ratios - p_max_err) * p_bins).astype(int), 0)
+            code_high = np.minimum(((pattern_edge_ratios + p_max_err) * p_bins).astype(int),
+                                   p_bins - 1)
+            code_offsets = np.array(list(itertools.product(
+                range(int(np.max(code_high - code_low)) + 1), repeat=code_low.shape[1])))
+            hash_codes = code_low[:, None, :] + code_offsets[None, :, :]
+            (code_pattern, code_offset) = np.nonzero(np.all(hash_codes <= code_high[:, None, :],
+                                                            axis=-1))
+            # only look up non-duplicate codes for each pattern
+            hash_keys = _pack_keys(np.sort(hash_codes[code_pattern, code_offset, :], axis=-1),
+                                   p_bins)
+            (_, first) = np.unique(np.stack((code_pattern, hash_keys), axis=1), axis=0,
+                                   return_index=True)
+            first = np.sort(first)
+            (source, slots) = _get_at_keys(hash_keys[first],
+                                           _keys_to_indices(hash_keys[first], catalog_length),
+                                           database['pattern_keys'])
+            match_pattern = code_pattern[first][source]
+            match_rows = pattern_catalog[slots, :]
+            # retrieve the vectors of the stars in the catalog patterns and their edge ratios
+            (catalog_edges, catalog_edge_ratios) = _compute_edge_ratios(
+                                                        star_table[match_rows, 2:5])
+            # check if matches are within the given maximum allowable error
+            # note that this also filters out star patterns from colliding bins
+            survivors = np.all(np.abs(catalog_edge_ratios
+                                      - pattern_edge_ratios[match_pattern, :]) <= p_max_err,
+                               axis=1)
+            self._logger.debug('Probed ' + str(len(match_rows)) + ' catalog patterns for '
+                               + str(len(image_patterns)) + ' image patterns, '
+                               + str(np.count_nonzero(survivors)) + ' within edge ratio error.')
+            match_pattern = match_pattern[survivors]
+            match_rows = match_rows[survivors, :]
+            catalog_edges = catalog_edges[survivors, :]
+            # compute the actual field-of-view of each candidate directly: the pattern's edge
+            # lengths scale with tan(fov/2), so fit that scale to the catalog edges (least squares
+            # in closed form) and repeat once to correct for the nonlinearity off the image centre
+            match_fov = np.full(len(match_pattern), fov_estimate)
+            for _ in range(2):
+                (pattern_edges, _) = _compute_edge_ratios(_compute_vectors(
+                                            image_patterns[match_pattern], height, width,
+                                            match_fov[:, None]))
+                match_fov = 2 * np.arctan(np.tan(match_fov / 2)
+                                          * np.sum(catalog_edges * pattern_edges, axis=1)
+                                          / np.sum(pattern_edges**2, axis=1))
+            candidates = zip(match_pattern, match_rows, catalog_edges, match_fov)
+        else:
+            candidates = ()
+
+        for (pattern_ind, match_row, catalog_edges, fov) in candidates:
+            image_centroids = image_patterns[pattern_ind]
+            # retrieve the vectors of the stars in the catalog pattern
+            catalog_vectors = star_table[match_row, 2:5]
+            if fov_refine:
+                # refine the field-of-view using least squares optimization
+                # helper function that calculates a list of errors in pattern edge lengths
+                # with the catalog edge lengths for a given fov
+
+                def fov_to_error(fov):
+                    # recalculate the pattern's star vectors and edge lengths given the new fov
+                    (pattern_edges, _) = _compute_edge_ratios(_compute_vectors(
+                                                        image_centroids, height, width, fov))
+                    # return a list of errors, one for each edge
+                    return catalog_edges - pattern_edges
+                # find the fov that minimizes the squared error, starting with the direct estimate
+                fov = scipy.optimize.leastsq(fov_to_error, fov)[0][0]
+
+            # If the FOV is incorrect we can skip this immediately
+            if fov_max_error is not None and abs(fov - fov_estimate) > fov_max_error:
+                continue
+
+            # Recalculate vectors and uniquely sort them by distance from centroid
+            pattern_star_vectors = _compute_vectors(image_centroids, height, width, fov)
+            # find the centroid, or average position, of the star pattern
+            pattern_centroid = np.mean(pattern_star_vectors, axis=0)
+            # calculate each star's radius, or Euclidean distance from the centroid
+            pattern_radii = norm(pattern_star_vectors - pattern_centroid, axis=1)
+            # use the radii to uniquely order the pattern's star vectors so they can be
+            # matched with the catalog vectors
+            pattern_sorted_vectors = pattern_star_vectors[np.argsort(pattern_radii)]
+            # find the centroid, or average position, of the star pattern
+            catalog_centroid = np.mean(catalog_vectors, axis=0)
+            # calculate each star's radius, or Euclidean distance from the centroid
+            catalog_radii = norm(catalog_vectors - catalog_centroid, axis=1)
+            # use the radii to uniquely order the catalog vectors
+            catalog_sorted_vectors = catalog_vectors[np.argsort(catalog_radii)]
+
+            # Use the pattern match to find an estimate for the image's rotation matrix
+            rotation_matrix = _find_rotation_matrix(pattern_sorted_vectors,
+                                                    catalog_sorted_vectors)
+            self._trials += 1
+            solution = self._verify_rotation(database, star_centroids, height, width,
+                                             rotation_matrix, fov, match_radius, match_threshold)
+            if solution is not None:
+                return solution
+        return None
+
+    def _verify_rotation(self, database, star_centroids, height, width, rotation_matrix, fov,
+                         match_radius, match_threshold):
+        """Match all stars for a proposed rotation and field of view, and verify the match.
+
+        Returns the solution dictionary without timing, or None if the probability of the match
+        being wrong is not below `match_threshold`.
+        """
+        # calculate all star vectors using the new field-of-view
+        all_star_vectors = _compute_vectors(star_centroids, height, width, fov)
+        rotated_star_vectors = np.dot(all_star_vectors, rotation_matrix)
+        # Find all star vectors inside the (diagonal) field of view for matching
+        image_center_vector = rotation_matrix[0, :]
+        fov_diagonal_rad = fov * np.sqrt(width**2 + height**2) / width
+        nearby_star_vectors = database['star_table'][
+                self._get_nearby_stars(image_center_vector, fov_diagonal_rad/2, database), 2:5]
+        # Match the nearby star vectors to the proposed measured star vectors
+        within_match_radius = (np.dot(rotated_star_vectors, nearby_star_vectors.T)
+                               > np.cos(match_radius * fov))
+        # Only keep stars with exactly one matching star
+        matched = np.count_nonzero(within_match_radius, axis=1) == 1
+        match_tuples = list(zip(all_star_vectors[matched],
+                                nearby_star_vectors[np.argmax(within_match_radius[matched],
+                                                              axis=1)]))
+        # Statistical reasoning for probability that current match is incorrect:
+        num_extracted_stars = len(all_star_vectors)
+        num_nearby_catalog_stars = len(nearby_star_vectors)
+        num_star_matches = len(match_tuples)
+        # Probability that a single star is a mismatch
+        prob_single_star_mismatch = \
+            1 - (1 - num_nearby_catalog_stars * match_radius**2)
+        # Two matches can always be made using the degrees of freedom of the pattern
+        prob_mismatch = scipy.stats.binom.cdf(num_extracted_stars
+                                              - (num_star_matches - 2),
+                                              num_extracted_stars,
+                                              1 - prob_single_star_mismatch)
+        if prob_mismatch >= match_threshold:
+            return None
+        # diplay mismatch probability in scientific notation
+        self._logger.debug("NEW P: %.4g" % prob_mismatch)
+        # if a match has been found, recompute rotation with all matched vectors
+        rotation_matrix = _find_rotation_matrix(*zip(*match_tuples))
+        # Residuals calculation
+        measured = np.dot(np.array([pair[0] for pair in match_tuples]), rotation_matrix)
+        catalog = np.array([pair[1] for pair in match_tuples])
+        angles = np.arcsin(norm(np.cross(measured, catalog), axis=1)
+                           / norm(measured, axis=1) / norm(catalog, axis=1))
+        residual = np.rad2deg(np.sqrt(np.mean(angles**2))) * 3600
+        # extract right ascension, declination, and roll from rotation matrix
+        ra = np.rad2deg(np.arctan2(rotation_matrix[0, 1],
+                                   rotation_matrix[0, 0])) % 360
+        dec = np.rad2deg(np.arctan2(rotation_matrix[0, 2],
+                                    norm(rotation_matrix[1:3, 2])))
+        roll = np.rad2deg(np.arctan2(rotation_matrix[1, 2],
+                                     rotation_matrix[2, 2])) % 360
+        self._logger.debug("RA:    %03.8f" % ra + ' deg')
+        self._logger.debug("DEC:   %03.8f" % dec + ' deg')
+        self._logger.debug("ROLL:  %03.8f" % roll + ' deg')
+        self._logger.debug("FOV:   %03.8f" % np.rad2deg(fov) + ' deg')
+        self._logger.debug('MATCH: %i' % len(match_tuples) + ' stars')
+        self._logger.debug('RESID: %.2f' % residual + ' asec')
+        return {'RA': ra, 'Dec': dec, 'Roll': roll, 'FOV': np.rad2deg(fov),
+                'RMSE': residual, 'Matches': len(match_tuples),
+                'Prob': prob_mismatch}
+
+    def _get_nearby_stars(self, vector, radius, database=None):
+        """Get stars within radius radians of the vector.
+
+        Only the stars in the cells of the sky index which overlap the cone are tested. The
+        stars are taken from the given database of the set, or the current one if None.
+        """
+        vector = np.asarray(vector)
+        if database is None:
+            database = self._current_database()
+        (bins, stars, cells, starts) = database['sky_index']
+        # given error of at most radius in each dimension, compute the box of cells to look in
+        low = np.clip(((vector + 1 - radius) * bins).astype(int), 0, 2*bins - 1)
+        high = np.clip(((vector + 1 + radius) * bins).astype(int), 0, 2*bins - 1)
+        # cells are contiguous along the last dimension, take one run of stars per (x, y) cell
+        (cell_x, cell_y) = np.meshgrid(np.arange(low[0], high[0] + 1),
+                                       np.arange(low[1], high[1] + 1), indexing='ij')
+        run_low = np.ravel_multi_index((cell_x.ravel(), cell_y.ravel(),
+                                        np.full(cell_x.size, low[2])), (2*bins,)*3)
+        run_high = np.ravel_multi_index((cell_x.ravel(), cell_y.ravel(),
+                                         np.full(cell_x.size, high[2])), (2*bins,)*3)
+        run_start = starts[np.searchsorted(cells, run_low, side='left')]
+        run_end = starts[np.searchsorted(cells, run_high, side='right')]
+        candidates = np.concatenate([stars[start:end] for (start, end)
+                                     in zip(run_start, run_end)])
+        nearby = candidates[np.dot(database['star_table'][candidates, 2:5], vector)
+                            > np.cos(radius)]
+        return np.sort(nearby)
 
 
 def get_centroids_from_image(image, sigma=3, image_th=None, crop=None, downsample=None,
                              filtsize=25, bg_sub_mode='local_mean', sigma_mode='global_root_square',
+                             tile_size=32, background_model=None, parallel_tiles=None,
+                             partial_extraction=False, peak_window=9,
                              binary_open=True, centroid_window=None, max_area=None, min_area=None,
                              max_sum=None, min_sum=None, max_axis_ratio=None, max_returned=None,
                              return_moments=False, return_images=False):
@@ -936,7 +1623,9 @@ def get_centroids_from_image(image, sigma=3, image_th=None, crop=None, downsampl
     is `bg_sub_mode='local_mean'` and `sigma_mode='global_root_square'` with a large (e.g. 15 to 25)
     sized filter, which is the default. You may elect to do background subtraction and image
     thresholding by your own methods, then pass `bg_sub_mode=None` and your threshold as `image_th`
-    to bypass these extraction steps.
+    to bypass these extraction steps. Close to the local median quality at a fraction of its cost
+    are the tile modes, `bg_sub_mode='tile_mean'` and `sigma_mode='tile_root_square'`, which
+    compute the statistics once per tile of `tile_size` and interpolate between the tiles.
 
     The algorithm proceeds as follows:
         1. Convert image to 2D numpy.ndarray with type float32.
@@ -950,6 +1639,9 @@ def get_centroids_from_image(image, sigma=3, image_th=None, crop=None, downsampl
              subtract pixelwise.
            - 'global_median': Subtract the median value of all pixels from each pixel.
            - 'global_mean': Subtract the mean value of all pixels from each pixel.
+           - 'tile_median': Take the median of each square tile of `tile_size` pixels and
+             bilinearly interpolate between the tile centres for the background image.
+           - 'tile_mean': As 'tile_median' with the 3 sigma clipped mean of each tile.
 
         4. Calculate the image threshold if image_th is None. If image_th is defined this value
            will be used to threshold the image. The threshold is determined by calculating the
@@ -964,6 +1656,11 @@ def get_centroids_from_image(image, sigma=3, image_th=None, crop=None, downsampl
              as the standard deviation.
            - 'global_root_square' (the default): Use the square root of the mean of the square of
              all pixels as the standard deviation.
+           - 'tile_median_abs': The median of the absolute values in each tile of `tile_size`
+             scaled by 1.48, bilinearly interpolated between the tile centres.
+           - 'tile_root_square': The 3 sigma clipped root mean square in each tile, bilinearly
+             interpolated. With `bg_sub_mode='tile_mean'` the clipped standard deviation of the
+             tiles found for the background is used, so the noise costs nothing extra.
 
         5. Create a binary mask using the image threshold. If `binary_open=True` (the default)
            apply a binary opening operation with a 3x3 cross as structuring element to clean up the
@@ -972,6 +1669,8 @@ def get_centroids_from_image(image, sigma=3, image_th=None, crop=None, downsampl
         7. Calculate statistics on each region and reject it if it fails any of the max or min
            values passed. Calculated statistics are: area, sum, centroid (first moments) in x and
            y, second moments in xx, yy, and xy, major over minor axis ratio.
+           Steps 5 to 7 can run on strips of the image in parallel, see `parallel_tiles`, or
+           only for the brightest spots, see `partial_extraction`.
         8. Sort the regions, largest sum first, and keep at most `max_returned` if not None.
         9. If `centroid_window` is not None, recalculate the statistics using a square region of
            the supplied width (instead of the region from the binary mask).
@@ -990,10 +1689,26 @@ def get_centroids_from_image(image, sigma=3, image_th=None, crop=None, downsampl
         filtsize (int, optional): Size of filter to use in local operations. Must be odd.
             Default 25.
         bg_sub_mode (str, optional): Background subtraction mode. Must be one of 'local_median',
-            'local_mean' (the default), 'global_median', 'global_mean'.
+            'local_mean' (the default), 'global_median', 'global_mean', 'tile_median' or
+            'tile_mean'.
         sigma_mode (str, optinal): Mode used to calculate noise standard deviation. Must be one of
-            'local_median_abs', 'local_root_square', 'global_median_abs', or
-            'global_root_square' (the default).
+            'local_median_abs', 'local_root_square', 'global_median_abs',
+            'global_root_square' (the default), 'tile_median_abs' or 'tile_root_square'.
+        tile_size (int, optional): Size of the tiles used by the tile modes. Default 32.
+        background_model (BackgroundModel, optional): If supplied, the background and noise images
+            are taken from this model of the previous frames (and the frame is added to it)
+            instead of `bg_sub_mode` and `sigma_mode`, see :class:`tetra3.BackgroundModel`.
+        parallel_tiles (int, optional): If more than 1, split the image into this many strips of
+            rows, threshold, label and measure them on a thread pool (numpy and scipy.ndimage
+            release the GIL) and join the spots crossing from one strip into the next. Default
+            None, the whole image at once.
+        partial_extraction (bool, optional): If True, don't label and measure every spot, only
+            those around the brightest 2 x `max_returned` local maxima above the threshold, in
+            windows of `peak_window`. Much faster in dense fields when few stars are wanted,
+            requires `max_returned`. `binary_open` then requires the four neighbours of the
+            maximum above the threshold and `parallel_tiles` has no effect. Default False.
+        peak_window (int, optional): Size of the square windows the spots are measured in with
+            `partial_extraction`. Default 9.
         binary_open (bool, optional): If True (the default), apply binary opening with 3x3 cross
            to thresholded binary mask.
         centroid_window (int, optional): If supplied, recalculate statistics using a square window
@@ -1071,7 +1786,12 @@ def get_centroids_from_image(image, sigma=3, image_th=None, crop=None, downsampl
     if return_images:
         images_dict['cropped_and_downsampled'] = image.copy()
     # 3. Subtract background:
-    if bg_sub_mode is not None:
+    if background_model is not None:
+        (background, noise) = background_model.update(image)
+        image = image - background
+        if image_th is None:
+            image_th = noise * sigma
+    elif bg_sub_mode is not None:
         if bg_sub_mode.lower() == 'local_median':
             assert filtsize is not None, \
                 'Must define filter size for local median background subtraction'
@@ -1088,9 +1808,15 @@ def get_centroids_from_image(image, sigma=3, image_th=None, crop=None, downsampl
             image = image - np.median(image)
         elif bg_sub_mode.lower() == 'global_mean':
             image = image - np.mean(image)
+        elif bg_sub_mode.lower() == 'tile_median':
+            tiles = _tile_grid(image, tile_size)
+            image = image - _upsample_tiles(np.median(tiles, axis=-1), tile_size, height, width)
+        elif bg_sub_mode.lower() == 'tile_mean':
+            (tile_mean, tile_std) = _tile_clipped_stats(_tile_grid(image, tile_size))
+            image = image - _upsample_tiles(tile_mean, tile_size, height, width)
         else:
             raise AssertionError('bg_sub_mode must be string: local_median, local_mean,'
-                                 + ' global_median, or global_mean')
+                                 + ' global_median, global_mean, tile_median or tile_mean')
     if return_images:
         images_dict['removed_background'] = image.copy()
     # 4. Find noise standard deviation to threshold unless a threshold is already defined!
@@ -1113,24 +1839,79 @@ def get_centroids_from_image(image, sigma=3, image_th=None, crop=None, downsampl
             img_std = np.median(np.abs(image)) * 1.48
         elif sigma_mode.lower() == 'global_root_square':
             img_std = np.sqrt(np.mean(image**2))
+        elif sigma_mode.lower() == 'tile_median_abs':
+            tiles = np.abs(_tile_grid(image, tile_size))
+            img_std = _upsample_tiles(np.median(tiles, axis=-1) * 1.48, tile_size, height, width)
+        elif sigma_mode.lower() == 'tile_root_square':
+            if bg_sub_mode is None or bg_sub_mode.lower() != 'tile_mean':
+                (tile_mean, tile_std) = _tile_clipped_stats(_tile_grid(image, tile_size))
+                tile_std = np.sqrt(tile_mean**2 + tile_std**2)
+            img_std = _upsample_tiles(tile_std, tile_size, height, width)
         else:
             raise AssertionError('sigma_mode must be string: local_median_abs, local_root_square,'
-                                 + ' global_median_abs, or global_root_square')
+                                 + ' global_median_abs, global_root_square, tile_median_abs or'
+                                 + ' tile_root_square')
         image_th = img_std * sigma
     if return_images:
         images_dict['image_threshold'] = image_th
-    # 5. Threshold to find binary mask
-    bin_mask = image > image_th
-    if binary_open:
-        bin_mask = scipy.ndimage.binary_opening(bin_mask)
-    if return_images:
-        images_dict['binary_mask'] = bin_mask
-    # 6. Label each region in the binary mask
-    (labels, num_labels) = scipy.ndimage.label(bin_mask)
-    index = np.arange(1, num_labels + 1)
-    if return_images:
-        images_dict['labelled_regions'] = labels
-    if num_labels < 1:
+    # rows beyond a strip which the binary opening looks at, so a strip's mask is exact
+    halo = 2 if binary_open else 0
+
+    def find_spots(own_first, own_last):
+        """Steps 5 and 6 for image rows own_first to own_last, and the sums step 7 needs for each
+        spot in them, see :meth:`_spot_sums`. Returns the sums, the binary mask and the labels."""
+        (first, last) = (max(0, own_first - halo), min(height, own_last + halo))
+        strip_th = image_th[first:last] if np.ndim(image_th) == 2 else image_th
+        # 5. Threshold to find binary mask
+        bin_mask = image[first:last] > strip_th
+        if binary_open:
+            bin_mask = scipy.ndimage.binary_opening(bin_mask)
+        bin_mask = bin_mask[own_first - first:own_last - first]
+        # 6. Label each region in the binary mask
+        (labels, num_labels) = scipy.ndimage.label(bin_mask)
+        return (_spot_sums(image[own_first:own_last], labels, num_labels, own_first), bin_mask,
+                labels)
+
+    if partial_extraction:
+        # 5. to 7. Only the spots around the brightest local maxima, twice as many as will be
+        # returned as some are rejected and the spots are sorted by sum, not peak
+        assert max_returned, 'Must define max_returned for partial extraction'
+        (extracted, minor, bin_mask) = _measure_peaks(image, image_th, 2 * max_returned,
+                                                      peak_window, binary_open)
+        if return_images:
+            images_dict['binary_mask'] = bin_mask
+    else:
+        # 5. to 7. Either on the whole image or on strips of rows on a thread pool, the spots
+        # crossing from one strip to the next are joined
+        if parallel_tiles is not None and parallel_tiles > 1:
+            bounds = np.linspace(0, height, parallel_tiles + 1).astype(int)
+            strips = [(own_first, own_last) for (own_first, own_last)
+                      in zip(bounds[:-1], bounds[1:]) if own_last > own_first]
+            results = list(_extraction_pool().map(lambda strip: find_spots(*strip), strips))
+        else:
+            results = [find_spots(0, height)]
+        (sums, labels) = _join_strip_spots([result[0] for result in results],
+                                           [result[2] for result in results], return_images)
+        # 7. Get statistics and threshold
+        (extracted, minor) = _spot_statistics(sums)
+        if return_images:
+            bin_mask = np.concatenate([result[1] for result in results])
+            images_dict['binary_mask'] = bin_mask
+            images_dict['labelled_regions'] = labels
+    found = len(extracted)
+    keep = np.all(np.isfinite(extracted[:, 0:3]), axis=1)
+    if min_area:
+        keep &= extracted[:, 6] >= min_area
+    if max_area:
+        keep &= extracted[:, 6] <= max_area
+    if min_sum:
+        keep &= extracted[:, 0] >= min_sum
+    if max_sum:
+        keep &= extracted[:, 0] <= max_sum
+    if max_axis_ratio:
+        keep &= (minor > 0) & (extracted[:, 7] <= max_axis_ratio)
+    extracted = extracted[keep, :]
+    if found < 1:
         # Found nothing in binary image, return empty.
         if return_moments and return_images:
             return ((np.empty((0, 2)), np.empty((0, 1)), np.empty((0, 1)), np.empty((0, 3)),
@@ -1142,45 +1923,6 @@ def get_centroids_from_image(image, sigma=3, image_th=None, crop=None, downsampl
             return (np.empty((0, 2)), images_dict)
         else:
             return np.empty((0, 2))
-
-    # 7. Get statistics and threshold
-    def calc_stats(a, p):
-        """Calculates statistics for each labelled region:
-        - Sum (zeroth moment)
-        - Centroid y, x (first moment)
-        - Variance xx, yy, xy (second moment)
-        - Area (pixels)
-        - Major axis/minor axis ratio
-        """
-        (y, x) = (np.unravel_index(p, (height, width)))
-        area = len(a)
-        if min_area and area < min_area:
-            return (np.nan,)*8
-        if max_area and area > max_area:
-            return (np.nan,)*8
-        m0 = np.sum(a)
-        if min_sum and m0 < min_sum:
-            return (np.nan,)*8
-        if max_sum and m0 > max_sum:
-            return (np.nan,)*8
-        m1_x = np.sum(x * a) / m0
-        m1_y = np.sum(y * a) / m0
-        m2_xx = max(0, np.sum((x - m1_x)**2 * a) / m0)
-        m2_yy = max(0, np.sum((y - m1_y)**2 * a) / m0)
-        m2_xy = np.sum((x - m1_x) * (y - m1_y) * a) / m0
-        major = np.sqrt(2 * (m2_xx + m2_yy + np.sqrt((m2_xx - m2_yy)**2 + 4 * m2_xy**2)))
-        minor = np.sqrt(2 * max(0, m2_xx + m2_yy - np.sqrt((m2_xx - m2_yy)**2 + 4 * m2_xy**2)))
-        if max_axis_ratio and minor <= 0:
-            return (np.nan,)*8
-        axis_ratio = major / max(minor, .000000001)
-        if max_axis_ratio and axis_ratio > max_axis_ratio:
-            return (np.nan,)*8
-        return (m0, m1_y+.5, m1_x+.5, m2_xx, m2_yy, m2_xy, area, axis_ratio)
-
-    tmp = scipy.ndimage.labeled_comprehension(image, labels, index, calc_stats, '8f', None,
-                                              pass_positions=True)
-    valid = np.all(~np.isnan(tmp), axis=1)
-    extracted = tmp[valid, :]
     if return_images:
         images_dict['label_statistics'] = bin_mask.copy()
     # 8. Sort
@@ -1230,6 +1972,241 @@ def get_centroids_from_image(image, sigma=3, image_th=None, crop=None, downsampl
         return extracted[:, 1:3]
 
 
+def _spot_sums(image, labels, num_labels, first_row=0):
+    """The sums of the labelled spots of an image (or rows of one starting at `first_row`) from
+    which :meth:`_spot_statistics` calculates them: a (7, num_labels) array of the area, sum and
+    the sums of x, y, x*x, y*y and x*y weighted by the pixel values, for pixel coordinates of the
+    whole image. Sums of the parts of a spot add up to those of the whole spot."""
+    (y, x) = np.nonzero(labels)
+    spot = labels[y, x]
+    a = image[y, x].astype(np.float64)
+    (x, y) = (x.astype(np.float64), (y + first_row).astype(np.float64))
+    weights = (None, a, x * a, y * a, x * x * a, y * y * a, x * y * a)
+    return np.array([np.bincount(spot, weights=w, minlength=num_labels + 1)[1:] for w in weights])
+
+
+def _join_strip_spots(sums, labels, return_labels=False):
+    """Join the spots of strips of rows from :meth:`_spot_sums`, in order from the top, which
+    cross from one strip into the next. Returns the sums of the joined spots and, if
+    `return_labels`, the labels of the whole image numbered like them (else None)."""
+    offsets = np.cumsum([0] + [s.shape[1] for s in sums])
+    total = offsets[-1]
+    sums = np.concatenate(sums, axis=1)
+    # labels are connected up and down, a spot crosses where it is in the same column of the
+    # last row of a strip and the first row of the next
+    (above, below) = ([], [])
+    for (i, (upper, lower)) in enumerate(zip(labels[:-1], labels[1:])):
+        crossing = (upper[-1] > 0) & (lower[0] > 0)
+        above.append(upper[-1][crossing] + offsets[i] - 1)
+        below.append(lower[0][crossing] + offsets[i + 1] - 1)
+    joined = np.arange(total)
+    if len(above) and sum(len(a) for a in above):
+        graph = scipy.sparse.coo_matrix((np.ones(sum(len(a) for a in above)),
+                                         (np.concatenate(above), np.concatenate(below))),
+                                        shape=(total, total))
+        (total, joined) = scipy.sparse.csgraph.connected_components(graph, directed=False)
+        sums = np.array([np.bincount(joined, weights=s, minlength=total) for s in sums])
+    image_labels = None
+    if return_labels:
+        numbering = np.concatenate(([0], joined + 1))
+        image_labels = np.concatenate([numbering[np.where(strip > 0, strip + offset, 0)]
+                                       for (strip, offset) in zip(labels, offsets)])
+    return (sums, image_labels)
+
+
+def _spot_statistics(sums):
+    """Statistics of spots from their sums from :meth:`_spot_sums`, as calculated in
+    :meth:`tetra3.get_centroids_from_image`: the (N,8) sum, centroid y and x, variances xx, yy
+    and xy, area and major over minor axis ratio, and the N minor axes."""
+    (area, m0, sum_x, sum_y, sum_xx, sum_yy, sum_xy) = sums
+    with np.errstate(divide='ignore', invalid='ignore'):
+        m1_x = sum_x / m0
+        m1_y = sum_y / m0
+        m2_xx = np.maximum(0, sum_xx / m0 - m1_x**2)
+        m2_yy = np.maximum(0, sum_yy / m0 - m1_y**2)
+        m2_xy = sum_xy / m0 - m1_x * m1_y
+    root = np.sqrt((m2_xx - m2_yy)**2 + 4 * m2_xy**2)
+    major = np.sqrt(2 * (m2_xx + m2_yy + root))
+    minor = np.sqrt(2 * np.maximum(0, m2_xx + m2_yy - root))
+    axis_ratio = major / np.maximum(minor, .000000001)
+    return (np.column_stack((m0, m1_y + .5, m1_x + .5, m2_xx, m2_yy, m2_xy, area, axis_ratio)),
+            minor)
+
+
+def _measure_peaks(image, image_th, count, window, cross):
+    """Statistics of the spots at the brightest `count` local maxima above the threshold, as
+    calculated in :meth:`tetra3.get_centroids_from_image`, but from the pixels above the threshold
+    in a square window around each maximum. Maxima within the window of a brighter one are left
+    out. If cross is True the four neighbours of the maximum must be above the threshold too.
+
+    Returns the (N,8) statistics, the N minor axes and the binary mask.
+    """
+    (height, width) = image.shape
+    above = image > image_th
+    # local maxima among the pixels above the threshold, usually a small part of the image
+    (py, px) = np.nonzero(above)
+    peak = image[py, px]
+    keep = np.ones(len(py), dtype=bool)
+    for (dy, dx) in itertools.product((-1, 0, 1), repeat=2):
+        (ny, nx) = (np.clip(py + dy, 0, height - 1), np.clip(px + dx, 0, width - 1))
+        keep &= peak >= image[ny, nx]
+        if cross and dy * dx == 0:
+            keep &= above[ny, nx]
+    (py, px, peak) = (py[keep], px[keep], peak[keep])
+    if len(py) == 0:
+        return (np.empty((0, 8)), np.empty(0), above)
+    if len(peak) > count:
+        brightest = np.argpartition(-peak, count)[:count]
+        (py, px, peak) = (py[brightest], px[brightest], peak[brightest])
+    order = np.argsort(-peak, kind='stable')
+    (py, px) = (py[order], px[order])
+    # the first close candidate (brightest, as sorted) of each candidate must be itself
+    r = window // 2
+    close = (np.abs(py[:, None] - py[None, :]) <= r) & (np.abs(px[:, None] - px[None, :]) <= r)
+    keep = np.argmax(close, axis=0) == np.arange(len(py))
+    (py, px) = (py[keep], px[keep])
+    window = min(window, height, width)
+    rows = np.clip(py - r, 0, height - window)[:, None] + np.arange(window)
+    cols = np.clip(px - r, 0, width - window)[:, None] + np.arange(window)
+    a = image[rows[:, :, None], cols[:, None, :]]
+    if np.ndim(image_th) == 2:
+        a = np.where(a > image_th[rows[:, :, None], cols[:, None, :]], a, 0)
+    else:
+        a = np.where(a > image_th, a, 0)
+    (y, x) = (rows[:, :, None], cols[:, None, :])
+    area = np.count_nonzero(a, axis=(1, 2))
+    m0 = np.sum(a, axis=(1, 2))
+    m1_x = np.sum(x * a, axis=(1, 2)) / m0
+    m1_y = np.sum(y * a, axis=(1, 2)) / m0
+    (dx, dy) = (x - m1_x[:, None, None], y - m1_y[:, None, None])
+    m2_xx = np.maximum(0, np.sum(dx**2 * a, axis=(1, 2)) / m0)
+    m2_yy = np.maximum(0, np.sum(dy**2 * a, axis=(1, 2)) / m0)
+    m2_xy = np.sum(dx * dy * a, axis=(1, 2)) / m0
+    root = np.sqrt((m2_xx - m2_yy)**2 + 4 * m2_xy**2)
+    major = np.sqrt(2 * (m2_xx + m2_yy + root))
+    minor = np.sqrt(2 * np.maximum(0, m2_xx + m2_yy - root))
+    axis_ratio = major / np.maximum(minor, .000000001)
+    return (np.column_stack((m0, m1_y + .5, m1_x + .5, m2_xx, m2_yy, m2_xy, area, axis_ratio)),
+            minor, above)
+
+
+_extraction_executor = None
+
+
+def _extraction_pool():
+    """The thread pool for `parallel_tiles` extraction, started on first use."""
+    global _extraction_executor
+    if _extraction_executor is None:
+        _extraction_executor = concurrent.futures.ThreadPoolExecutor(
+            os.cpu_count(), thread_name_prefix='tetra3 extraction')
+    return _extraction_executor
+
+
+def _tile_grid(image, tile_size, step=2):
+    """The image as a (rows, columns, samples) array of square tiles, the last row and column of
+    tiles are filled up by mirroring the image. Only every `step` pixel in each direction is
+    sampled, plenty for the background and noise levels and a quarter of the work."""
+    (height, width) = image.shape
+    (rows, cols) = (-(-height // tile_size), -(-width // tile_size))
+    image = np.pad(image, ((0, rows * tile_size - height), (0, cols * tile_size - width)),
+                   mode='symmetric')
+    tiles = image.reshape(rows, tile_size, cols, tile_size)[:, ::step, :, ::step]
+    return tiles.swapaxes(1, 2).reshape(rows, cols, -1)
+
+
+def _tile_clipped_stats(tiles, clip=3, iterations=3):
+    """Sigma clipped mean and standard deviation of each tile of :meth:`_tile_grid`."""
+    mean = tiles.mean(axis=-1, keepdims=True)
+    std = tiles.std(axis=-1, keepdims=True)
+    for _ in range(iterations):
+        keep = np.abs(tiles - mean) <= clip * std
+        count = np.maximum(np.count_nonzero(keep, axis=-1)[..., None], 1)
+        mean = np.sum(tiles, axis=-1, where=keep, keepdims=True) / count
+        std = np.sqrt(np.sum((tiles - mean)**2, axis=-1, where=keep, keepdims=True) / count)
+    return (mean[..., 0].astype(np.float32), std[..., 0].astype(np.float32))
+
+
+def _upsample_tiles(values, tile_size, height, width):
+    """Bilinearly interpolate per tile values, taken at the tile centres, to a full size image."""
+    def weights(size, cells):
+        pos = np.clip((np.arange(size) + .5) / tile_size - .5, 0, cells - 1)
+        low = np.minimum(pos.astype(int), max(cells - 2, 0))
+        return (low, np.minimum(low + 1, cells - 1), (pos - low).astype(np.float32))
+    (y0, y1, fy) = weights(height, values.shape[0])
+    (x0, x1, fx) = weights(width, values.shape[1])
+    rows = values[y0] * (1 - fy[:, None]) + values[y1] * fy[:, None]
+    return rows[:, x0] * (1 - fx) + rows[:, x1] * fx
+
+
+class BackgroundModel():
+    """Background and noise images kept up to date over consecutive frames of the same camera.
+
+    The sky background and noise barely change from one exposure to the next, so instead of
+    filtering every frame the model is updated from the tile statistics of every `update_every`
+    frame (see the 'tile_mean' and 'tile_root_square' modes of
+    :meth:`tetra3.get_centroids_from_image`), as an exponential moving average with `weight` for
+    the new frame. In between, frames are only subtracted from and thresholded against the cached
+    images. The model starts over when the frame size changes or when the level of a frame is more
+    than `max_jump` noise standard deviations off the model (exposure or gain changed, a light
+    came on, ...), checked every frame on a sparse grid of pixels.
+
+    Pass the model as `background_model` to :meth:`tetra3.get_centroids_from_image`, or use
+    `track_background=True` with :meth:`Tetra3.get_centroids`.
+
+    Args:
+        tile_size (int, optional): Size of the tiles the statistics are computed in. Default 32.
+        update_every (int, optional): Update the model with every this many frames. Default 8.
+        weight (float, optional): Weight of the new frame when updating. Default 0.25.
+        max_jump (float, optional): Start over when the level changes more than this many noise
+            standard deviations. Default 3.
+    """
+    def __init__(self, tile_size=32, update_every=8, weight=.25, max_jump=3):
+        self.tile_size = tile_size
+        self.update_every = update_every
+        self.weight = weight
+        self.max_jump = max_jump
+        self.background = None
+        self.noise = None
+        self._tile_background = None
+        self._tile_noise = None
+        self._since_update = 0
+        self.frames = 0
+        self.updates = 0
+        self.resets = 0
+
+    def reset(self):
+        """Forget the model, the next frame starts a new one."""
+        self._tile_background = None
+
+    def _jumped(self, image):
+        step = self.tile_size // 2
+        change = np.median(image[::step, ::step] - self.background[::step, ::step])
+        return abs(change) > self.max_jump * np.median(self._tile_noise)
+
+    def update(self, image):
+        """Add a frame to the model, returns the (background, noise) images to use for it."""
+        self.frames += 1
+        if self._tile_background is not None and (self.background.shape != image.shape
+                                                  or self._jumped(image)):
+            self.resets += 1
+            self.reset()
+        if self._tile_background is not None and self._since_update < self.update_every - 1:
+            self._since_update += 1
+            return (self.background, self.noise)
+        (mean, std) = _tile_clipped_stats(_tile_grid(image, self.tile_size))
+        if self._tile_background is None:
+            (self._tile_background, self._tile_noise) = (mean, std)
+        else:
+            self._tile_background += self.weight * (mean - self._tile_background)
+            self._tile_noise += self.weight * (std - self._tile_noise)
+        (height, width) = image.shape
+        self.background = _upsample_tiles(self._tile_background, self.tile_size, height, width)
+        self.noise = _upsample_tiles(self._tile_noise, self.tile_size, height, width)
+        self._since_update = 0
+        self.updates += 1
+        return (self.background, self.noise)
+
+
 def crop_and_downsample_image(image, crop=None, downsample=None, sum_when_downsample=True,
                               return_offsets=False):
     """Crop and/or downsample an image. Cropping is applied before downsampling.